@@ -1,3 +1,4 @@
+import asyncio
 import io
 import json
 import logging
@@ -7,9 +8,10 @@ import os
 import base64
 import subprocess
 from pathlib import Path
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional, Union, cast
 import json
 
+from azure.core.credentials_async import AsyncTokenCredential
 from azure.core.exceptions import ResourceNotFoundError
 from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
 from azure.monitor.opentelemetry import configure_azure_monitor
@@ -30,11 +32,16 @@ from quart import (
     send_file,
     send_from_directory,
 )
+from quart.formparser import FormDataParser
 from quart_cors import cors
 
+from approaches.approach import Approach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
 from core.authentication import AuthenticationHelper
+from core.deadline import DeadlineExceeded, DeadlineSettings
+from core.looplag import LoopLagMonitor
+from core.uploads import UploadStaging
 
 CONFIG_ASK_APPROACH = "ask_approach"
 CONFIG_CHAT_APPROACH = "chat_approach"
@@ -42,13 +49,20 @@ CONFIG_BLOB_CONTAINER_CLIENT = "blob_container_client"
 CONFIG_AUTH_CLIENT = "auth_client"
 CONFIG_SEARCH_CLIENT = "search_client"
 CONFIG_OPENAI_CLIENT = "openai_client"
+CONFIG_LOOP_LAG_MONITOR = "loop_lag_monitor"
+CONFIG_DEADLINE_SETTINGS = "deadline_settings"
+# Questions embedded in a single call to /ask/batch
+ASK_BATCH_MAX_QUESTIONS = 100
 ERROR_MESSAGE = """The app encountered an error processing your request.
 If you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.
 Error type: {error_type}
 """
 ERROR_MESSAGE_FILTER = """Your message contains content that was flagged by the OpenAI content filter."""
+ERROR_MESSAGE_DEADLINE = """The request took longer than its deadline allows, during the {stage} stage."""
 
 bp = Blueprint("routes", __name__, static_folder="static")
+# prepdocs and its library are deployed with the backend, in ./scripts
+sys.path.append(str(Path(__file__).parent / "scripts"))
 # Fix Windows registry issue with mimetypes
 mimetypes.add_type("application/javascript", ".js")
 mimetypes.add_type("text/css", ".css")
@@ -106,6 +120,8 @@ async def content_file(path: str):
 def error_dict(error: Exception) -> dict:
     if isinstance(error, APIError) and error.code == "content_filter":
         return {"error": ERROR_MESSAGE_FILTER}
+    if isinstance(error, DeadlineExceeded):
+        return {"error": ERROR_MESSAGE_DEADLINE.format(stage=error.stage)}
     return {"error": ERROR_MESSAGE.format(error_type=type(error))}
 
 
@@ -113,25 +129,28 @@ def error_response(error: Exception, route: str, status_code: int = 500):
     logging.exception("Exception in %s: %s", route, error)
     if isinstance(error, APIError) and error.code == "content_filter":
         status_code = 400
+    if isinstance(error, DeadlineExceeded):
+        status_code = 504
     return jsonify(error_dict(error)), status_code
 
 
-def run_prepdocs_script(index: str, container: str):
+async def run_prepdocs_script(index: str, container: str, files: str, use_file_manifest: bool = True):
     script_path = os.path.join(os.path.dirname(
         __file__), 'scripts', 'prepdocs.sh')
 
-    try:
-        # Pass the index and container as arguments to the shell script
-        result = subprocess.run(
-            ['sh', script_path, index, container],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        print(f"Script output: {result.stdout.decode()}")
-    except subprocess.CalledProcessError as e:
-        print(f"Script failed with error: {e.stderr.decode()}")
-        raise e
+    # Pass the index, container and files pattern as arguments to the shell script.
+    # The script runs as an asyncio subprocess so other requests keep being served while it ingests.
+    # The file manifest remembers files by path, it's only worth keeping for the paths ingested again.
+    process = await asyncio.create_subprocess_exec(
+        'sh', script_path, index, container, files, *([] if use_file_manifest else ["none"]),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        logging.error("Script failed with error: %s", stderr.decode())
+        raise subprocess.CalledProcessError(process.returncode or 1, script_path, stdout, stderr)
+    logging.info("Script output: %s", stdout.decode())
 
 
 @bp.route("/ask", methods=["POST"])
@@ -140,6 +159,11 @@ async def ask():
         return jsonify({"error": "request must be json"}), 415
     request_json = await request.get_json()
     context = request_json.get("context", {})
+    try:
+        context["deadline"] = current_app.config[CONFIG_DEADLINE_SETTINGS].start(request.headers)
+        Approach.include_context(context.get("overrides", {}))
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
     auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
     context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
     try:
@@ -153,6 +177,54 @@ async def ask():
         return error_response(error, "/ask")
 
 
+@bp.route("/ask/batch", methods=["POST"])
+async def ask_batch():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    questions = request_json.get("questions")
+    if (
+        not isinstance(questions, list)
+        or not questions
+        or not all(isinstance(question, str) and question for question in questions)
+    ):
+        return jsonify({"error": "questions must be a list of questions"}), 400
+    if len(questions) > ASK_BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"A batch has at most {ASK_BATCH_MAX_QUESTIONS} questions"}), 400
+    context = request_json.get("context", {})
+    try:
+        context["deadline"] = current_app.config[CONFIG_DEADLINE_SETTINGS].start(request.headers)
+        Approach.include_context(context.get("overrides", {}))
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
+    context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    try:
+        approach = current_app.config[CONFIG_ASK_APPROACH]
+        results = await approach.run_batch(questions, context=context)
+        response = await make_response(format_as_ndjson(format_batch_results(results)))
+        response.timeout = None  # type: ignore
+        response.mimetype = "application/json-lines"
+        return response
+    except Exception as error:
+        return error_response(error, "/ask/batch")
+
+
+async def format_batch_results(
+    results: AsyncGenerator[tuple[int, Union[dict, Exception]], None]
+) -> AsyncGenerator[dict, None]:
+    # One answer or error per question, in the order they're ready
+    try:
+        async for index, result in results:
+            if isinstance(result, Exception):
+                logging.error("Exception in /ask/batch: %s", result, exc_info=result)
+                yield {"index": index, **error_dict(result)}
+            else:
+                yield {"index": index, **result}
+    finally:
+        await results.aclose()
+
+
 async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
     try:
         async for event in r:
@@ -160,6 +232,9 @@ async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str,
     except Exception as e:
         logging.exception("Exception while generating response stream: %s", e)
         yield json.dumps(error_dict(e))
+    finally:
+        # When the client disconnects, Quart closes this generator at its yield, the approach's has to be closed too
+        await r.aclose()
 
 
 @bp.route("/chat", methods=["POST"])
@@ -168,10 +243,17 @@ async def chat():
     if not request.is_json:
         return jsonify({"error": "request must be json"}), 415
     request_json = await request.get_json()
+    try:
+        # Started first, the whole request counts against its budget
+        deadline = current_app.config[CONFIG_DEADLINE_SETTINGS].start(request.headers)
+        Approach.include_context(request_json.get("context", {}).get("overrides", {}))
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
 
     await set_index_and_container(
         request_json["azureIndex"], request_json["azureContainer"])
     context = request_json.get("context", {})
+    context["deadline"] = deadline
     communicationFrameworkIndex = request_json["communicationFrameworkIndex"]
     toneIndex = request_json["toneIndex"]
     readabilityIndex = request_json["readabilityIndex"]
@@ -226,84 +308,77 @@ async def chat():
 
 @bp.route("/runScript", methods=["POST"])
 async def runScript():
-    run_prepdocs_script()
+    request_json = await request.get_json(silent=True) or {}
+    azure_index = request_json.get("azureIndex") or os.environ["AZURE_SEARCH_INDEX"]
+    azure_container = request_json.get("azureContainer") or os.environ["AZURE_STORAGE_CONTAINER"]
+    await run_prepdocs_script(azure_index, azure_container, "./data/*")
     return jsonify({"result": "ranScript"})
 
 
-@bp.route("/uploadFiles", methods=["POST"])
-async def upload_files():
-    # Get the current working directory
-    current_directory = os.getcwd()
-    print(f"Current working directory: {current_directory}")
-
-    # Set the data folder path relative to the current directory
-    DATA_FOLDER = os.path.join(current_directory, "data")
-    print(f"Data folder path: {DATA_FOLDER}")
-
-    # Ensure the data folder exists, create it if it doesn't
-    if not os.path.exists(DATA_FOLDER):
-        os.makedirs(DATA_FOLDER)
-    else:
-        # Delete all files in the data folder
-        for filename in os.listdir(DATA_FOLDER):
-            file_path = os.path.join(DATA_FOLDER, filename)
-            try:
-                os.unlink(file_path)  # Remove the file or symbolic link
-            except Exception as e:
-                print(f'Failed to delete {file_path}. Reason: {e}')
-
-    if not request.is_json:
-        return jsonify({"error": "Request must be JSON"}), 415
-
-    request_json = await request.get_json()
-
-    azure_index = request_json.get("azureIndex")
-    azure_container = request_json.get("azureContainer")
-
+async def ingest_staged_files(staging: UploadStaging, azure_index: Optional[str], azure_container: Optional[str]):
     if not azure_index or not azure_container:
         return jsonify({"error": "azureIndex and azureContainer are required"}), 400
-
-    files = request_json.get("files", [])
-
-    if not files:
+    if not staging.files:
         return jsonify({"error": "No files provided"}), 400
 
-    # Save the files to the data folder
-    for file in files:
-        file_name = file["name"]
-        # Split to remove the metadata prefix
-        file_content = file["content"].split(",")[1]
-
-        # Decode the base64 content
-        file_data = base64.b64decode(file_content)
-
-        # Construct the file path using the relative data folder
-        file_path = os.path.join(DATA_FOLDER, file_name)
-        print(f"Saving file to: {file_path}")
-
-        # Save the file to the data folder
-        with open(file_path, "wb") as f:
-            f.write(file_data)
-
-    # Handle the index and container logic here
+    # Make sure everything is flushed to disk before prepdocs reads the staging directory
+    staging.close_files()
     await set_index_and_container(azure_index, azure_container)
-    run_prepdocs_script(azure_index, azure_container)
-
-    # Delete contents of the data folder
-    for filename in os.listdir(DATA_FOLDER):
-        file_path = os.path.join(DATA_FOLDER, filename)
-        try:
-            os.unlink(file_path)  # Remove the file or symbolic link
-        except Exception as e:
-            print(f'Failed to delete {file_path}. Reason: {e}')
+    # Each upload is staged in a new directory, whose paths the manifest would never see again
+    await run_prepdocs_script(azure_index, azure_container, staging.path_pattern, use_file_manifest=False)
 
     return jsonify({
         "result": "Files uploaded and processed successfully",
         "azureIndex": azure_index,
-        "azureContainer": azure_container
+        "azureContainer": azure_container,
+        "files": [staged_file.to_dict() for staged_file in staging.files],
     })
 
 
+@bp.route("/uploadFiles", methods=["POST"])
+async def upload_files():
+    # multipart/form-data is streamed straight into a per-request staging directory with bounded memory.
+    # JSON bodies with base64 data URLs are still accepted for older clients.
+    if request.mimetype == "multipart/form-data":
+        return await upload_files_multipart()
+    if request.is_json:
+        return await upload_files_json()
+    return jsonify({"error": "Request must be multipart/form-data or JSON"}), 415
+
+
+async def upload_files_multipart():
+    try:
+        with UploadStaging() as staging:
+            parser = FormDataParser(stream_factory=staging.stream_factory, silent=False)
+            try:
+                form, _ = await parser.parse(
+                    request.body, request.mimetype, request.content_length, request.mimetype_params
+                )
+            except ValueError as error:
+                return jsonify({"error": str(error)}), 400
+            return await ingest_staged_files(staging, form.get("azureIndex"), form.get("azureContainer"))
+    except Exception as error:
+        return error_response(error, "/uploadFiles")
+
+
+async def upload_files_json():
+    request_json = await request.get_json()
+    try:
+        with UploadStaging() as staging:
+            for file in request_json.get("files", []):
+                try:
+                    staged_file = staging.open(file["name"])
+                except ValueError as error:
+                    return jsonify({"error": str(error)}), 400
+                # Split to remove the data URL metadata prefix and decode the base64 content
+                staged_file.write(base64.b64decode(file["content"].split(",")[1]))
+            return await ingest_staged_files(
+                staging, request_json.get("azureIndex"), request_json.get("azureContainer")
+            )
+    except Exception as error:
+        return error_response(error, "/uploadFiles")
+
+
 # Send MSAL.js settings to the client UI
 @bp.route("/auth_setup", methods=["GET"])
 def auth_setup():
@@ -316,13 +391,18 @@ async def setup_clients():
     # Replace these with your own values, either in environment variables or directly here
     AZURE_STORAGE_ACCOUNT = os.environ["AZURE_STORAGE_ACCOUNT"]
     AZURE_STORAGE_CONTAINER = os.environ["AZURE_STORAGE_CONTAINER"]
-    AZURE_SEARCH_SERVICE = os.environ["AZURE_SEARCH_SERVICE"]
     AZURE_SEARCH_INDEX = os.environ["AZURE_SEARCH_INDEX"]
     # Shared by all OpenAI deployments
     OPENAI_HOST = os.getenv("OPENAI_HOST", "azure")
     OPENAI_CHATGPT_MODEL = os.environ["AZURE_OPENAI_CHATGPT_MODEL"]
     OPENAI_EMB_MODEL = os.getenv(
         "AZURE_OPENAI_EMB_MODEL_NAME", "text-embedding-3-large")
+    # Shortened text-embedding-3 embeddings, the same number of dimensions prepdocs indexed
+    AZURE_OPENAI_EMB_DIMENSIONS = int(os.environ["AZURE_OPENAI_EMB_DIMENSIONS"]) if os.getenv(
+        "AZURE_OPENAI_EMB_DIMENSIONS") else None
+    # Concurrent searches and completions of a batch of questions to /ask/batch
+    APP_ASK_BATCH_SEARCH_CONCURRENCY = int(os.getenv("APP_ASK_BATCH_SEARCH_CONCURRENCY", "8"))
+    APP_ASK_BATCH_COMPLETION_CONCURRENCY = int(os.getenv("APP_ASK_BATCH_COMPLETION_CONCURRENCY", "4"))
     # Used with Azure OpenAI deployments
     AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
     AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.getenv(
@@ -365,11 +445,7 @@ async def setup_clients():
     )
 
     # Set up clients for AI Search and Storage
-    search_client = SearchClient(
-        endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-        index_name=AZURE_SEARCH_INDEX,
-        credential=azure_credential,
-    )
+    search_client = create_search_client(AZURE_SEARCH_INDEX, azure_credential)
     blob_client = BlobServiceClient(
         account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=azure_credential
     )
@@ -384,7 +460,8 @@ async def setup_clients():
             azure_credential, "https://cognitiveservices.azure.com/.default")
         # Store on app.config for later use inside requests
         openai_client = AsyncAzureOpenAI(
-            api_version="2023-07-01-preview",
+            # First GA version accepting the dimensions parameter of text-embedding-3 models
+            api_version="2024-02-01",
             azure_endpoint=f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com",
             azure_ad_token_provider=token_provider,
         )
@@ -408,10 +485,13 @@ async def setup_clients():
         chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
         embedding_model=OPENAI_EMB_MODEL,
         embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
+        embedding_dimensions=AZURE_OPENAI_EMB_DIMENSIONS,
         sourcepage_field=KB_FIELDS_SOURCEPAGE,
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        batch_search_concurrency=APP_ASK_BATCH_SEARCH_CONCURRENCY,
+        batch_completion_concurrency=APP_ASK_BATCH_COMPLETION_CONCURRENCY,
     )
 
     current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
@@ -421,6 +501,7 @@ async def setup_clients():
         chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
         embedding_model=OPENAI_EMB_MODEL,
         embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
+        embedding_dimensions=AZURE_OPENAI_EMB_DIMENSIONS,
         sourcepage_field=KB_FIELDS_SOURCEPAGE,
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
@@ -433,12 +514,17 @@ async def set_index_and_container(index, container):
     print(index)
     print(container)
     AZURE_STORAGE_ACCOUNT = os.environ["AZURE_STORAGE_ACCOUNT"]
-    AZURE_SEARCH_SERVICE = os.environ["AZURE_SEARCH_SERVICE"]
     # Shared by all OpenAI deployments
     OPENAI_HOST = os.getenv("OPENAI_HOST", "azure")
     OPENAI_CHATGPT_MODEL = os.environ["AZURE_OPENAI_CHATGPT_MODEL"]
     OPENAI_EMB_MODEL = os.getenv(
         "AZURE_OPENAI_EMB_MODEL_NAME", "text-embedding-3-large")
+    # Shortened text-embedding-3 embeddings, the same number of dimensions prepdocs indexed
+    AZURE_OPENAI_EMB_DIMENSIONS = int(os.environ["AZURE_OPENAI_EMB_DIMENSIONS"]) if os.getenv(
+        "AZURE_OPENAI_EMB_DIMENSIONS") else None
+    # Concurrent searches and completions of a batch of questions to /ask/batch
+    APP_ASK_BATCH_SEARCH_CONCURRENCY = int(os.getenv("APP_ASK_BATCH_SEARCH_CONCURRENCY", "8"))
+    APP_ASK_BATCH_COMPLETION_CONCURRENCY = int(os.getenv("APP_ASK_BATCH_COMPLETION_CONCURRENCY", "4"))
     # Used with Azure OpenAI deployments
     AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.getenv(
         "AZURE_OPENAI_CHATGPT_DEPLOYMENT") if OPENAI_HOST == "azure" else None
@@ -455,11 +541,7 @@ async def set_index_and_container(index, container):
     azure_credential = DefaultAzureCredential(
         exclude_shared_token_cache_credential=True)
 
-    search_client = SearchClient(
-        endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-        index_name=index,
-        credential=azure_credential,
-    )
+    search_client = create_search_client(index, azure_credential)
 
     blob_client = BlobServiceClient(
         account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=azure_credential
@@ -477,10 +559,13 @@ async def set_index_and_container(index, container):
         chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
         embedding_model=OPENAI_EMB_MODEL,
         embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
+        embedding_dimensions=AZURE_OPENAI_EMB_DIMENSIONS,
         sourcepage_field=KB_FIELDS_SOURCEPAGE,
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        batch_search_concurrency=APP_ASK_BATCH_SEARCH_CONCURRENCY,
+        batch_completion_concurrency=APP_ASK_BATCH_COMPLETION_CONCURRENCY,
     )
 
     current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
@@ -490,6 +575,7 @@ async def set_index_and_container(index, container):
         chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
         embedding_model=OPENAI_EMB_MODEL,
         embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
+        embedding_dimensions=AZURE_OPENAI_EMB_DIMENSIONS,
         sourcepage_field=KB_FIELDS_SOURCEPAGE,
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
@@ -499,6 +585,20 @@ async def set_index_and_container(index, container):
     return "Success"
 
 
+def create_search_client(index: str, credential: Union[AsyncTokenCredential, DefaultAzureCredential]) -> SearchClient:
+    # Indexes created by prepdocs with --localindexdirectory are searched in process instead of on the service
+    if local_index_directory := os.getenv("LOCAL_SEARCH_INDEX_DIRECTORY"):
+        from prepdocslib.localsearch import LocalSearchClient
+
+        # Same async search interface as the SDK's SearchClient
+        return cast(SearchClient, LocalSearchClient(os.path.join(local_index_directory, index)))
+    return SearchClient(
+        endpoint=f"https://{os.environ['AZURE_SEARCH_SERVICE']}.search.windows.net",
+        index_name=index,
+        credential=credential,
+    )
+
+
 def create_app():
 
     logging.info("CREATE APP 1000")
@@ -535,6 +635,19 @@ def create_app():
 
     app.logger.info("App logger")
 
+    # Optional time budget of the /ask and /chat requests, see core/deadline.py
+    app.config[CONFIG_DEADLINE_SETTINGS] = DeadlineSettings.from_env()
+
+    # Opt-in, measures the event loop lag and logs the stack of callbacks blocking the loop for longer than the threshold
+    if os.getenv("APP_LOOP_LAG_MONITOR", "").lower() == "true":
+        monitor = LoopLagMonitor(
+            threshold=float(os.getenv("APP_LOOP_LAG_THRESHOLD_MS", "100")) / 1000,
+            log_interval=float(os.getenv("APP_LOOP_LAG_LOG_INTERVAL", "60")),
+        )
+        app.config[CONFIG_LOOP_LAG_MONITOR] = monitor
+        app.before_serving(monitor.start)
+        app.after_serving(monitor.stop)
+
     if allowed_origin := os.getenv("ALLOWED_ORIGIN"):
         app.logger.info("CORS enabled for %s", allowed_origin)
         cors(app, allow_origin=allowed_origin, allow_methods=["GET", "POST"])
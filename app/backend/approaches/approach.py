@@ -1,8 +1,11 @@
 from abc import ABC
-from typing import Any, AsyncGenerator, Optional, Union
+from typing import Any, AsyncGenerator, Callable, Optional, Union
 
 from core.authentication import AuthenticationHelper
 
+# What the context of a response carries: nothing, the citations of the sources, or the sources and the prompt
+INCLUDE_CONTEXT_OPTIONS = ["none", "citations", "full"]
+
 
 class Approach(ABC):
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
@@ -15,6 +18,37 @@ class Approach(ABC):
             filters.append(security_filter)
         return None if len(filters) == 0 else " and ".join(filters)
 
+    @staticmethod
+    def search_select(sourcepage_field: str, content_field: str, use_semantic_captions: bool) -> list[str]:
+        # Only the fields the sources are built from, so hits don't carry their embeddings and ACLs. Captions are
+        # returned whatever the selected fields.
+        return [sourcepage_field] if use_semantic_captions else [sourcepage_field, content_field]
+
+    @staticmethod
+    def embedding_dimensions_options(dimensions: Optional[int]) -> dict[str, Any]:
+        # Shortens text-embedding-3 embeddings to the dimensions of the index. The installed openai version doesn't
+        # know the dimensions parameter yet, so it's sent as an extra body field
+        return {"extra_body": {"dimensions": dimensions}} if dimensions else {}
+
+    @staticmethod
+    def include_context(overrides: dict[str, Any]) -> str:
+        include_context = overrides.get("include_context") or "full"
+        if include_context not in INCLUDE_CONTEXT_OPTIONS:
+            raise ValueError(f"include_context must be one of {', '.join(INCLUDE_CONTEXT_OPTIONS)}")
+        return include_context
+
+    @staticmethod
+    def response_context(include_context: str, sources: list[tuple[str, str]], thoughts: Callable[[], str]) -> dict:
+        # The thoughts stringify the whole prompt, they're only built when the client shows them
+        if include_context == "full":
+            return {
+                "data_points": [sourcepage + ": " + text for sourcepage, text in sources],
+                "thoughts": thoughts(),
+            }
+        if include_context == "citations":
+            return {"data_points": list(dict.fromkeys(sourcepage for sourcepage, _ in sources))}
+        return {}
+
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import re
@@ -13,8 +14,10 @@ from openai.types.chat import (
 )
 
 from approaches.approach import Approach
+from core.deadline import Deadline, DeadlineExceeded
 from core.messagebuilder import MessageBuilder
 from core.modelhelper import get_token_limit
+from core.streams import StreamCancellations
 from text import nonewlines
 
 
@@ -61,6 +64,7 @@ If you cannot generate a search query, return just the number 0.
         {"role": USER, "content": "does my plan cover cardio?"},
         {"role": ASSISTANT, "content": "Health plan cardio coverage"},
     ]
+    response_token_limit = 1024
 
     def __init__(
         self,
@@ -76,6 +80,7 @@ If you cannot generate a search query, return just the number 0.
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_dimensions: Optional[int] = None,  # Only for shortened text-embedding-3 embeddings
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -83,11 +88,13 @@ If you cannot generate a search query, return just the number 0.
         self.chatgpt_deployment = chatgpt_deployment
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
+        self.embedding_dimensions = embedding_dimensions
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        self.stream_cancellations = StreamCancellations()
 
     @overload
     async def run_until_final_call(
@@ -96,6 +103,7 @@ If you cannot generate a search query, return just the number 0.
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[False],
+        deadline: Optional[Deadline] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, ChatCompletion]]:
         ...
 
@@ -106,6 +114,7 @@ If you cannot generate a search query, return just the number 0.
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[True],
+        deadline: Optional[Deadline] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]:
         ...
 
@@ -115,7 +124,9 @@ If you cannot generate a search query, return just the number 0.
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
+        deadline: Optional[Deadline] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
+        deadline = deadline or Deadline()
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in [
             "vectors", "hybrid", None]
@@ -144,38 +155,49 @@ If you cannot generate a search query, return just the number 0.
         ]
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        messages = self.get_messages_from_history(
-            system_prompt=self.query_prompt_template,
-            model_id=self.chatgpt_model,
-            history=history,
-            user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(user_query_request),
-            few_shots=self.query_prompt_few_shots,
-        )
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=messages,  # type: ignore
-            # Azure Open AI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,
-            # Setting too low risks malformed JSON, setting too high may affect performance
-            max_tokens=100,
-            n=1,
-            functions=functions,
-            function_call="auto",
-        )
+        if deadline.allows("rewrite"):
+            messages = self.get_messages_from_history(
+                system_prompt=self.query_prompt_template,
+                model_id=self.chatgpt_model,
+                history=history,
+                user_content=user_query_request,
+                max_tokens=self.chatgpt_token_limit - len(user_query_request),
+                few_shots=self.query_prompt_few_shots,
+            )
+            chat_completion: ChatCompletion = await deadline.run(
+                "rewrite",
+                self.openai_client.chat.completions.create(
+                    messages=messages,  # type: ignore
+                    # Azure Open AI takes the deployment name as the model name
+                    model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                    temperature=0.0,
+                    # Setting too low risks malformed JSON, setting too high may affect performance
+                    max_tokens=100,
+                    n=1,
+                    functions=functions,
+                    function_call="auto",
+                ),
+            )
 
-        query_text = self.get_search_query(
-            chat_completion, original_user_query)
+            query_text = self.get_search_query(
+                chat_completion, original_user_query)
+        else:
+            # Short on time, search for the last question as it was asked
+            query_text = original_user_query
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
         # If retrieval mode includes vectors, compute an embedding for the query
         vectors: list[VectorQuery] = []
         if has_vector:
-            embedding = await self.openai_client.embeddings.create(
-                # Azure Open AI takes the deployment name as the model name
-                model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-                input=query_text,
+            embedding = await deadline.run(
+                "embedding",
+                self.openai_client.embeddings.create(
+                    # Azure Open AI takes the deployment name as the model name
+                    model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
+                    input=query_text,
+                    **self.embedding_dimensions_options(self.embedding_dimensions),
+                ),
             )
             query_vector = embedding.data[0].embedding
             vectors.append(RawVectorQuery(
@@ -186,30 +208,40 @@ If you cannot generate a search query, return just the number 0.
             query_text = None
 
         # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language=self.query_language,
-                query_speller=self.query_speller,
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector_queries=vectors,
-            )
-        else:
-            r = await self.search_client.search(query_text, filter=filter, top=top, vector_queries=vectors)
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field] + ": " +
-                nonewlines(" . ".join(
-                    [c.text for c in doc["@search.captions"]]))
-                async for doc in r
-            ]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
-        content = "\n".join(results)
+        use_semantic_ranker = bool(overrides.get("semantic_ranker")) and has_text
+        if use_semantic_ranker and not deadline.allows("semantic_ranker"):
+            # Short on time, the captions come from the semantic ranker too
+            use_semantic_ranker = use_semantic_captions = False
+        select = self.search_select(self.sourcepage_field, self.content_field, use_semantic_captions)
+
+        async def search() -> list[tuple[str, str]]:
+            # The results are fetched while iterating, so they're part of the search stage
+            if use_semantic_ranker:
+                r = await self.search_client.search(
+                    query_text,
+                    filter=filter,
+                    query_type=QueryType.SEMANTIC,
+                    query_language=self.query_language,
+                    query_speller=self.query_speller,
+                    semantic_configuration_name="default",
+                    top=top,
+                    query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                    vector_queries=vectors,
+                    select=select,
+                )
+            else:
+                r = await self.search_client.search(
+                    query_text, filter=filter, top=top, vector_queries=vectors, select=select
+                )
+            if use_semantic_captions:
+                return [
+                    (doc[self.sourcepage_field], nonewlines(" . ".join([c.text for c in doc["@search.captions"]])))
+                    async for doc in r
+                ]
+            return [(doc[self.sourcepage_field], nonewlines(doc[self.content_field])) async for doc in r]
+
+        sources = await deadline.run("search", search())
+        content = "\n".join(sourcepage + ": " + text for sourcepage, text in sources)
 
         follow_up_questions_prompt = (
             self.follow_up_questions_prompt_content if overrides.get(
@@ -232,8 +264,7 @@ If you cannot generate a search query, return just the number 0.
             system_message = prompt_override.format(
                 follow_up_questions_prompt=follow_up_questions_prompt)
 
-        response_token_limit = 1024
-        messages_token_limit = self.chatgpt_token_limit - response_token_limit
+        messages_token_limit = self.chatgpt_token_limit - self.response_token_limit
         messages = self.get_messages_from_history(
             system_prompt=system_message,
             model_id=self.chatgpt_model,
@@ -242,22 +273,26 @@ If you cannot generate a search query, return just the number 0.
             user_content=original_user_query + "\n\nSources:\n" + content,
             max_tokens=messages_token_limit,
         )
-        msg_to_display = "\n\n".join([str(message) for message in messages])
-
-        extra_info = {
-            "data_points": results,
-            "thoughts": f"Searched for:<br>{query_text}<br><br>Conversations:<br>"
-            + msg_to_display.replace("\n", "<br>"),
-        }
+        extra_info = self.response_context(
+            self.include_context(overrides),
+            sources,
+            lambda: f"Searched for:<br>{query_text}<br><br>Conversations:<br>"
+            + "\n\n".join([str(message) for message in messages]).replace("\n", "<br>"),
+        )
+        if deadline.skipped:
+            extra_info["skipped_stages"] = deadline.skipped
 
-        chat_coroutine = self.openai_client.chat.completions.create(
-            # Azure Open AI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            messages=messages,
-            temperature=overrides.get("temperature") or 0.7,
-            max_tokens=response_token_limit,
-            n=1,
-            stream=should_stream,
+        chat_coroutine = deadline.run(
+            "generation",
+            self.openai_client.chat.completions.create(
+                # Azure Open AI takes the deployment name as the model name
+                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                messages=messages,
+                temperature=overrides.get("temperature") or 0.7,
+                max_tokens=self.response_token_limit,
+                n=1,
+                stream=should_stream,
+            ),
         )
         return (extra_info, chat_coroutine)
 
@@ -267,9 +302,10 @@ If you cannot generate a search query, return just the number 0.
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
+        deadline: Optional[Deadline] = None,
     ) -> dict[str, Any]:
         extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, auth_claims, should_stream=False
+            history, overrides, auth_claims, should_stream=False, deadline=deadline
         )
         chat_completion_response: ChatCompletion = await chat_coroutine
         # Convert to dict to make it JSON serializable
@@ -289,9 +325,11 @@ If you cannot generate a search query, return just the number 0.
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
+        deadline: Optional[Deadline] = None,
     ) -> AsyncGenerator[dict, None]:
+        deadline = deadline or Deadline()
         extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, auth_claims, should_stream=True
+            history, overrides, auth_claims, should_stream=True, deadline=deadline
         )
         yield {
             "choices": [
@@ -308,24 +346,41 @@ If you cannot generate a search query, return just the number 0.
 
         followup_questions_started = False
         followup_content = ""
-        async for event_chunk in await chat_coroutine:
-            # "2023-07-01-preview" API version has a bug where first response has empty choices
-            event = event_chunk.model_dump()  # Convert pydantic model to dict
-            if event["choices"]:
-                # if event contains << and not >>, it is start of follow-up question, truncate
-                content = event["choices"][0]["delta"].get("content")
-                content = content or ""  # content may either not exist in delta, or explicitly be None
-                if overrides.get("suggest_followup_questions") and "<<" in content:
-                    followup_questions_started = True
-                    earlier_content = content[: content.index("<<")]
-                    if earlier_content:
-                        event["choices"][0]["delta"]["content"] = earlier_content
+        chat_stream = await chat_coroutine
+        received_tokens = 0
+        try:
+            async for event_chunk in deadline.iterate("generation", chat_stream):
+                # "2023-07-01-preview" API version has a bug where first response has empty choices
+                event = event_chunk.model_dump()  # Convert pydantic model to dict
+                if event["choices"]:
+                    # if event contains << and not >>, it is start of follow-up question, truncate
+                    content = event["choices"][0]["delta"].get("content")
+                    content = content or ""  # content may either not exist in delta, or explicitly be None
+                    if content:
+                        received_tokens += 1
+                    if overrides.get("suggest_followup_questions") and "<<" in content:
+                        followup_questions_started = True
+                        earlier_content = content[: content.index("<<")]
+                        if earlier_content:
+                            event["choices"][0]["delta"]["content"] = earlier_content
+                            yield event
+                        followup_content += content[content.index("<<"):]
+                    elif followup_questions_started:
+                        followup_content += content
+                    else:
                         yield event
-                    followup_content += content[content.index("<<"):]
-                elif followup_questions_started:
-                    followup_content += content
-                else:
-                    yield event
+        except DeadlineExceeded:
+            # Keep the part of the answer that arrived in time and stop generating the rest
+            await self.stream_cancellations.close(chat_stream, self.response_token_limit, received_tokens)
+            yield {
+                "choices": [{"delta": {}, "finish_reason": "deadline_exceeded", "index": 0}],
+                "object": "chat.completion.chunk",
+            }
+            return
+        except (asyncio.CancelledError, GeneratorExit):
+            # The client disconnected, so Quart cancelled the request's task or closed the response generator
+            await self.stream_cancellations.close(chat_stream, self.response_token_limit, received_tokens)
+            raise
         if followup_content:
             _, followup_questions = self.extract_followup_questions(
                 followup_content)
@@ -346,10 +401,11 @@ If you cannot generate a search query, return just the number 0.
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
+        deadline = context.get("deadline")
         if stream is False:
-            return await self.run_without_streaming(messages, overrides, auth_claims, session_state)
+            return await self.run_without_streaming(messages, overrides, auth_claims, session_state, deadline)
         else:
-            return self.run_with_streaming(messages, overrides, auth_claims, session_state)
+            return self.run_with_streaming(messages, overrides, auth_claims, session_state, deadline)
 
     def get_messages_from_history(
         self,
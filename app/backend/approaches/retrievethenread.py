@@ -1,10 +1,13 @@
+import asyncio
 from typing import Any, AsyncGenerator, Optional, Union
 
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType, RawVectorQuery, VectorQuery
 from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion
 
 from approaches.approach import Approach
+from core.deadline import Deadline
 from core.messagebuilder import MessageBuilder
 from text import nonewlines
 
@@ -50,6 +53,9 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_dimensions: Optional[int] = None,  # Only for shortened text-embedding-3 embeddings
+        batch_search_concurrency: int = 8,
+        batch_completion_concurrency: int = 4,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -57,10 +63,13 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         self.embedding_model = embedding_model
         self.chatgpt_deployment = chatgpt_deployment
         self.embedding_deployment = embedding_deployment
+        self.embedding_dimensions = embedding_dimensions
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.batch_search_concurrency = batch_search_concurrency
+        self.batch_completion_concurrency = batch_completion_concurrency
 
     async def run(
         self,
@@ -71,54 +80,152 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
         q = messages[-1]["content"]
         overrides = context.get("overrides", {})
-        auth_claims = context.get("auth_claims", {})
+        deadline: Deadline = context.get("deadline") or Deadline()
+        query_vectors = await self.compute_query_vectors([q], overrides, deadline)
+        return await self.answer_question(
+            q,
+            overrides,
+            context.get("auth_claims", {}),
+            deadline,
+            session_state,
+            query_vector=query_vectors[0] if query_vectors else None,
+        )
+
+    async def run_batch(
+        self, questions: list[str], context: dict[str, Any] = {}
+    ) -> AsyncGenerator[tuple[int, Union[dict[str, Any], Exception]], None]:
+        """
+        Answers independent questions, with the embeddings of all of them computed in a single call. The searches and
+        the completions run concurrently, up to the batch concurrency limits of the approach. The answers are yielded
+        as they're ready, with the index of their question, or the exception that failed it.
+        """
+        overrides = context.get("overrides", {})
+        deadline: Deadline = context.get("deadline") or Deadline()
+        # Computed before the first answer, so an error fails the whole batch rather than each of its questions
+        query_vectors = await self.compute_query_vectors(questions, overrides, deadline)
+        return self.answer_batch(questions, query_vectors, overrides, context.get("auth_claims", {}), deadline)
+
+    async def answer_batch(
+        self,
+        questions: list[str],
+        query_vectors: list[list[float]],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        deadline: Deadline,
+    ) -> AsyncGenerator[tuple[int, Union[dict[str, Any], Exception]], None]:
+        search_semaphore = asyncio.Semaphore(self.batch_search_concurrency)
+        completion_semaphore = asyncio.Semaphore(self.batch_completion_concurrency)
+
+        async def answer(index: int) -> tuple[int, Union[dict[str, Any], Exception]]:
+            try:
+                result = await self.answer_question(
+                    questions[index],
+                    overrides,
+                    auth_claims,
+                    # Same expiry, but the stages skipped for each question are reported in its own answer
+                    Deadline(deadline.remaining(), deadline.min_remaining),
+                    query_vector=query_vectors[index] if query_vectors else None,
+                    search_semaphore=search_semaphore,
+                    completion_semaphore=completion_semaphore,
+                )
+                return index, result
+            except Exception as error:
+                return index, error
+
+        tasks = [asyncio.create_task(answer(index)) for index in range(len(questions))]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            # Stops answering when the client went away before the end of the batch
+            for task in tasks:
+                task.cancel()
+
+    async def compute_query_vectors(
+        self, queries: list[str], overrides: dict[str, Any], deadline: Deadline
+    ) -> list[list[float]]:
+        # If retrieval mode includes vectors, compute the embeddings of the queries, none otherwise
+        if overrides.get("retrieval_mode") not in ["vectors", "hybrid", None]:
+            return []
+        embedding = await deadline.run(
+            "embedding",
+            self.openai_client.embeddings.create(
+                # Azure Open AI takes the deployment name as the model name
+                model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
+                input=queries,
+                **self.embedding_dimensions_options(self.embedding_dimensions),
+            ),
+        )
+        return [data.embedding for data in sorted(embedding.data, key=lambda data: data.index)]
+
+    async def answer_question(
+        self,
+        q: str,
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        deadline: Deadline,
+        session_state: Any = None,
+        query_vector: Optional[list[float]] = None,
+        search_semaphore: Optional[asyncio.Semaphore] = None,
+        completion_semaphore: Optional[asyncio.Semaphore] = None,
+    ) -> dict[str, Any]:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
-        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
         top = overrides.get("top", 3)
         filter = self.build_filter(overrides, auth_claims)
-        # If retrieval mode includes vectors, compute an embedding for the query
+        # A single question makes one search and one completion, its own semaphores don't limit it
+        search_semaphore = search_semaphore or asyncio.Semaphore(1)
+        completion_semaphore = completion_semaphore or asyncio.Semaphore(1)
         vectors: list[VectorQuery] = []
-        if has_vector:
-            embedding = await self.openai_client.embeddings.create(
-                # Azure Open AI takes the deployment name as the model name
-                model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-                input=q,
-            )
-            query_vector = embedding.data[0].embedding
+        if query_vector is not None:
             vectors.append(RawVectorQuery(vector=query_vector, k=50, fields="embedding"))
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else ""
 
         # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language=self.query_language,
-                query_speller=self.query_speller,
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector_queries=vectors,
-            )
-        else:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                top=top,
-                vector_queries=vectors,
-            )
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                async for doc in r
-            ]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
-        content = "\n".join(results)
+        use_semantic_ranker = bool(overrides.get("semantic_ranker")) and has_text
+        if use_semantic_ranker and not deadline.allows("semantic_ranker"):
+            # Short on time, the captions come from the semantic ranker too
+            use_semantic_ranker = use_semantic_captions = False
+        select = self.search_select(self.sourcepage_field, self.content_field, use_semantic_captions)
+
+        async def search() -> list[tuple[str, str]]:
+            async with search_semaphore:
+                return await search_sources()
+
+        async def search_sources() -> list[tuple[str, str]]:
+            # The results are fetched while iterating, so they're part of the search stage
+            if use_semantic_ranker:
+                r = await self.search_client.search(
+                    query_text,
+                    filter=filter,
+                    query_type=QueryType.SEMANTIC,
+                    query_language=self.query_language,
+                    query_speller=self.query_speller,
+                    semantic_configuration_name="default",
+                    top=top,
+                    query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                    vector_queries=vectors,
+                    select=select,
+                )
+            else:
+                r = await self.search_client.search(
+                    query_text,
+                    filter=filter,
+                    top=top,
+                    vector_queries=vectors,
+                    select=select,
+                )
+            if use_semantic_captions:
+                return [
+                    (doc[self.sourcepage_field], nonewlines(" . ".join([c.text for c in doc["@search.captions"]])))
+                    async for doc in r
+                ]
+            return [(doc[self.sourcepage_field], nonewlines(doc[self.content_field])) async for doc in r]
+
+        sources = await deadline.run("search", search())
+        content = "\n".join(sourcepage + ": " + text for sourcepage, text in sources)
 
         message_builder = MessageBuilder(
             overrides.get("prompt_template") or self.system_chat_template, self.chatgpt_model
@@ -132,22 +239,27 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         message_builder.insert_message("assistant", self.answer)
         message_builder.insert_message("user", self.question)
 
-        chat_completion = (
-            await self.openai_client.chat.completions.create(
-                # Azure Open AI takes the deployment name as the model name
-                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-                messages=message_builder.messages,
-                temperature=overrides.get("temperature") or 0.3,
-                max_tokens=1024,
-                n=1,
-            )
-        ).model_dump()
-
-        extra_info = {
-            "data_points": results,
-            "thoughts": f"Question:<br>{query_text}<br><br>Prompt:<br>"
+        async def generate() -> ChatCompletion:
+            async with completion_semaphore:
+                return await self.openai_client.chat.completions.create(
+                    # Azure Open AI takes the deployment name as the model name
+                    model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                    messages=message_builder.messages,
+                    temperature=overrides.get("temperature") or 0.3,
+                    max_tokens=1024,
+                    n=1,
+                )
+
+        chat_completion = (await deadline.run("generation", generate())).model_dump()
+
+        extra_info = self.response_context(
+            self.include_context(overrides),
+            sources,
+            lambda: f"Question:<br>{query_text}<br><br>Prompt:<br>"
             + "\n\n".join([str(message) for message in message_builder.messages]),
-        }
+        )
+        if deadline.skipped:
+            extra_info["skipped_stages"] = deadline.skipped
         chat_completion["choices"][0]["context"] = extra_info
         chat_completion["choices"][0]["session_state"] = session_state
         return chat_completion
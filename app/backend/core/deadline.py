@@ -0,0 +1,99 @@
+import asyncio
+import os
+import time
+from typing import AsyncGenerator, AsyncIterable, Awaitable, Mapping, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Header with which a client sets the time budget of its request, in milliseconds
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+# Optional stages of a request, skipped when less than their minimum remaining time is left
+OPTIONAL_STAGES = ["rewrite", "semantic_ranker"]
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage: str):
+        super().__init__(f"The request deadline was exceeded during the {stage} stage")
+        self.stage = stage
+
+
+class Deadline:
+    """
+    Time budget of a request, shared by its stages (query rewrite, embedding, search and generation).
+    Each stage runs with the remaining budget as its timeout and is cancelled, with its HTTP request, once the budget
+    runs out. Optional stages are skipped when less than their minimum remaining time is left, e.g. the rewrite of the
+    query by the chat model, so that the stages that can't be skipped still fit in the budget.
+    A deadline without a budget never expires and never skips a stage.
+    """
+
+    def __init__(self, budget: Optional[float] = None, min_remaining: Optional[Mapping[str, float]] = None):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget if budget is not None else None
+        self.min_remaining = dict(min_remaining or {})
+        self.skipped: list[str] = []
+
+    def remaining(self) -> Optional[float]:
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def allows(self, stage: str) -> bool:
+        remaining = self.remaining()
+        if remaining is None or remaining >= self.min_remaining.get(stage, 0.0):
+            return True
+        self.skipped.append(stage)
+        return False
+
+    async def run(self, stage: str, awaitable: Awaitable[T]) -> T:
+        remaining = self.remaining()
+        if remaining is None:
+            return await awaitable
+        try:
+            return await asyncio.wait_for(awaitable, remaining)
+        except asyncio.TimeoutError as error:
+            raise DeadlineExceeded(stage) from error
+
+    async def iterate(self, stage: str, iterable: AsyncIterable[T]) -> AsyncGenerator[T, None]:
+        # Every item of a stream has to arrive before the deadline
+        iterator = iterable.__aiter__()
+        while True:
+            try:
+                item = await self.run(stage, iterator.__anext__())
+            except StopAsyncIteration:
+                return
+            yield item
+
+
+class DeadlineSettings:
+    """
+    Budget of the requests and minimum remaining time of the optional stages, read from the environment:
+    APP_REQUEST_DEADLINE_SECONDS, and APP_DEADLINE_MIN_REMAINING_<STAGE>_SECONDS for each optional stage.
+    Clients can ask for a shorter budget with the X-Request-Deadline-Ms header, but not for a longer one.
+    """
+
+    def __init__(self, budget: Optional[float] = None, min_remaining: Optional[Mapping[str, float]] = None):
+        self.budget = budget
+        self.min_remaining = dict(min_remaining or {})
+
+    @classmethod
+    def from_env(cls) -> "DeadlineSettings":
+        budget = os.getenv("APP_REQUEST_DEADLINE_SECONDS")
+        min_remaining = {}
+        for stage in OPTIONAL_STAGES:
+            value = os.getenv(f"APP_DEADLINE_MIN_REMAINING_{stage.upper()}_SECONDS")
+            if value:
+                min_remaining[stage] = float(value)
+        return cls(float(budget) if budget else None, min_remaining)
+
+    def start(self, headers: Mapping[str, str]) -> Deadline:
+        budget = self.budget
+        header = headers.get(DEADLINE_HEADER)
+        if header:
+            try:
+                requested = int(header) / 1000
+            except ValueError:
+                raise ValueError(f"{DEADLINE_HEADER} must be a number of milliseconds")
+            if requested <= 0:
+                raise ValueError(f"{DEADLINE_HEADER} must be a positive number of milliseconds")
+            budget = requested if budget is None else min(budget, requested)
+        return Deadline(budget, self.min_remaining)
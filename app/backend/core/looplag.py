@@ -0,0 +1,135 @@
+import asyncio
+import bisect
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional
+
+from opentelemetry import metrics
+
+# Upper bounds of the lag histogram buckets, in milliseconds
+LAG_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+class LoopLagMonitor:
+    """
+    Measures the event loop lag, how late the loop wakes up a task sleeping for interval seconds, and records it in a
+    histogram, also exported through OpenTelemetry as event_loop.lag.
+    A watchdog thread checks that the loop keeps up. When it's stuck for more than threshold seconds, the watchdog
+    captures the stack of the loop's thread, which is the stack of the callback blocking it, and logs it at most once
+    every log_interval seconds.
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.1,
+        threshold: float = 0.1,
+        log_interval: float = 60.0,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.log_interval = log_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.histogram = metrics.get_meter(__name__).create_histogram(
+            "event_loop.lag", unit="ms", description="Delay of the event loop in running a ready callback"
+        )
+        self.reset()
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.watchdog: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        self.last_logged: Optional[float] = None
+        self.unlogged = 0
+
+    def reset(self):
+        self.counts = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.samples = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.blocked = 0
+        self.last_stack: Optional[str] = None
+
+    def record(self, lag_ms: float):
+        self.counts[bisect.bisect_left(LAG_BUCKETS_MS, lag_ms)] += 1
+        self.samples += 1
+        self.total_ms += lag_ms
+        self.max_ms = max(self.max_ms, lag_ms)
+        self.histogram.record(lag_ms)
+
+    async def run(self):
+        while True:
+            start = time.monotonic()
+            self.heartbeat = start
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, time.monotonic() - start - self.interval) * 1000)
+
+    def watch(self):
+        # Runs in its own thread, so it keeps running while the loop is blocked
+        captured_heartbeat = None
+        while not self.stopped.wait(self.threshold / 2):
+            heartbeat = self.heartbeat
+            if heartbeat != captured_heartbeat and time.monotonic() - heartbeat - self.interval > self.threshold:
+                # Only one capture per stall, the heartbeat changes once the loop is running again
+                captured_heartbeat = heartbeat
+                self.capture()
+
+    def capture(self):
+        frame = sys._current_frames().get(self.loop_thread_id) if self.loop_thread_id is not None else None
+        if frame is None:
+            return
+        self.blocked += 1
+        self.last_stack = "".join(traceback.format_stack(frame))
+        now = time.monotonic()
+        if self.last_logged is not None and now - self.last_logged < self.log_interval:
+            self.unlogged += 1
+            return
+        self.logger.warning(
+            "Event loop blocked for more than %d ms (%d more times since the last report), in:\n%s",
+            self.threshold * 1000,
+            self.unlogged,
+            self.last_stack,
+        )
+        self.last_logged = now
+        self.unlogged = 0
+
+    async def start(self):
+        # Called from the event loop to monitor
+        self.loop_thread_id = threading.get_ident()
+        self.stopped.clear()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.create_task(self.run())
+        self.watchdog = threading.Thread(target=self.watch, name="loop-lag-watchdog", daemon=True)
+        self.watchdog.start()
+
+    async def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def percentile_ms(self, fraction: float) -> Optional[float]:
+        # Upper bound of the bucket holding the percentile, the largest lag seen for the last bucket
+        if not self.samples:
+            return None
+        rank = fraction * self.samples
+        count = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            count += bucket_count
+            if count >= rank and bucket_count:
+                return float(LAG_BUCKETS_MS[bucket]) if bucket < len(LAG_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def stats(self) -> Dict[str, Any]:
+        buckets: List[str] = [f"<={bound}ms" for bound in LAG_BUCKETS_MS] + [f">{LAG_BUCKETS_MS[-1]}ms"]
+        return {
+            "samples": self.samples,
+            "mean_ms": round(self.total_ms / self.samples, 2) if self.samples else None,
+            "p99_ms": self.percentile_ms(0.99),
+            "max_ms": round(self.max_ms, 2),
+            "histogram": dict(zip(buckets, self.counts)),
+            "blocked": self.blocked,
+        }
@@ -0,0 +1,34 @@
+from openai import AsyncStream
+from opentelemetry import metrics
+
+
+class StreamCancellations:
+    """
+    Closes the chat completion streams that are left unread, because the client disconnected or the request deadline
+    passed, so that the model stops generating an answer nobody reads and the connection goes back to the pool.
+    The closed streams are counted, also exported through OpenTelemetry as openai.streams.cancelled, along with the
+    completion tokens they saved, as openai.streams.tokens_saved. The model stops at max_tokens at the latest and each
+    chunk carries about one token, so the tokens saved are estimated as max_tokens minus the chunks received, an upper
+    bound for answers that would have ended earlier.
+    """
+
+    def __init__(self):
+        meter = metrics.get_meter(__name__)
+        self.cancelled_counter = meter.create_counter(
+            "openai.streams.cancelled", description="Chat completion streams closed before the end of the answer"
+        )
+        self.tokens_saved_counter = meter.create_counter(
+            "openai.streams.tokens_saved",
+            unit="{token}",
+            description="Estimated completion tokens not generated thanks to closed streams",
+        )
+        self.cancelled = 0
+        self.tokens_saved = 0
+
+    async def close(self, stream: AsyncStream, max_tokens: int, received_tokens: int):
+        await stream.response.aclose()
+        tokens_saved = max(0, max_tokens - received_tokens)
+        self.cancelled += 1
+        self.tokens_saved += tokens_saved
+        self.cancelled_counter.add(1)
+        self.tokens_saved_counter.add(tokens_saved)
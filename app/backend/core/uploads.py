@@ -0,0 +1,101 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from typing import IO, Any, Optional, cast
+
+
+class StagedFile(io.RawIOBase):
+    """
+    A file received by /uploadFiles that is written straight to disk, computing its size and sha256 while it streams
+    """
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._file = open(path, "wb")
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # Quart rewinds every file part once it has been fully received
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def write(self, data: Any) -> int:
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        super().close()
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"name": self.name, "size": self.size, "sha256": self.sha256}
+
+
+class UploadStaging:
+    """
+    Per-request staging directory for uploaded files. Every upload gets its own directory so that concurrent
+    uploads never see (or delete) each other's files, and the directory is removed once ingestion has finished.
+    """
+
+    def __init__(self, root: Optional[str] = None):
+        self.directory = tempfile.mkdtemp(prefix="upload-", dir=root)
+        self.files: list[StagedFile] = []
+
+    def __enter__(self) -> "UploadStaging":
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+
+    @property
+    def path_pattern(self) -> str:
+        # Pattern understood by prepdocs.py's LocalListFileStrategy
+        return os.path.join(self.directory, "*")
+
+    def open(self, filename: Optional[str]) -> StagedFile:
+        # Browsers may send a full client-side path, only the base name is kept
+        name = os.path.basename((filename or "").replace("\\", "/"))
+        if name in ("", ".", ".."):
+            raise ValueError(f"Invalid file name '{filename}'")
+        # Files are staged under their base name, a second file with the same name would overwrite the first
+        if any(staged_file.name == name for staged_file in self.files):
+            raise ValueError(f"Duplicate file name '{name}'")
+        staged_file = StagedFile(name, os.path.join(self.directory, name))
+        self.files.append(staged_file)
+        return staged_file
+
+    def stream_factory(
+        self,
+        total_content_length: Optional[int],
+        content_type: Optional[str],
+        filename: Optional[str],
+        content_length: Optional[int] = None,
+    ) -> IO[bytes]:
+        # Used by Quart's FormDataParser so multipart file parts are written to the staging directory as they arrive
+        return cast(IO[bytes], self.open(filename))
+
+    def close_files(self):
+        for staged_file in self.files:
+            staged_file.close()
+
+    def cleanup(self):
+        self.close_files()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -2,6 +2,14 @@
 
 . ./scripts/loadenv.sh "$1" "$2"
 
+# Optional third argument: pattern of the files to ingest (defaults to the shared data folder)
+files="${3:-./data/*}"
+
+# Optional fourth argument: "none" to ingest without the file manifest, for files that are only ingested once
+if [ "$4" = "none" ]; then
+  fileManifestArg="--filemanifest="
+fi
+
 echo 'Running "prepdocs.py"'
 
 if [ -n "$AZURE_ADLS_GEN2_STORAGE_ACCOUNT" ]; then
@@ -21,8 +29,21 @@ if [ -n "$AZURE_SEARCH_ANALYZER_NAME" ]; then
   searchAnalyzerNameArg="--searchanalyzername $AZURE_SEARCH_ANALYZER_NAME"
 fi
 
+if [ -n "$LOCAL_SEARCH_INDEX_DIRECTORY" ]; then
+  localIndexDirectoryArg="--localindexdirectory $LOCAL_SEARCH_INDEX_DIRECTORY"
+fi
+
+if [ -n "$LOCAL_SEARCH_VECTOR_COMPRESSION" ]; then
+  localVectorCompressionArg="--localvectorcompression $LOCAL_SEARCH_VECTOR_COMPRESSION"
+fi
+
+if [ -n "$AZURE_OPENAI_EMB_DIMENSIONS" ]; then
+  openAiDimensionsArg="--openaidimensions $AZURE_OPENAI_EMB_DIMENSIONS"
+fi
+
 ./antenv/bin/python ./scripts/prepdocs.py \
-'./data/*' $adlsGen2StorageAccountArg $adlsGen2FilesystemArg $adlsGen2FilesystemPathArg $searchAnalyzerNameArg \
+"$files" $adlsGen2StorageAccountArg $adlsGen2FilesystemArg $adlsGen2FilesystemPathArg $searchAnalyzerNameArg $localIndexDirectoryArg \
+$localVectorCompressionArg $openAiDimensionsArg $fileManifestArg \
 $aclArg  --storageaccount "$AZURE_STORAGE_ACCOUNT" \
 --container "$AZURE_STORAGE_CONTAINER" --searchservice "$AZURE_SEARCH_SERVICE" \
 --openaiservice "$AZURE_OPENAI_SERVICE" --openaideployment "$AZURE_OPENAI_EMB_DEPLOYMENT" \
@@ -0,0 +1,106 @@
+import hashlib
+import os
+import sqlite3
+import time
+from array import array
+from typing import Any, Dict, List, Optional, Sequence
+
+# SQLite limits the number of parameters in a single statement, so lookups are chunked
+MAX_LOOKUP_SIZE = 500
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings stored in a single local SQLite file, so that re-running prepdocs over text that
+    was already embedded (full reindexes, index schema changes, runs that crashed halfway) doesn't call the API again.
+    Entries are keyed by (model, dimensions, sha256 of the text) and vectors are stored as packed float32.
+    """
+
+    def __init__(self, path: str, verbose: bool = False):
+        self.path = path
+        self.verbose = verbose
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                dimensions INTEGER NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, dimensions, text_hash)
+            )
+            """)
+        self.connection.commit()
+
+    @classmethod
+    def text_hash(cls, text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, dimensions: int, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        hashes = [self.text_hash(text) for text in texts]
+        found: Dict[str, List[float]] = {}
+        unique_hashes = list(dict.fromkeys(hashes))
+        for i in range(0, len(unique_hashes), MAX_LOOKUP_SIZE):
+            chunk = unique_hashes[i : i + MAX_LOOKUP_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND dimensions = ? AND text_hash IN ({placeholders})",
+                [model, dimensions, *chunk],
+            )
+            for text_hash, vector in rows:
+                found[text_hash] = array("f", vector).tolist()
+        if found:
+            self.connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND dimensions = ? AND text_hash = ?",
+                [(time.time(), model, dimensions, text_hash) for text_hash in found],
+            )
+            self.connection.commit()
+        return [found.get(text_hash) for text_hash in hashes]
+
+    def put_many(self, model: str, dimensions: int, texts: Sequence[str], embeddings: Sequence[List[float]]):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, dimensions, text_hash, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+            [
+                (model, dimensions, self.text_hash(text), array("f", embedding).tobytes(), now)
+                for text, embedding in zip(texts, embeddings)
+            ],
+        )
+        self.connection.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        models = [
+            {"model": model, "dimensions": dimensions, "entries": entries, "vector_bytes": vector_bytes}
+            for model, dimensions, entries, vector_bytes in self.connection.execute(
+                "SELECT model, dimensions, COUNT(*), SUM(LENGTH(vector)) FROM embeddings GROUP BY model, dimensions"
+            )
+        ]
+        return {
+            "path": self.path,
+            "file_bytes": os.path.getsize(self.path),
+            "entries": sum(model["entries"] for model in models),
+            "models": models,
+        }
+
+    def prune(self, older_than_days: Optional[float] = None, model: Optional[str] = None) -> int:
+        conditions = []
+        parameters: List[Any] = []
+        if older_than_days is not None:
+            conditions.append("last_used < ?")
+            parameters.append(time.time() - older_than_days * 24 * 60 * 60)
+        if model is not None:
+            conditions.append("model = ?")
+            parameters.append(model)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        removed = self.connection.execute(f"DELETE FROM embeddings{where}", parameters).rowcount
+        self.connection.commit()
+        # Give the freed pages back to the file system
+        self.connection.execute("VACUUM")
+        if self.verbose:
+            print(f"Pruned {removed} embeddings from {self.path}")
+        return removed
+
+    def close(self):
+        self.connection.close()
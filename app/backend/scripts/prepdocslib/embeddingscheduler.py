@@ -0,0 +1,220 @@
+import asyncio
+import email.utils
+import time
+from typing import Any, Awaitable, Callable, List, Mapping, Optional, Tuple
+
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+# The clients are created without the SDK's own retries, so throttling and transient server or network errors are
+# retried here instead
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+
+class EmbeddingBatch:
+    """
+    Represents a batch of text that is going to be embedded
+    """
+
+    def __init__(self, texts: List[str], token_length: int):
+        self.texts = texts
+        self.token_length = token_length
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """
+    Reads how long the service asked us to wait from the retry-after-ms or retry-after headers of a throttled response
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if retry_after_ms := headers.get("retry-after-ms"):
+            return float(retry_after_ms) / 1000
+        if retry_after := headers.get("retry-after"):
+            try:
+                return float(retry_after)
+            except ValueError:
+                # retry-after may also be an HTTP date
+                retry_date = email.utils.parsedate_to_datetime(retry_after)
+                return max(0.0, retry_date.timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+class TokenBucket:
+    """
+    Client-side view of the per-minute token and request quota, synchronized from the x-ratelimit-* response headers.
+    Azure OpenAI only reports the remaining quota, so the limit is estimated as the largest remaining value seen.
+    """
+
+    def __init__(self):
+        self.remaining_tokens: Optional[float] = None
+        self.remaining_requests: Optional[float] = None
+        self.token_limit: Optional[float] = None
+        self.request_limit: Optional[float] = None
+        self.updated = time.monotonic()
+
+    @staticmethod
+    def _header(headers: Mapping[str, str], name: str) -> Optional[float]:
+        try:
+            value = headers.get(name)
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+    def update(self, headers: Mapping[str, str]):
+        self.refill()
+        if (remaining_tokens := self._header(headers, "x-ratelimit-remaining-tokens")) is not None:
+            self.remaining_tokens = remaining_tokens
+            self.token_limit = max(
+                self._header(headers, "x-ratelimit-limit-tokens") or 0, self.token_limit or 0, remaining_tokens
+            )
+        if (remaining_requests := self._header(headers, "x-ratelimit-remaining-requests")) is not None:
+            self.remaining_requests = remaining_requests
+            self.request_limit = max(
+                self._header(headers, "x-ratelimit-limit-requests") or 0, self.request_limit or 0, remaining_requests
+            )
+
+    def refill(self):
+        # Quotas are per minute and replenish continuously
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        if self.remaining_tokens is not None and self.token_limit:
+            self.remaining_tokens = min(self.token_limit, self.remaining_tokens + self.token_limit * elapsed / 60)
+        if self.remaining_requests is not None and self.request_limit:
+            self.remaining_requests = min(
+                self.request_limit, self.remaining_requests + self.request_limit * elapsed / 60
+            )
+
+    def delay(self, tokens: int) -> float:
+        # Seconds until there is enough quota left for a request of this many tokens (0 when unknown)
+        self.refill()
+        delay = 0.0
+        if self.remaining_tokens is not None and self.token_limit:
+            deficit = min(tokens, self.token_limit) - self.remaining_tokens
+            delay = max(delay, deficit * 60 / self.token_limit)
+        if self.remaining_requests is not None and self.request_limit:
+            deficit = min(1, self.request_limit) - self.remaining_requests
+            delay = max(delay, deficit * 60 / self.request_limit)
+        return delay
+
+    def consume(self, tokens: int):
+        if self.remaining_tokens is not None:
+            self.remaining_tokens -= tokens
+        if self.remaining_requests is not None:
+            self.remaining_requests -= 1
+
+
+class EmbeddingBatchScheduler:
+    """
+    Keeps several embedding batches in flight at once, up to a concurrency limit that adapts to throttling (AIMD):
+    it grows by one for every window of successful batches and halves whenever the service answers with a 429.
+    Dispatch is paced by a token bucket fed from the rate limit headers, and a retry-after from the service pauses
+    every batch for exactly that long. Results are returned in the same order as the batches.
+    """
+
+    def __init__(self, max_concurrency: int = 4, verbose: bool = False):
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = float(self.max_concurrency)
+        self.verbose = verbose
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.bucket = TokenBucket()
+        self.fallback_wait = wait_random_exponential(min=15, max=60)
+        self._condition: Optional[asyncio.Condition] = None
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        # Created lazily so that it's bound to the running event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self, tokens: int):
+        async with self.condition:
+            while True:
+                wait = max(self.paused_until - time.monotonic(), self.bucket.delay(tokens))
+                if wait <= 0 and self.in_flight < int(self.concurrency):
+                    break
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout=wait if wait > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+            self.in_flight += 1
+            self.bucket.consume(tokens)
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self, headers: Mapping[str, str]):
+        self.bucket.update(headers)
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+    def on_rate_limited(self, retry_after: Optional[float]):
+        self.concurrency = max(1.0, self.concurrency / 2)
+        if retry_after is not None:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        if self.verbose:
+            print(f"Throttled, reducing embedding concurrency to {int(self.concurrency)}")
+
+    def retry_wait(self, retry_state) -> float:
+        # Honor the retry-after the service sent exactly, otherwise back off exponentially
+        exception = retry_state.outcome.exception() if retry_state.outcome else None
+        retry_after = retry_after_seconds(exception) if exception else None
+        if retry_after is not None:
+            return retry_after
+        return self.fallback_wait(retry_state)
+
+    async def run_batch(
+        self,
+        batch: EmbeddingBatch,
+        embed: Callable[[EmbeddingBatch], Awaitable[Tuple[List[List[float]], Mapping[str, str]]]],
+        before_sleep: Optional[Callable[[Any], Any]] = None,
+    ) -> List[List[float]]:
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception_type(RETRYABLE_ERRORS),
+            wait=self.retry_wait,
+            stop=stop_after_attempt(15),
+            before_sleep=before_sleep,
+        ):
+            with attempt:
+                await self.acquire(batch.token_length)
+                try:
+                    embeddings, headers = await embed(batch)
+                except RateLimitError as error:
+                    self.on_rate_limited(retry_after_seconds(error))
+                    raise
+                finally:
+                    await self.release()
+                self.on_success(headers)
+        return embeddings
+
+    async def run(
+        self,
+        batches: List[EmbeddingBatch],
+        embed: Callable[[EmbeddingBatch], Awaitable[Tuple[List[List[float]], Mapping[str, str]]]],
+        before_sleep: Optional[Callable[[Any], Any]] = None,
+    ) -> List[List[float]]:
+        tasks = [asyncio.ensure_future(self.run_batch(batch, embed, before_sleep)) for batch in batches]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # Don't leave the other batches running once one of them has failed for good
+            for task in tasks:
+                task.cancel()
+            raise
+        return [embedding for batch_embeddings in results for embedding in batch_embeddings]
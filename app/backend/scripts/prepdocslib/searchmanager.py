@@ -1,7 +1,9 @@
 import asyncio
+import hashlib
 import os
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Set, Tuple
 
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import (
     HnswParameters,
     HnswVectorSearchAlgorithmConfiguration,
@@ -22,9 +24,19 @@ from azure.search.documents.indexes.models import (
 from .blobmanager import BlobManager
 from .embeddings import OpenAIEmbeddings
 from .listfilestrategy import File
+from .searchuploader import SearchDocumentUploader
 from .strategy import SearchInfo
 from .textsplitter import SplitPage
 
+# Upper bound on the number of sections a single file can have in the index
+MAX_SECTIONS_PER_FILE = 100000
+# Number of documents sent to the search service in a single request
+MAX_BATCH_SIZE = 1000
+# Number of files whose sections are looked up with a single search query when removing content
+MAX_FILES_PER_QUERY = 100
+# Dimensions of the embedding field when the embeddings don't ask for shorter text-embedding-3 embeddings
+DEFAULT_EMBEDDING_DIMENSIONS = 3072
+
 
 class Section:
     """
@@ -37,6 +49,25 @@ class Section:
         self.category = category
 
 
+class ContentUpdate:
+    """
+    Changes to apply to the search index for a set of sections: documents to embed and upload, documents that are
+    already indexed with the same text, and ids of documents that are no longer part of the files
+    """
+
+    def __init__(
+        self,
+        new_documents: List[Dict[str, Any]],
+        kept_documents: List[Dict[str, Any]],
+        removed_ids: List[str],
+        token_counts: Dict[str, Optional[int]],
+    ):
+        self.new_documents = new_documents
+        self.kept_documents = kept_documents
+        self.removed_ids = removed_ids
+        self.token_counts = token_counts
+
+
 class SearchManager:
     """
     Class to manage a search service. It can create indexes, and update or remove sections stored in these indexes
@@ -49,11 +80,13 @@ class SearchManager:
         search_analyzer_name: Optional[str] = None,
         use_acls: bool = False,
         embeddings: Optional[OpenAIEmbeddings] = None,
+        uploader: Optional[SearchDocumentUploader] = None,
     ):
         self.search_info = search_info
         self.search_analyzer_name = search_analyzer_name
         self.use_acls = use_acls
         self.embeddings = embeddings
+        self.uploader = uploader or SearchDocumentUploader(verbose=search_info.verbose)
 
     async def create_index(self):
         if self.search_info.verbose:
@@ -61,6 +94,9 @@ class SearchManager:
                 f"Ensuring search index {self.search_info.index_name} exists")
 
         async with self.search_info.create_search_index_client() as search_index_client:
+            embedding_dimensions = DEFAULT_EMBEDDING_DIMENSIONS
+            if self.embeddings and self.embeddings.dimensions:
+                embedding_dimensions = self.embeddings.dimensions
             fields = [
                 SimpleField(name="id", type="Edm.String", key=True),
                 SearchableField(name="content", type="Edm.String",
@@ -69,12 +105,13 @@ class SearchManager:
                     name="embedding",
                     type=SearchFieldDataType.Collection(
                         SearchFieldDataType.Single),
-                    hidden=False,
+                    # Only searched, never returned, so embeddings aren't sent back with every search result
+                    hidden=True,
                     searchable=True,
                     filterable=False,
                     sortable=False,
                     facetable=False,
-                    vector_search_dimensions=3072,
+                    vector_search_dimensions=embedding_dimensions,
                     vector_search_profile="embedding_config",
                 ),
                 SimpleField(name="category", type="Edm.String",
@@ -135,49 +172,149 @@ class SearchManager:
                     print(
                         f"Search index {self.search_info.index_name} already exists")
 
-    async def update_content(self, sections: List[Section]):
-        MAX_BATCH_SIZE = 1000
-        section_batches = [sections[i: i + MAX_BATCH_SIZE]
-                           for i in range(0, len(sections), MAX_BATCH_SIZE)]
+    @classmethod
+    def section_ids(cls, sections: List[Section], embedding_key: str = "") -> List[str]:
+        # Content-addressed ids: the file id followed by a hash of the section text. Unchanged chunks keep their id
+        # across re-ingestion, so only new chunks have to be embedded and uploaded. Identical chunks within a file
+        # are told apart by how many times that text occurred before them. The embedding key is part of the hash,
+        # so sections embedded by another model or with other dimensions are replaced rather than kept.
+        occurrences: Dict[Tuple[str, str], int] = {}
+        ids = []
+        for section in sections:
+            file_id = section.content.filename_to_id()
+            text = section.split_page.text
+            occurrence = occurrences.get((file_id, text), 0)
+            occurrences[(file_id, text)] = occurrence + 1
+            text_hash = hashlib.sha256(f"{embedding_key}{occurrence}:{text}".encode()).hexdigest()
+            ids.append(f"{file_id}-{text_hash}")
+        return ids
 
-        async with self.search_info.create_search_client() as search_client:
-            for batch_index, batch in enumerate(section_batches):
-                documents = [
-                    {
-                        "id": f"{section.content.filename_to_id()}-page-{section_index + batch_index * MAX_BATCH_SIZE}",
-                        "content": section.split_page.text,
-                        "category": section.category,
-                        "sourcepage": BlobManager.sourcepage_from_file_page(
-                            filename=section.content.filename(), page=section.split_page.page_num
-                        ),
-                        "sourcefile": section.content.filename(),
-                        **section.content.acls,
-                    }
-                    for section_index, section in enumerate(batch)
-                ]
-                if self.embeddings:
-                    embeddings = await self.embeddings.create_embeddings(
-                        texts=[section.split_page.text for section in batch]
-                    )
-                    for i, document in enumerate(documents):
-                        document["embedding"] = embeddings[i]
+    def embedding_key(self) -> str:
+        if not self.embeddings:
+            return ""
+        # Dimensions 0 means the model's native number of dimensions, like in the embedding cache
+        return f"{self.embeddings.open_ai_model_name}:{self.embeddings.dimensions or 0}:"
 
-                await search_client.upload_documents(documents)
+    @classmethod
+    def sourcefile_filter(cls, filenames: List[str]) -> str:
+        return " or ".join("sourcefile eq '{}'".format(filename.replace("'", "''")) for filename in filenames)
 
-    async def remove_content(self, path: Optional[str] = None):
+    async def get_ids(self, search_client: SearchClient, filter: Optional[str]) -> List[str]:
+        # Only the ids are returned, not the content and embeddings of the sections.
+        # Results above 1000 are paged by the service, the SDK follows the continuation for us
+        result = await search_client.search("", filter=filter, select=["id"], top=MAX_SECTIONS_PER_FILE)
+        return [document["id"] async for document in result]
+
+    async def get_section_ids(self, search_client: SearchClient, filename: str) -> Set[str]:
+        # Manifest of the section ids the index currently holds for a file
+        return set(await self.get_ids(search_client, self.sourcefile_filter([filename])))
+
+    async def prepare_update(self, search_client: SearchClient, sections: List[Section]) -> ContentUpdate:
+        section_ids = self.section_ids(sections, self.embedding_key())
+        existing_ids: Set[str] = set()
+        for filename in {section.content.filename() for section in sections}:
+            existing_ids.update(await self.get_section_ids(search_client, filename))
+
+        documents = [
+            {
+                "id": section_id,
+                "content": section.split_page.text,
+                "category": section.category,
+                "sourcepage": BlobManager.sourcepage_from_file_page(
+                    filename=section.content.filename(), page=section.split_page.page_num
+                ),
+                "sourcefile": section.content.filename(),
+                **section.content.acls,
+            }
+            for section_id, section in zip(section_ids, sections)
+        ]
+        token_counts = {section_id: section.split_page.token_count for section_id, section in zip(section_ids, sections)}
+        update = ContentUpdate(
+            new_documents=[document for document in documents if document["id"] not in existing_ids],
+            kept_documents=[document for document in documents if document["id"] in existing_ids],
+            removed_ids=sorted(existing_ids.difference(section_ids)),
+            token_counts=token_counts,
+        )
         if self.search_info.verbose:
             print(
-                f"Removing sections from '{path or '<all>'}' from search index '{self.search_info.index_name}'")
+                f"\tUploading {len(update.new_documents)} new sections, keeping {len(update.kept_documents)}, removing {len(update.removed_ids)}"
+            )
+        return update
+
+    async def embed_update(self, update: ContentUpdate):
+        if not self.embeddings:
+            return
+        for i in range(0, len(update.new_documents), MAX_BATCH_SIZE):
+            batch = update.new_documents[i : i + MAX_BATCH_SIZE]
+            embeddings = await self.embeddings.create_embeddings(
+                texts=[document["content"] for document in batch],
+                token_counts=[update.token_counts[document["id"]] for document in batch],
+            )
+            for j, document in enumerate(batch):
+                document["embedding"] = embeddings[j]
+
+    async def apply_update(self, search_client: SearchClient, update: ContentUpdate):
+        # The three sets of ids don't overlap, so they can be sent at the same time
+        await asyncio.gather(
+            self.uploader.send(search_client, "upload", update.new_documents),
+            # Sections that didn't change keep their content and embedding, only refresh the fields that can move
+            # without the text changing, e.g. the page number after pages were inserted earlier in the file
+            self.uploader.send(
+                search_client,
+                "merge",
+                [
+                    {key: value for key, value in document.items() if key != "content"}
+                    for document in update.kept_documents
+                ],
+            ),
+            self.uploader.send(search_client, "delete", [{"id": id} for id in update.removed_ids]),
+        )
+
+    async def update_content(self, sections: List[Section]):
         async with self.search_info.create_search_client() as search_client:
-            while True:
-                filter = None if path is None else f"sourcefile eq '{os.path.basename(path)}'"
-                result = await search_client.search("", filter=filter, top=1000, include_total_count=True)
-                if await result.get_count() == 0:
-                    break
-                removed_docs = await search_client.delete_documents(
-                    documents=[{"id": document["id"]} async for document in result]
-                )
-                if self.search_info.verbose:
-                    print(f"\tRemoved {len(removed_docs)} sections from index")
-                # It can take a few seconds for search results to reflect changes, so wait a bit
-                await asyncio.sleep(2)
+            update = await self.prepare_update(search_client, sections)
+            await self.embed_update(update)
+            await self.apply_update(search_client, update)
+
+    async def remove_content(self, path: Optional[str] = None):
+        await self.remove_contents(None if path is None else [path])
+
+    async def remove_contents(self, paths: Optional[List[str]] = None):
+        # Removes the sections of all the given files, or of every file when paths is None
+        if self.search_info.verbose:
+            target = "<all>" if paths is None else f"{len(paths)} file(s)"
+            print(f"Removing sections from {target} from search index '{self.search_info.index_name}'")
+        if paths is None:
+            filters: List[Optional[str]] = [None]
+        else:
+            filenames = sorted({os.path.basename(path) for path in paths})
+            filters = [
+                self.sourcefile_filter(filenames[i : i + MAX_FILES_PER_QUERY])
+                for i in range(0, len(filenames), MAX_FILES_PER_QUERY)
+            ]
+        semaphore = asyncio.Semaphore(self.uploader.max_concurrency)
+
+        async def remove_matching(filter: Optional[str]) -> int:
+            async with semaphore:
+                return await self.remove_matching(search_client, filter)
+
+        async with self.search_info.create_search_client() as search_client:
+            removed = await asyncio.gather(*map(remove_matching, filters))
+        if self.search_info.verbose:
+            print(f"\tRemoved {sum(removed)} sections from index")
+
+    async def remove_matching(self, search_client: SearchClient, filter: Optional[str]) -> int:
+        removed: Set[str] = set()
+        delay = 0.5
+        while True:
+            found = await self.get_ids(search_client, filter)
+            ids = [id for id in found if id not in removed]
+            await self.uploader.send(search_client, "delete", [{"id": id} for id in ids])
+            removed.update(ids)
+            # A single search returns at most MAX_SECTIONS_PER_FILE ids, search again only when it came back full
+            if len(found) < MAX_SECTIONS_PER_FILE:
+                return len(removed)
+            if not ids:
+                # The index still lists sections that were just deleted, give it time to catch up
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 10)
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
+
+# Per-document status codes the service returns for transient failures, see
+# https://learn.microsoft.com/rest/api/searchservice/addupdate-or-delete-documents#response
+RETRYABLE_DOCUMENT_STATUS_CODES = {409, 422, 503}
+# Status codes of a whole request worth retrying
+RETRYABLE_REQUEST_STATUS_CODES = {429, 503}
+# Past tense of the actions, to report what was sent
+ACTIONS_DONE = {"upload": "Uploaded", "merge": "Merged", "delete": "Deleted"}
+
+
+class SearchDocumentUploader:
+    """
+    Sends documents to a search index in batches sized by their serialized size, so that large vectors don't go over
+    the service's request size limit, with several batches in flight at once.
+    Documents the service reports as failed with a transient status (e.g. 503 inside a 207 response) are retried on
+    their own with exponential backoff, and the documents that still fail are reported in a single error.
+    """
+
+    def __init__(
+        self,
+        max_batch_bytes: int = 12 * 1024 * 1024,
+        max_batch_size: int = 1000,
+        max_concurrency: int = 4,
+        max_retries: int = 5,
+        retry_delay: float = 1.0,
+        verbose: bool = False,
+    ):
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.verbose = verbose
+        self.documents_sent = 0
+        self.seconds = 0.0
+
+    @classmethod
+    def document_size(cls, document: Dict[str, Any]) -> int:
+        # Size of the document in the JSON body of the request, plus the "@search.action" the SDK adds
+        return len(json.dumps(document, separators=(",", ":"), default=str)) + 32
+
+    def split_batches(self, documents: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        batches: List[List[Dict[str, Any]]] = []
+        batch: List[Dict[str, Any]] = []
+        batch_bytes = 0
+        for document in documents:
+            size = self.document_size(document)
+            if batch and (batch_bytes + size > self.max_batch_bytes or len(batch) == self.max_batch_size):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(document)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def backoff(self, attempt: int) -> float:
+        return self.retry_delay * (2**attempt) * (0.5 + random.random() / 2)
+
+    async def send_batch(self, search_client: SearchClient, action: str, batch: List[Dict[str, Any]]) -> List[str]:
+        # Returns the keys of the documents that couldn't be indexed
+        send = getattr(search_client, f"{action}_documents")
+        pending = batch
+        failed: Dict[str, str] = {}
+        for attempt in range(self.max_retries + 1):
+            try:
+                results = await send(pending) or []
+            except HttpResponseError as error:
+                if error.status_code not in RETRYABLE_REQUEST_STATUS_CODES or attempt == self.max_retries:
+                    raise
+                if self.verbose:
+                    print(f"\tSearch service responded with {error.status_code}, retrying {len(pending)} documents")
+                await asyncio.sleep(self.backoff(attempt))
+                continue
+
+            retry_keys = set()
+            for result in results:
+                if result.succeeded:
+                    continue
+                if result.status_code in RETRYABLE_DOCUMENT_STATUS_CODES:
+                    retry_keys.add(result.key)
+                else:
+                    failed[result.key] = f"{result.status_code} {result.error_message}"
+            if not retry_keys:
+                return list(failed)
+            pending = [document for document in pending if document["id"] in retry_keys]
+            if attempt == self.max_retries:
+                failed.update({document["id"]: "retries exhausted" for document in pending})
+                break
+            if self.verbose:
+                print(f"\tRetrying {len(pending)} of {len(batch)} documents the search service couldn't index yet")
+            await asyncio.sleep(self.backoff(attempt))
+
+        if self.verbose:
+            for key, reason in failed.items():
+                print(f"\tDocument {key} couldn't be indexed: {reason}")
+        return list(failed)
+
+    async def send(self, search_client: SearchClient, action: str, documents: List[Dict[str, Any]]):
+        # action is one of "upload", "merge" or "delete"
+        if not documents:
+            return
+        start = time.monotonic()
+        batches = self.split_batches(documents)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def send_with_limit(batch: List[Dict[str, Any]]) -> List[str]:
+            async with semaphore:
+                return await self.send_batch(search_client, action, batch)
+
+        failed_keys = [key for keys in await asyncio.gather(*map(send_with_limit, batches)) for key in keys]
+        seconds = time.monotonic() - start
+        self.documents_sent += len(documents)
+        self.seconds += seconds
+        if self.verbose:
+            print(
+                f"\t{ACTIONS_DONE[action]} {len(documents)} documents in {len(batches)} batches, {seconds:.2f}s ({self.rate(len(documents), seconds):.1f} docs/s)"
+            )
+        if failed_keys:
+            raise Exception(f"{len(failed_keys)} documents couldn't be indexed, e.g. {', '.join(failed_keys[:5])}")
+
+    @classmethod
+    def rate(cls, documents: int, seconds: float) -> float:
+        return documents / seconds if seconds > 0 else 0.0
+
+    def report(self) -> Optional[str]:
+        if not self.documents_sent:
+            return None
+        return f"Sent {self.documents_sent} documents to the search index in {self.seconds:.1f}s ({self.rate(self.documents_sent, self.seconds):.1f} docs/s)"
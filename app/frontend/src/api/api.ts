@@ -55,36 +55,18 @@ export async function runScriptApi(request: ChatAppRequest, idToken: string | un
 }
 
 export async function uploadFilesApi(request: FileUploadRequest, idToken: string | undefined): Promise<Response> {
-    // Convert files to base64 and attach them to the request
-    const base64Files: { name: string; content: string; type: string }[] = [];
-
+    // Send the files as multipart/form-data so the backend can stream them to disk
+    const formData = new FormData();
+    formData.append("azureIndex", request.azureIndex);
+    formData.append("azureContainer", request.azureContainer);
     for (const file of request.files) {
-        const base64 = await fileToBase64(file);
-        base64Files.push({
-            name: file.name,
-            content: base64,
-            type: file.type
-        });
+        formData.append("files", file, file.name);
     }
 
-    const payload = {
-        ...request,
-        files: base64Files
-    };
-
-    // Send the request as JSON
+    // Let the browser set the multipart Content-Type header with its boundary
     return await fetch(`${BACKEND_URI}/uploadFiles`, {
         method: "POST",
-        headers: getHeaders(idToken, "application/json"),
-        body: JSON.stringify(payload)
-    });
-}
-
-function fileToBase64(file: File): Promise<string> {
-    return new Promise((resolve, reject) => {
-        const reader = new FileReader();
-        reader.onload = () => resolve(reader.result as string);
-        reader.onerror = error => reject(error);
-        reader.readAsDataURL(file); // This method returns base64 encoded string
+        headers: getHeaders(idToken, ""),
+        body: formData
     });
 }
@@ -0,0 +1,75 @@
+import argparse
+import os
+import sys
+from typing import Any
+
+import psutil
+import uvicorn
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+from azure.storage.blob.aio import BlobServiceClient
+from quart import Quart, jsonify, request
+
+BACKEND_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app", "backend")
+
+
+def create_loadtest_app(openai_url: str, search_url: str, blob_url: str) -> Quart:
+    # Settings the backend requires, the endpoints derived from them are replaced below
+    os.environ.update(
+        {
+            "AZURE_STORAGE_ACCOUNT": "loadtest",
+            "AZURE_STORAGE_CONTAINER": "content",
+            "AZURE_SEARCH_SERVICE": "loadtest",
+            "AZURE_SEARCH_INDEX": "loadtest",
+            "AZURE_OPENAI_CHATGPT_MODEL": "gpt-35-turbo",
+            "AZURE_OPENAI_EMB_MODEL_NAME": "text-embedding-ada-002",
+            "OPENAI_HOST": "openai",
+            "OPENAI_API_KEY": "loadtest",
+            "OPENAI_BASE_URL": f"{openai_url}/v1",
+            "APP_LOOP_LAG_MONITOR": "true",
+        }
+    )
+    sys.path.insert(0, BACKEND_DIRECTORY)
+    import app as backend
+
+    # The backend creates its clients in setup_clients and again for every /chat request, so its own code runs
+    # unchanged and only the clients it constructs point at the mock servers
+    def search_client(endpoint: str, index_name: str, credential: Any) -> SearchClient:
+        return SearchClient(endpoint=search_url, index_name=index_name, credential=AzureKeyCredential("loadtest"))
+
+    def blob_service_client(account_url: str, credential: Any) -> BlobServiceClient:
+        return BlobServiceClient(account_url=blob_url)
+
+    backend.SearchClient = search_client  # type: ignore[attr-defined]
+    backend.BlobServiceClient = blob_service_client  # type: ignore[attr-defined]
+
+    app = backend.create_app()  # type: ignore[attr-defined]
+    monitor = app.config[backend.CONFIG_LOOP_LAG_MONITOR]  # type: ignore[attr-defined]
+    process = psutil.Process()
+
+    @app.route("/_loadtest/stats")
+    async def stats():
+        result = {
+            "loop_lag": monitor.stats(),
+            "rss_bytes": process.memory_info().rss,
+            "cpu_seconds": round(sum(process.cpu_times()[:2]), 2),
+        }
+        if request.args.get("reset"):
+            monitor.reset()
+        return jsonify(result)
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the backend against the load test mock servers.")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--openai-url", required=True)
+    parser.add_argument("--search-url", required=True)
+    parser.add_argument("--blob-url", required=True)
+    args = parser.parse_args()
+
+    # /chat reads prompts.json relative to the working directory
+    os.chdir(BACKEND_DIRECTORY)
+    quart_app = create_loadtest_app(args.openai_url, args.search_url, args.blob_url)
+    uvicorn.run(quart_app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,313 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from loadtest.mockservers import MockOpenAIServer, MockSearchServer
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ["chat", "chat-stream", "ask", "content"]
+QUESTIONS = [
+    "What is included in my Northwind Health Plus plan that is not in standard?",
+    "What does a Product Manager do?",
+    "What happens in a performance review?",
+    "Whats your whistleblower policy?",
+]
+OVERRIDES = {
+    "retrieval_mode": "hybrid",
+    "semantic_ranker": True,
+    "semantic_captions": False,
+    "top": 3,
+    "suggest_followup_questions": False,
+}
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    # Nearest-rank percentile, None without values
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def summarize(seconds: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        name: None if value is None else round(1000 * value, 1)
+        for name, value in (
+            ("p50_ms", percentile(seconds, 0.5)),
+            ("p95_ms", percentile(seconds, 0.95)),
+            ("p99_ms", percentile(seconds, 0.99)),
+        )
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class RequestResult:
+    """
+    Outcome of one request sent to the app
+    """
+
+    def __init__(self, scenario: str):
+        self.scenario = scenario
+        self.status: Optional[int] = None
+        self.seconds = 0.0
+        self.first_token_seconds: Optional[float] = None
+        self.error: Optional[str] = None
+
+
+class LoadGenerator:
+    """
+    Open-loop load generator: requests start at a fixed rate whether or not the previous ones finished, so a slow
+    app shows up as growing latencies instead of a lower request rate
+    """
+
+    def __init__(self, app_url: str, scenarios: List[str], rps: float, timeout: float = 120):
+        self.app_url = app_url
+        self.scenarios = scenarios
+        self.rps = rps
+        self.timeout = timeout
+        self.sent = 0
+
+    def chat_body(self, stream: bool) -> Dict[str, Any]:
+        return {
+            "messages": [{"content": QUESTIONS[self.sent % len(QUESTIONS)], "role": "user"}],
+            "context": {"overrides": OVERRIDES},
+            "stream": stream,
+            "azureIndex": "loadtest",
+            "azureContainer": "content",
+            "communicationFrameworkIndex": 0,
+            "toneIndex": 0,
+            "readabilityIndex": 0,
+            "wordCountIndex": 0,
+        }
+
+    async def send(self, session: aiohttp.ClientSession, scenario: str) -> RequestResult:
+        result = RequestResult(scenario)
+        start = time.monotonic()
+        try:
+            if scenario == "content":
+                response_context = session.get(f"{self.app_url}/content/doc{self.sent % 10}.pdf")
+            elif scenario == "ask":
+                response_context = session.post(
+                    f"{self.app_url}/ask",
+                    json={
+                        "messages": [{"content": QUESTIONS[self.sent % len(QUESTIONS)], "role": "user"}],
+                        "context": {"overrides": OVERRIDES},
+                    },
+                )
+            else:
+                response_context = session.post(f"{self.app_url}/chat", json=self.chat_body(scenario == "chat-stream"))
+            self.sent += 1
+            async with response_context as response:
+                result.status = response.status
+                if scenario == "chat-stream":
+                    async for line in response.content:
+                        event = self.parse_event(line)
+                        if event is None:
+                            continue
+                        if "error" in event:
+                            # The app reports failures in-band, as the last event of a stream that started with a 200
+                            result.error = f"Stream error: {event['error']}"
+                        elif result.first_token_seconds is None and self.has_content(event):
+                            result.first_token_seconds = time.monotonic() - start
+                    if response.status == 200 and result.error is None and result.first_token_seconds is None:
+                        result.error = "Stream without content"
+                else:
+                    await response.read()
+                if response.status != 200:
+                    result.error = f"HTTP {response.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            result.error = f"{type(error).__name__}: {error}"
+        result.seconds = time.monotonic() - start
+        return result
+
+    @classmethod
+    def parse_event(cls, line: bytes) -> Optional[Dict[str, Any]]:
+        # One NDJSON event of the chat stream, None for blank or malformed lines
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return None
+        return event if isinstance(event, dict) else None
+
+    @classmethod
+    def has_content(cls, event: Dict[str, Any]) -> bool:
+        # Whether an event of the chat stream carries generated text
+        choices = event.get("choices") or [{}]
+        return bool((choices[0].get("delta") or {}).get("content"))
+
+    async def run(self, duration: float) -> List[RequestResult]:
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            tasks = []
+            start = time.monotonic()
+            for number in range(int(self.rps * duration)):
+                delay = start + number / self.rps - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                scenario = self.scenarios[number % len(self.scenarios)]
+                tasks.append(asyncio.create_task(self.send(session, scenario)))
+            return await asyncio.gather(*tasks)
+
+
+async def wait_until_ready(app_url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"The app exited with code {process.returncode} before it was ready")
+            try:
+                async with session.get(f"{app_url}/_loadtest/stats") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"The app didn't start listening within {timeout}s")
+
+
+async def app_stats(app_url: str, reset: bool = False) -> Dict[str, Any]:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{app_url}/_loadtest/stats", params={"reset": "1"} if reset else {}) as response:
+            return await response.json()
+
+
+def report(results: List[RequestResult], seconds: float) -> Dict[str, Any]:
+    scenarios: Dict[str, Any] = {}
+    for scenario in sorted({result.scenario for result in results}):
+        scenario_results = [result for result in results if result.scenario == scenario]
+        succeeded = [result for result in scenario_results if result.error is None]
+        errors: Dict[str, int] = {}
+        for result in scenario_results:
+            if result.error is not None:
+                errors[result.error] = errors.get(result.error, 0) + 1
+        scenarios[scenario] = {
+            "requests": len(scenario_results),
+            "errors": errors,
+            "latency": summarize([result.seconds for result in succeeded]),
+        }
+        first_token = [result.first_token_seconds for result in succeeded if result.first_token_seconds is not None]
+        if first_token:
+            scenarios[scenario]["first_token"] = summarize(first_token)
+    return {
+        "requests": len(results),
+        "errors": sum(1 for result in results if result.error is not None),
+        "achieved_rps": round(len(results) / seconds, 2) if seconds > 0 else 0,
+        "scenarios": scenarios,
+    }
+
+
+async def run_load_test(args: argparse.Namespace) -> Dict[str, Any]:
+    openai_server = MockOpenAIServer(
+        latency=args.openailatency,
+        token_delay=args.tokendelay,
+        tokens=args.tokens,
+        throttle_rate=args.throttlerate,
+    )
+    search_server = MockSearchServer(latency=args.searchlatency)
+    openai_url = await openai_server.start()
+    search_url = await search_server.start()
+    port = free_port()
+    app_url = f"http://127.0.0.1:{port}"
+    environment = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [ROOT_DIRECTORY, os.getenv("PYTHONPATH")]))}
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "loadtest.appserver",
+            "--port",
+            str(port),
+            "--openai-url",
+            openai_url,
+            "--search-url",
+            search_url,
+            "--blob-url",
+            search_url,
+        ],
+        env=environment,
+        stdout=None if args.verbose else subprocess.DEVNULL,
+    )
+    try:
+        await wait_until_ready(app_url, process)
+        generator = LoadGenerator(app_url, args.scenarios, args.rps, timeout=args.timeout)
+        if args.warmup > 0:
+            await generator.run(args.warmup)
+        await app_stats(app_url, reset=True)
+
+        start = time.monotonic()
+        results = await generator.run(args.duration)
+        seconds = time.monotonic() - start
+        stats = await app_stats(app_url)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        await openai_server.close()
+        await search_server.close()
+
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "verbose")},
+        "seconds": round(seconds, 2),
+        **report(results, seconds),
+        "app": stats,
+        "openai": openai_server.stats(),
+        "search": search_server.stats(),
+    }
+
+
+def parse_scenarios(value: str) -> List[str]:
+    scenarios = [scenario.strip() for scenario in value.split(",") if scenario.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown or not scenarios:
+        raise argparse.ArgumentTypeError(f"Scenarios must be a list of {', '.join(SCENARIOS)}")
+    return scenarios
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load test the backend on this machine, against local mock servers for OpenAI, AI Search and blob storage.",
+        epilog="Example: python -m loadtest.harness --rps 20 --duration 60 --scenarios chat-stream,ask --throttlerate 0.05",
+    )
+    parser.add_argument("--rps", type=float, default=10, help="Requests started per second")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=3, help="Seconds of load before measuring")
+    parser.add_argument(
+        "--scenarios",
+        type=parse_scenarios,
+        default=SCENARIOS,
+        help=f"Comma-separated requests to send in turn, of {', '.join(SCENARIOS)}",
+    )
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds before a request is counted as failed")
+    parser.add_argument("--openailatency", type=float, default=0.3, help="Average seconds until the first token")
+    parser.add_argument("--tokendelay", type=float, default=0.02, help="Seconds between streamed tokens")
+    parser.add_argument("--tokens", type=int, default=100, help="Tokens per completion")
+    parser.add_argument(
+        "--throttlerate", type=float, default=0.0, help="Fraction of OpenAI requests answered with a 429"
+    )
+    parser.add_argument("--searchlatency", type=float, default=0.05, help="Average seconds per search or blob request")
+    parser.add_argument("--output", help="Path of the JSON file to write the results to, instead of standard output")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Show the app's output")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_load_test(args))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
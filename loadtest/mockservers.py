@@ -0,0 +1,233 @@
+import asyncio
+import json
+import random
+import time
+from email.utils import formatdate
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+WORDS = "the of and to in is for on that by with from as are this be or at an can plan health benefits employee".split()
+
+
+class MockServer:
+    """
+    aiohttp application listening on a free local port, with counters shared by the mock services
+    """
+
+    def __init__(self, seed: int = 0):
+        self.random = random.Random(seed)
+        self.app = web.Application()
+        self.runner: Optional[web.AppRunner] = None
+        self.url = ""
+        self.requests = 0
+        self.throttled = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        bound_port = self.runner.addresses[0][1]
+        self.url = f"http://{host}:{bound_port}"
+        return self.url
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def jitter(self, seconds: float) -> float:
+        return seconds * self.random.uniform(0.5, 1.5)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "throttled": self.throttled}
+
+
+class MockOpenAIServer(MockServer):
+    """
+    OpenAI-compatible chat completions and embeddings API.
+    Completions take latency seconds until the first token, then token_delay seconds per token, and streamed ones are
+    sent as server-sent events as the tokens are generated. A throttle_rate fraction of requests is answered with a
+    429 and a retry-after-ms header, like Azure OpenAI does when a deployment is over its quota.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.3,
+        token_delay: float = 0.02,
+        tokens: int = 100,
+        throttle_rate: float = 0.0,
+        retry_after_ms: int = 100,
+        dimensions: int = 1536,
+        seed: int = 0,
+    ):
+        super().__init__(seed)
+        self.latency = latency
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.throttle_rate = throttle_rate
+        self.retry_after_ms = retry_after_ms
+        self.dimensions = dimensions
+        self.streams_completed = 0
+        self.streams_cancelled = 0
+        self.app.router.add_post("/v1/chat/completions", self.chat_completions)
+        self.app.router.add_post("/v1/embeddings", self.embeddings)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **super().stats(),
+            "streams_completed": self.streams_completed,
+            "streams_cancelled": self.streams_cancelled,
+        }
+
+    def throttle(self) -> Optional[web.Response]:
+        self.requests += 1
+        if self.random.random() >= self.throttle_rate:
+            return None
+        self.throttled += 1
+        return web.json_response(
+            {"error": {"code": "429", "message": "Requests to the deployment have exceeded the rate limit."}},
+            status=429,
+            headers={"retry-after-ms": str(self.retry_after_ms), "retry-after": "1"},
+        )
+
+    def completion_tokens(self) -> List[str]:
+        tokens = [self.random.choice(WORDS) + " " for _ in range(self.tokens - 1)]
+        return tokens + ["[info1.txt]."]
+
+    @classmethod
+    def completion(cls, model: str, **fields: Any) -> Dict[str, Any]:
+        return {"id": "chatcmpl-loadtest", "created": int(time.time()), "model": model, **fields}
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        throttled = self.throttle()
+        if throttled is not None:
+            return throttled
+        body = await request.json()
+        model = body.get("model", "gpt-35-turbo")
+        tokens = self.completion_tokens()
+        await asyncio.sleep(self.jitter(self.latency))
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_delay * len(tokens))
+            return web.json_response(
+                self.completion(
+                    model,
+                    object="chat.completion",
+                    choices=[
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": "".join(tokens)},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    usage={"prompt_tokens": 100, "completion_tokens": len(tokens), "total_tokens": 100 + len(tokens)},
+                )
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        deltas: List[Dict[str, Any]] = [{"role": "assistant", "content": ""}]
+        deltas += [{"content": token} for token in tokens]
+        try:
+            for index, delta in enumerate(deltas):
+                if index > 0:
+                    await asyncio.sleep(self.token_delay)
+                chunk = self.completion(
+                    model,
+                    object="chat.completion.chunk",
+                    choices=[{"index": 0, "delta": delta, "finish_reason": None}],
+                )
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            chunk = self.completion(
+                model, object="chat.completion.chunk", choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]
+            )
+            await response.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode())
+            await response.write_eof()
+        except (ConnectionResetError, asyncio.CancelledError):
+            # The app stopped reading the stream, e.g. because its own client went away
+            self.streams_cancelled += 1
+            raise
+        self.streams_completed += 1
+        return response
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        throttled = self.throttle()
+        if throttled is not None:
+            return throttled
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dimensions = body.get("dimensions", self.dimensions)
+        await asyncio.sleep(self.jitter(self.latency / 3))
+        return web.json_response(
+            {
+                "object": "list",
+                "model": body.get("model", "text-embedding-ada-002"),
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": index,
+                        "embedding": [self.random.random() for _ in range(dimensions)],
+                    }
+                    for index in range(len(inputs))
+                ],
+                "usage": {"prompt_tokens": 10 * len(inputs), "total_tokens": 10 * len(inputs)},
+            }
+        )
+
+
+class MockSearchServer(MockServer):
+    """
+    Stand-in for the Azure AI Search documents API, answering every query with top documents after latency seconds,
+    and for the blob storage account serving the documents' source files.
+    """
+
+    def __init__(self, latency: float = 0.05, blob_size: int = 200 * 1024, seed: int = 0):
+        super().__init__(seed)
+        self.latency = latency
+        self.blob = bytes(self.random.getrandbits(8) for _ in range(blob_size))
+        self.app.router.add_post("/indexes('{index}')/docs/search.post.search", self.search)
+        self.app.router.add_post("/indexes/{index}/docs/search.post.search", self.search)
+        self.app.router.add_get("/{container}/{blob:.+}", self.download_blob)
+
+    def document(self, number: int, score: float) -> Dict[str, Any]:
+        content = " ".join(self.random.choice(WORDS) for _ in range(200))
+        return {
+            "@search.score": score,
+            "@search.rerankerScore": score,
+            "@search.captions": [{"text": content[:200], "highlights": ""}],
+            "id": f"file-doc{number}_pdf-page-{number}",
+            "content": content,
+            "category": None,
+            "sourcepage": f"doc{number}-{number}.pdf",
+            "sourcefile": f"doc{number}.pdf",
+        }
+
+    async def search(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = await request.json()
+        top = body.get("top") or 3
+        await asyncio.sleep(self.jitter(self.latency))
+        return web.json_response({"value": [self.document(number, 1.0 / (number + 1)) for number in range(top)]})
+
+    async def download_blob(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.jitter(self.latency))
+        size = len(self.blob)
+        start, end = 0, size - 1
+        if range_header := request.headers.get("x-ms-range") or request.headers.get("Range"):
+            first, _, last = range_header.split("=", 1)[1].partition("-")
+            start, end = int(first), min(int(last) if last else size - 1, size - 1)
+        return web.Response(
+            status=206,
+            body=self.blob[start : end + 1],
+            headers={
+                "Content-Type": "application/pdf",
+                "Content-Range": f"bytes {start}-{end}/{size}",
+                "ETag": '"0x8DC0000000000000"',
+                "Last-Modified": formatdate(usegmt=True),
+                "x-ms-blob-type": "BlockBlob",
+                "x-ms-version": "2023-11-03",
+            },
+        )
@@ -0,0 +1,29 @@
+import argparse
+import json
+
+from prepdocslib.embeddingcache import EmbeddingCache
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report the size of the prepdocs embedding cache, or prune entries from it.",
+        epilog="Example: embeddingcache.py .embeddingcache.sqlite prune --olderthandays 30 -v",
+    )
+    parser.add_argument("path", help="Path of the SQLite embedding cache passed to prepdocs.py with --embeddingcache")
+    parser.add_argument("action", choices=["stats", "prune"], help="stats prints the cache size, prune removes entries")
+    parser.add_argument(
+        "--olderthandays",
+        type=float,
+        required=False,
+        help="Optional. Only prune entries that haven't been used by prepdocs for this many days",
+    )
+    parser.add_argument("--model", required=False, help="Optional. Only prune entries for this embedding model")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.path, verbose=args.verbose)
+    try:
+        if args.action == "prune":
+            cache.prune(older_than_days=args.olderthandays, model=args.model)
+        print(json.dumps(cache.stats(), indent=2))
+    finally:
+        cache.close()
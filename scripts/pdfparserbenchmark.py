@@ -0,0 +1,127 @@
+import argparse
+import html
+import random
+import time
+from typing import List, Tuple
+
+from azure.ai.formrecognizer import (
+    BoundingRegion,
+    DocumentSpan,
+    DocumentTable,
+    DocumentTableCell,
+)
+
+from prepdocslib.pdfparser import DocumentAnalysisPdfParser
+
+
+def legacy_table_to_html(table: DocumentTable) -> str:
+    # Previous implementation: every row scans all the cells of the table
+    table_html = "<table>"
+    rows = [
+        sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index)
+        for i in range(table.row_count)
+    ]
+    for row_cells in rows:
+        table_html += "<tr>"
+        for cell in row_cells:
+            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            cell_spans = ""
+            if cell.column_span is not None and cell.column_span > 1:
+                cell_spans += f" colSpan={cell.column_span}"
+            if cell.row_span is not None and cell.row_span > 1:
+                cell_spans += f" rowSpan={cell.row_span}"
+            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
+        table_html += "</tr>"
+    table_html += "</table>"
+    return table_html
+
+
+def legacy_page_text(content: str, page_offset: int, page_length: int, tables: List[DocumentTable]) -> str:
+    # Previous implementation: one entry per character of the page, text appended one character at a time
+    table_chars = [-1] * page_length
+    for table_id, table in enumerate(tables):
+        for span in table.spans:
+            for i in range(span.length):
+                idx = span.offset - page_offset + i
+                if idx >= 0 and idx < page_length:
+                    table_chars[idx] = table_id
+    page_text = ""
+    added_tables = set()
+    for idx, table_id in enumerate(table_chars):
+        if table_id == -1:
+            page_text += content[page_offset + idx]
+        elif table_id not in added_tables:
+            page_text += legacy_table_to_html(tables[table_id])
+            added_tables.add(table_id)
+    return page_text
+
+
+def make_pages(
+    pages: int, page_length: int, tables_per_page: int, rows: int, columns: int
+) -> Tuple[str, List[Tuple[int, int, List[DocumentTable]]]]:
+    # Synthetic Document Intelligence output: pages of text, each with evenly spaced tables covering half the page
+    random.seed(0)
+    content = "".join(random.choice("abcdefghij klmnop.\n") for _ in range(pages * page_length))
+    result = []
+    for page_num in range(pages):
+        page_offset = page_num * page_length
+        table_length = page_length // (2 * tables_per_page)
+        tables = []
+        for table_num in range(tables_per_page):
+            table_offset = page_offset + table_num * 2 * table_length
+            cells = [
+                DocumentTableCell(
+                    kind="columnHeader" if row == 0 else "content",
+                    row_index=row,
+                    column_index=column,
+                    row_span=1,
+                    column_span=1,
+                    content=f"{row}.{column} & value",
+                    bounding_regions=[],
+                    spans=[],
+                )
+                for row in range(rows)
+                for column in range(columns)
+            ]
+            random.shuffle(cells)
+            tables.append(
+                DocumentTable(
+                    row_count=rows,
+                    column_count=columns,
+                    cells=cells,
+                    bounding_regions=[BoundingRegion(page_number=page_num + 1, polygon=[])],
+                    spans=[DocumentSpan(offset=table_offset, length=table_length)],
+                )
+            )
+        result.append((page_offset, page_length, tables))
+    return content, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare how long the Document Intelligence parser takes to assemble page text on dense, table-heavy synthetic pages.",
+        epilog="Example: pdfparserbenchmark.py --pages 500 --tables 4 --rows 40 --columns 8",
+    )
+    parser.add_argument("--pages", type=int, default=100, help="Number of pages")
+    parser.add_argument("--pagelength", type=int, default=5000, help="Number of characters per page")
+    parser.add_argument("--tables", type=int, default=4, help="Number of tables per page")
+    parser.add_argument("--rows", type=int, default=40, help="Number of rows per table")
+    parser.add_argument("--columns", type=int, default=8, help="Number of columns per table")
+    args = parser.parse_args()
+
+    content, pages = make_pages(args.pages, args.pagelength, args.tables, args.rows, args.columns)
+
+    start = time.perf_counter()
+    legacy_texts = [legacy_page_text(content, *page) for page in pages]
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    texts = [DocumentAnalysisPdfParser.page_text(content, *page) for page in pages]
+    seconds = time.perf_counter() - start
+
+    if texts != legacy_texts:
+        raise RuntimeError("Page text differs from the previous implementation")
+    print(f"Pages: {args.pages}, tables per page: {args.tables}, cells per table: {args.rows * args.columns}")
+    print(f"Previous implementation: {legacy_seconds:.3f}s ({legacy_seconds / args.pages * 1000:.2f}ms per page)")
+    print(f"Span intervals: {seconds:.3f}s ({seconds / args.pages * 1000:.2f}ms per page)")
+    print(f"Speedup: {legacy_seconds / seconds:.1f}x")
@@ -31,7 +31,20 @@ if ($env:AZURE_ADLS_GEN2_STORAGE_ACCOUNT) {
 if ($env:AZURE_SEARCH_ANALYZER_NAME) {
   $searchAnalyzerNameArg = "--searchanalyzername $env:AZURE_SEARCH_ANALYZER_NAME"
 }
-$argumentList = "./scripts/prepdocs.py `"$cwd/data/*`" $adlsGen2StorageAccountArg $adlsGen2FilesystemArg $adlsGen2FilesystemPathArg $searchAnalyzerNameArg " + `
+# Optional local index directory to index into instead of the Azure AI Search service
+if ($env:LOCAL_SEARCH_INDEX_DIRECTORY) {
+  $localIndexDirectoryArg = "--localindexdirectory `"$env:LOCAL_SEARCH_INDEX_DIRECTORY`""
+}
+# Optional compression of the embeddings of a new local index
+if ($env:LOCAL_SEARCH_VECTOR_COMPRESSION) {
+  $localVectorCompressionArg = "--localvectorcompression $env:LOCAL_SEARCH_VECTOR_COMPRESSION"
+}
+# Optional number of dimensions of shortened text-embedding-3 embeddings
+if ($env:AZURE_OPENAI_EMB_DIMENSIONS) {
+  $openAiDimensionsArg = "--openaidimensions $env:AZURE_OPENAI_EMB_DIMENSIONS"
+}
+$argumentList = "./scripts/prepdocs.py `"$cwd/data/*`" $adlsGen2StorageAccountArg $adlsGen2FilesystemArg $adlsGen2FilesystemPathArg $searchAnalyzerNameArg $localIndexDirectoryArg " + `
+"$localVectorCompressionArg $openAiDimensionsArg " + `
 "$aclArg --storageaccount $env:AZURE_STORAGE_ACCOUNT --container $env:AZURE_STORAGE_CONTAINER " + `
 "--searchservice $env:AZURE_SEARCH_SERVICE --openaihost `"$env:OPENAI_HOST`" " + `
 "--openaiservice `"$env:AZURE_OPENAI_SERVICE`" --openaikey `"$env:OPENAI_API_KEY`" " + `
@@ -1,24 +1,28 @@
 import argparse
 import asyncio
-from typing import Any, Optional, Union
+from typing import Any, Dict, Optional, Union
 
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import AzureDeveloperCliCredential
 
 from prepdocslib.blobmanager import BlobManager
+from prepdocslib.embeddingcache import EmbeddingCache
 from prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
     OpenAIEmbeddings,
     OpenAIEmbeddingService,
 )
-from prepdocslib.filestrategy import DocumentAction, FileStrategy
+from prepdocslib.filemanifest import FileManifest
+from prepdocslib.filestrategy import DEFAULT_STAGE_WORKERS, DocumentAction, FileStrategy
 from prepdocslib.listfilestrategy import (
     ADLSGen2ListFileStrategy,
     ListFileStrategy,
     LocalListFileStrategy,
 )
+from prepdocslib.localsearch import VECTOR_COMPRESSIONS, LocalSearchInfo
 from prepdocslib.pdfparser import DocumentAnalysisPdfParser, LocalPdfParser, PdfParser
+from prepdocslib.searchuploader import SearchDocumentUploader
 from prepdocslib.strategy import SearchInfo, Strategy
 from prepdocslib.textsplitter import TextSplitter
 
@@ -27,6 +31,19 @@ def is_key_empty(key):
     return key is None or len(key.strip()) == 0
 
 
+def parse_stage_workers(value: str) -> Dict[str, int]:
+    # e.g. "parse=4,embed=2"
+    stage_workers = {}
+    for setting in value.split(","):
+        stage, _, workers = setting.partition("=")
+        if stage.strip() not in DEFAULT_STAGE_WORKERS or not workers.strip().isdigit() or int(workers) < 1:
+            raise argparse.ArgumentTypeError(
+                f"Invalid stage workers '{setting}', expected STAGE=N with STAGE one of {', '.join(DEFAULT_STAGE_WORKERS)}"
+            )
+        stage_workers[stage.strip()] = int(workers)
+    return stage_workers
+
+
 def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStrategy:
     storage_creds = credential if is_key_empty(
         args.storagekey) else args.storagekey
@@ -39,7 +56,7 @@ def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStra
 
     pdf_parser: PdfParser
     if args.localpdfparser:
-        pdf_parser = LocalPdfParser()
+        pdf_parser = LocalPdfParser(workers=args.localpdfparserworkers, verbose=args.verbose)
     else:
         # check if Azure Document Intelligence credentials are provided
         if args.formrecognizerservice is None:
@@ -59,6 +76,7 @@ def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStra
 
     use_vectors = not args.novectors
     embeddings: Optional[OpenAIEmbeddings] = None
+    embedding_cache = EmbeddingCache(args.embeddingcache, verbose=args.verbose) if args.embeddingcache else None
     if use_vectors and args.openaihost != "openai":
         azure_open_ai_credential: Union[AsyncTokenCredential, AzureKeyCredential] = (
             credential if is_key_empty(
@@ -71,6 +89,9 @@ def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStra
             credential=azure_open_ai_credential,
             disable_batch=args.disablebatchvectors,
             verbose=args.verbose,
+            cache=embedding_cache,
+            max_concurrency=args.embeddingconcurrency,
+            dimensions=args.openaidimensions,
         )
     elif use_vectors:
         embeddings = OpenAIEmbeddingService(
@@ -79,6 +100,9 @@ def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStra
             organization=args.openaiorg,
             disable_batch=args.disablebatchvectors,
             verbose=args.verbose,
+            cache=embedding_cache,
+            max_concurrency=args.embeddingconcurrency,
+            dimensions=args.openaidimensions,
         )
 
     print("Processing files...")
@@ -98,7 +122,10 @@ def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStra
     else:
         print(f"Using local files in {args.files}")
         list_file_strategy = LocalListFileStrategy(
-            path_pattern=args.files, verbose=args.verbose)
+            path_pattern=args.files,
+            verbose=args.verbose,
+            manifest=FileManifest(args.filemanifest, verbose=args.verbose) if args.filemanifest else None,
+        )
 
     if args.removeall:
         document_action = DocumentAction.RemoveAll
@@ -111,12 +138,21 @@ def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStra
         list_file_strategy=list_file_strategy,
         blob_manager=blob_manager,
         pdf_parser=pdf_parser,
-        text_splitter=TextSplitter(),
+        text_splitter=TextSplitter(
+            max_tokens_per_section=args.maxsectiontokens,
+            model_name=args.openaimodelname or "text-embedding-ada-002",
+        ),
         document_action=document_action,
         embeddings=embeddings,
         search_analyzer_name=args.searchanalyzername,
         use_acls=args.useacls,
         category=args.category,
+        stage_workers=args.stageworkers,
+        search_uploader=SearchDocumentUploader(
+            max_batch_bytes=args.searchbatchmegabytes * 1024 * 1024,
+            max_concurrency=args.searchuploadconcurrency,
+            verbose=args.verbose,
+        ),
     )
 
 
@@ -125,12 +161,21 @@ async def main(strategy: Strategy, credential: AsyncTokenCredential, args: Any):
         credential if is_key_empty(
             args.searchkey) else AzureKeyCredential(args.searchkey)
     )
-    search_info = SearchInfo(
-        endpoint=f"https://{args.searchservice}.search.windows.net/",
-        credential=search_creds,
-        index_name=args.index,
-        verbose=args.verbose,
-    )
+    search_info: SearchInfo
+    if args.localindexdirectory:
+        search_info = LocalSearchInfo(
+            args.localindexdirectory,
+            index_name=args.index,
+            verbose=args.verbose,
+            vector_compression=args.localvectorcompression,
+        )
+    else:
+        search_info = SearchInfo(
+            endpoint=f"https://{args.searchservice}.search.windows.net/",
+            credential=search_creds,
+            index_name=args.index,
+            verbose=args.verbose,
+        )
 
     if not args.remove and not args.removeall:
         await strategy.setup(search_info)
@@ -195,6 +240,17 @@ if __name__ == "__main__":
         required=False,
         help="Optional. Use this Azure AI Search account key instead of the current user identity to login (use az login to set current user for Azure)",
     )
+    parser.add_argument(
+        "--localindexdirectory",
+        required=False,
+        help="Optional. Index the sections in a local index stored in a subdirectory of this directory named after the index, instead of in an Azure AI Search service. Meant for small indexes searched by the app in process",
+    )
+    parser.add_argument(
+        "--localvectorcompression",
+        choices=VECTOR_COMPRESSIONS,
+        required=False,
+        help="Optional. Also store the embeddings of a new local index scalar (int8) or binary quantized, to search the compressed embeddings and rescore the best matches with the full precision ones",
+    )
     parser.add_argument(
         "--searchanalyzername",
         required=False,
@@ -212,6 +268,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--openaimodelname", help="Name of the Azure OpenAI embedding model ('text-embedding-3-large' recommended)"
     )
+    parser.add_argument(
+        "--openaidimensions",
+        type=int,
+        required=False,
+        help="Optional. Number of dimensions of the embeddings, to shorten text-embedding-3 embeddings and the vectors stored in the index. The app must use the same number of dimensions",
+    )
     parser.add_argument(
         "--novectors",
         action="store_true",
@@ -220,6 +282,48 @@ if __name__ == "__main__":
     parser.add_argument(
         "--disablebatchvectors", action="store_true", help="Don't compute embeddings in batch for the sections"
     )
+    parser.add_argument(
+        "--stageworkers",
+        type=parse_stage_workers,
+        required=False,
+        help="Optional. Number of workers of each ingestion stage, e.g. 'parse=4,embed=2'. Stages are parse, split, embed, index and blob (defaults: "
+        + ", ".join(f"{stage}={workers}" for stage, workers in DEFAULT_STAGE_WORKERS.items())
+        + ")",
+    )
+    parser.add_argument(
+        "--maxsectiontokens",
+        type=int,
+        required=False,
+        help="Optional. Split documents into sections of at most this many tokens of the embedding model, keeping sentences and tables whole where possible, instead of sections of about 1000 characters",
+    )
+    parser.add_argument(
+        "--filemanifest",
+        default=".prepdocsmanifest.sqlite",
+        help="Path of a local SQLite file recording the local files that were ingested, so unchanged files are skipped on the next run. Pass an empty value to ingest every file",
+    )
+    parser.add_argument(
+        "--embeddingcache",
+        required=False,
+        help="Optional. Path of a local SQLite file used to cache embeddings across runs, so unchanged text is never sent to the embeddings API twice",
+    )
+    parser.add_argument(
+        "--embeddingconcurrency",
+        type=int,
+        default=4,
+        help="Maximum number of embedding batches sent to the OpenAI embeddings API at once. Lowered automatically when the API throttles requests",
+    )
+    parser.add_argument(
+        "--searchuploadconcurrency",
+        type=int,
+        default=4,
+        help="Maximum number of batches of documents sent to the search index at once",
+    )
+    parser.add_argument(
+        "--searchbatchmegabytes",
+        type=int,
+        default=12,
+        help="Maximum estimated size of a batch of documents sent to the search index, which rejects requests over 16MB",
+    )
     parser.add_argument(
         "--openaikey",
         required=False,
@@ -242,6 +346,12 @@ if __name__ == "__main__":
         action="store_true",
         help="Use PyPdf local PDF parser (supports only digital PDFs) instead of Azure Document Intelligence service to extract text, tables and layout from the documents",
     )
+    parser.add_argument(
+        "--localpdfparserworkers",
+        type=int,
+        default=1,
+        help="Optional. Number of processes the local PDF parser extracts pages with, e.g. the number of CPU cores. Pages of a file are split across the processes",
+    )
     parser.add_argument(
         "--formrecognizerservice",
         required=False,
@@ -21,8 +21,21 @@ if [ -n "$AZURE_SEARCH_ANALYZER_NAME" ]; then
   searchAnalyzerNameArg="--searchanalyzername $AZURE_SEARCH_ANALYZER_NAME"
 fi
 
+if [ -n "$LOCAL_SEARCH_INDEX_DIRECTORY" ]; then
+  localIndexDirectoryArg="--localindexdirectory $LOCAL_SEARCH_INDEX_DIRECTORY"
+fi
+
+if [ -n "$LOCAL_SEARCH_VECTOR_COMPRESSION" ]; then
+  localVectorCompressionArg="--localvectorcompression $LOCAL_SEARCH_VECTOR_COMPRESSION"
+fi
+
+if [ -n "$AZURE_OPENAI_EMB_DIMENSIONS" ]; then
+  openAiDimensionsArg="--openaidimensions $AZURE_OPENAI_EMB_DIMENSIONS"
+fi
+
 ./scripts/.venv/bin/python ./scripts/prepdocs.py \
-'./data/*' $adlsGen2StorageAccountArg $adlsGen2FilesystemArg $adlsGen2FilesystemPathArg $searchAnalyzerNameArg \
+'./data/*' $adlsGen2StorageAccountArg $adlsGen2FilesystemArg $adlsGen2FilesystemPathArg $searchAnalyzerNameArg $localIndexDirectoryArg \
+$localVectorCompressionArg $openAiDimensionsArg \
 $aclArg  --storageaccount "$AZURE_STORAGE_ACCOUNT" \
 --container "$AZURE_STORAGE_CONTAINER" --searchservice "$AZURE_SEARCH_SERVICE" \
 --openaiservice "$AZURE_OPENAI_SERVICE" --openaideployment "$AZURE_OPENAI_EMB_DEPLOYMENT" \
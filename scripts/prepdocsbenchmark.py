@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import httpx
+import openai
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
+
+from prepdocs import parse_stage_workers
+from prepdocslib.blobmanager import BlobManager
+from prepdocslib.embeddings import OpenAIEmbeddings
+from prepdocslib.filestrategy import FileStrategy
+from prepdocslib.listfilestrategy import File, LocalListFileStrategy
+from prepdocslib.pdfparser import LocalPdfParser
+from prepdocslib.searchuploader import SearchDocumentUploader
+from prepdocslib.strategy import SearchInfo
+from prepdocslib.textsplitter import TextSplitter
+
+WORDS = "the of and to in is for on that by with from as are this be or at an can data search index model".split()
+
+
+def make_pdf(page_texts: List[str]) -> bytes:
+    # Smallest valid PDF with one line of Helvetica text per page
+    objects: List[Optional[bytes]] = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for text in page_texts:
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % len(objects)
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode()
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return pdf
+
+
+def make_corpus(directory: str, files: int, pages: int, page_length: int, seed: int = 0):
+    # PDFs of random sentences, the same for a given seed so runs can be compared
+    rng = random.Random(seed)
+    for file_num in range(files):
+        page_texts = []
+        for _ in range(pages):
+            text = ""
+            while len(text) < page_length:
+                sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 20)))
+                text += sentence.capitalize() + ". "
+            page_texts.append(text.strip())
+        with open(os.path.join(directory, f"doc{file_num}.pdf"), "wb") as pdf_file:
+            pdf_file.write(make_pdf(page_texts))
+
+
+class FakeBackend:
+    """
+    Shared latency and throttling behavior of the stand-ins for the Azure services
+    """
+
+    def __init__(self, latency: float, throttle_rate: float, seed: int = 0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.throttled = 0
+
+    async def call(self) -> bool:
+        # Returns whether the request should be throttled
+        self.requests += 1
+        await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if self.random.random() < self.throttle_rate:
+            self.throttled += 1
+            return True
+        return False
+
+
+class FakeEmbeddingsClient:
+    """
+    Stand-in for the embeddings API of AsyncOpenAI, returning random vectors and rate limit headers
+    """
+
+    def __init__(self, backend: FakeBackend, dimensions: int):
+        self.backend = backend
+        self.dimensions = dimensions
+        self.embeddings = SimpleNamespace(with_raw_response=self)
+
+    async def create(self, model: str, input: List[str], extra_body: Optional[Dict[str, Any]] = None):
+        if await self.backend.call():
+            request = httpx.Request("POST", "https://localhost/embeddings")
+            response = httpx.Response(429, headers={"retry-after-ms": "100"}, request=request)
+            raise openai.RateLimitError("Rate limit reached", response=response, body=None)
+        dimensions = (extra_body or {}).get("dimensions", self.dimensions)
+        data = [SimpleNamespace(embedding=[self.backend.random.random() for _ in range(dimensions)]) for _ in input]
+        headers = {"x-ratelimit-remaining-tokens": "1000000", "x-ratelimit-remaining-requests": "10000"}
+        return SimpleNamespace(parse=lambda: SimpleNamespace(data=data), headers=headers)
+
+    async def close(self):
+        pass
+
+
+class FakeEmbeddings(OpenAIEmbeddings):
+    def __init__(self, backend: FakeBackend, dimensions: int, max_concurrency: int):
+        super().__init__(
+            open_ai_model_name="text-embedding-3-large", max_concurrency=max_concurrency, dimensions=dimensions
+        )
+        self.backend = backend
+
+    async def create_client(self) -> Any:
+        return FakeEmbeddingsClient(self.backend, self.dimensions or 0)
+
+    def calculate_token_length(self, text: str):
+        # Close enough for English text, and doesn't need to download a tokenizer
+        return len(text) // 4
+
+
+class FakeSearchResults:
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+    async def get_count(self):
+        return 0
+
+
+class FakeSearchClient:
+    """
+    Stand-in for an empty search index that accepts every document
+    """
+
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+        self.documents = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def search(self, *args, **kwargs):
+        await self.backend.call()
+        return FakeSearchResults()
+
+    async def index(self, documents: List[Dict[str, Any]]):
+        if await self.backend.call():
+            error = HttpResponseError("Too many requests")
+            error.status_code = 429
+            raise error
+        self.documents += len(documents)
+
+    async def upload_documents(self, documents: List[Dict[str, Any]]):
+        await self.index(documents)
+
+    async def merge_documents(self, documents: List[Dict[str, Any]]):
+        await self.index(documents)
+
+    async def delete_documents(self, documents: List[Dict[str, Any]]):
+        await self.index(documents)
+
+
+class FakeSearchInfo(SearchInfo):
+    def __init__(self, search_client: FakeSearchClient):
+        super().__init__(endpoint="https://localhost", credential=AzureKeyCredential("fake"), index_name="benchmark")
+        self.search_client = search_client
+
+    def create_search_client(self) -> Any:
+        return self.search_client
+
+
+class FakeBlobManager(BlobManager):
+    def __init__(self, backend: FakeBackend):
+        super().__init__(endpoint="https://localhost", container="benchmark", credential="fake")
+        self.backend = backend
+
+    async def upload_blob(self, file: File):
+        await self.backend.call()
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as directory:
+        make_corpus(directory, args.files, args.pages, args.pagelength)
+        embeddings_backend = FakeBackend(args.embeddinglatency, args.embeddingthrottlerate, seed=1)
+        search_backend = FakeBackend(args.searchlatency, args.searchthrottlerate, seed=2)
+        blob_backend = FakeBackend(args.bloblatency, 0)
+        search_client = FakeSearchClient(search_backend)
+        file_strategy = FileStrategy(
+            list_file_strategy=LocalListFileStrategy(path_pattern=os.path.join(directory, "*")),
+            blob_manager=FakeBlobManager(blob_backend),
+            pdf_parser=LocalPdfParser(workers=args.parserworkers),
+            text_splitter=TextSplitter(),
+            embeddings=FakeEmbeddings(embeddings_backend, args.dimensions, args.embeddingconcurrency),
+            stage_workers=args.stageworkers,
+            search_uploader=SearchDocumentUploader(retry_delay=args.searchretrydelay),
+        )
+
+        start = time.monotonic()
+        error = None
+        try:
+            await file_strategy.run(FakeSearchInfo(search_client))
+        except RuntimeError as run_error:
+            error = str(run_error)
+        seconds = time.monotonic() - start
+
+    return {
+        "commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "error": error,
+        "seconds": round(seconds, 3),
+        "files": args.files,
+        "sections": search_client.documents,
+        "docs_per_second": round(args.files / seconds, 2),
+        "sections_per_second": round(search_client.documents / seconds, 2),
+        "stage_seconds": {stage: round(value, 3) for stage, value in file_strategy.stage_seconds.items()},
+        "embedding_requests": embeddings_backend.requests,
+        "embedding_throttled": embeddings_backend.throttled,
+        "search_requests": search_backend.requests,
+        "search_throttled": search_backend.throttled,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput of the prepdocs ingestion pipeline on a generated PDF corpus, with local stand-ins for the embeddings API, the search index and blob storage.",
+        epilog="Example: prepdocsbenchmark.py --files 200 --pages 10 --embeddinglatency 0.3 --embeddingthrottlerate 0.05 --output before.json",
+    )
+    parser.add_argument("--files", type=int, default=50, help="Number of PDF files to generate")
+    parser.add_argument("--pages", type=int, default=5, help="Number of pages per file")
+    parser.add_argument("--pagelength", type=int, default=3000, help="Number of characters per page")
+    parser.add_argument("--dimensions", type=int, default=1536, help="Number of dimensions of the fake embeddings")
+    parser.add_argument("--embeddinglatency", type=float, default=0.2, help="Average seconds per embeddings request")
+    parser.add_argument(
+        "--embeddingthrottlerate", type=float, default=0.0, help="Fraction of embeddings requests answered with a 429"
+    )
+    parser.add_argument("--embeddingconcurrency", type=int, default=4, help="Embedding batches sent at once")
+    parser.add_argument("--searchlatency", type=float, default=0.1, help="Average seconds per search request")
+    parser.add_argument(
+        "--searchthrottlerate", type=float, default=0.0, help="Fraction of indexing requests answered with a 429"
+    )
+    parser.add_argument(
+        "--searchretrydelay", type=float, default=1.0, help="Base delay before retrying a throttled indexing request"
+    )
+    parser.add_argument("--bloblatency", type=float, default=0.05, help="Average seconds per blob upload")
+    parser.add_argument("--parserworkers", type=int, default=1, help="Worker processes of the local PDF parser")
+    parser.add_argument(
+        "--stageworkers",
+        type=parse_stage_workers,
+        default=None,
+        help="Number of workers of each ingestion stage, e.g. 'parse=4,embed=2'",
+    )
+    parser.add_argument("--output", help="Path of the JSON file to write the results to, instead of standard output")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmark(args))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
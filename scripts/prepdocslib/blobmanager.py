@@ -1,12 +1,21 @@
+import asyncio
+import hashlib
 import os
 import re
-from typing import Optional, Union
+from typing import IO, List, Optional, Union
 
 from azure.core.credentials_async import AsyncTokenCredential
-from azure.storage.blob.aio import BlobServiceClient
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import ContentSettings
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
 
 from .listfilestrategy import File
 
+# Number of blobs deleted at the same time when removing many files
+DELETE_CONCURRENCY = 16
+# Suffix of the blobs of PDFs split into individual pages, e.g. "-12.pdf"
+PAGE_BLOB_SUFFIX = re.compile(r"-\d+\.pdf")
+
 
 class BlobManager:
     """
@@ -19,47 +28,131 @@ class BlobManager:
         container: str,
         credential: Union[AsyncTokenCredential, str],
         verbose: bool = False,
+        max_concurrency: int = 4,
     ):
         self.endpoint = endpoint
         self.credential = credential
         self.container = container
         self.verbose = verbose
+        # Number of parallel connections used to upload the blocks of a single large file
+        self.max_concurrency = max_concurrency
+        self.service_client: Optional[BlobServiceClient] = None
+        self.container_client: Optional[ContainerClient] = None
+        self.container_exists = False
+        self.container_lock: Optional[asyncio.Lock] = None
+
+    def get_container_client(self) -> ContainerClient:
+        # A single client, and its connection pool, is shared by all the uploads and removals of a run
+        if self.container_client is None:
+            self.service_client = BlobServiceClient(
+                account_url=self.endpoint, credential=self.credential, max_single_put_size=4 * 1024 * 1024
+            )
+            self.container_client = self.service_client.get_container_client(self.container)
+        return self.container_client
+
+    async def check_container(self, create: bool = False) -> bool:
+        # The container is looked up, and created if needed, by the first caller only
+        if not self.container_exists:
+            if self.container_lock is None:
+                self.container_lock = asyncio.Lock()
+            async with self.container_lock:
+                if not self.container_exists:
+                    container_client = self.get_container_client()
+                    self.container_exists = await container_client.exists()
+                    if not self.container_exists and create:
+                        await container_client.create_container()
+                        self.container_exists = True
+        return self.container_exists
+
+    async def close(self):
+        if self.container_client is not None:
+            await self.container_client.close()
+        if self.service_client is not None:
+            await self.service_client.close()
+        self.container_client = None
+        self.service_client = None
+        self.container_exists = False
+
+    @classmethod
+    def content_md5(cls, content: IO) -> bytes:
+        md5 = hashlib.md5()
+        content.seek(0)
+        for chunk in iter(lambda: content.read(1024 * 1024), b""):
+            md5.update(chunk)
+        content.seek(0)
+        return md5.digest()
 
     async def upload_blob(self, file: File):
-        async with BlobServiceClient(
-            account_url=self.endpoint, credential=self.credential, max_single_put_size=4 * 1024 * 1024
-        ) as service_client, service_client.get_container_client(self.container) as container_client:
-            if not await container_client.exists():
-                await container_client.create_container()
-
-            # Re-open and upload the original file
-            with open(file.content.name, "rb") as reopened_file:
-                blob_name = BlobManager.blob_name_from_file_name(file.content.name)
-                print(f"\tUploading blob for whole file -> {blob_name}")
-                await container_client.upload_blob(blob_name, reopened_file, overwrite=True)
+        await self.check_container(create=True)
+        container_client = self.get_container_client()
+        blob_name = BlobManager.blob_name_from_file_name(file.filename())
+        content_md5 = await asyncio.to_thread(self.content_md5, file.content)
 
-    async def remove_blob(self, path: Optional[str] = None):
-        async with BlobServiceClient(
-            account_url=self.endpoint, credential=self.credential
-        ) as service_client, service_client.get_container_client(self.container) as container_client:
-            if not await container_client.exists():
+        # Skip files whose blob already has the same content, so re-runs over unchanged files upload nothing
+        try:
+            properties = await container_client.get_blob_client(blob_name).get_blob_properties()
+            if properties.content_settings.content_md5 == content_md5:
+                if self.verbose:
+                    print(f"\tSkipping blob {blob_name}, it's already up to date")
                 return
-            if path is None:
-                prefix = None
-                blobs = container_client.list_blob_names()
-            else:
-                prefix = os.path.splitext(os.path.basename(path))[0]
-                blobs = container_client.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0])
-            async for blob_path in blobs:
-                # This still supports PDFs split into individual pages, but we could remove in future to simplify code
-                if (prefix is not None and not re.match(rf"{prefix}-\d+\.pdf", blob_path)) or (
-                    path is not None and blob_path == os.path.basename(path)
-                ):
-                    continue
+        except ResourceNotFoundError:
+            pass
+
+        # Upload the original file, the content is rewound by content_md5
+        print(f"\tUploading blob for whole file -> {blob_name}")
+        await container_client.upload_blob(
+            blob_name,
+            file.content,
+            overwrite=True,
+            # Blobs uploaded in blocks don't get an MD5 from the service, so store the one computed locally
+            content_settings=ContentSettings(content_md5=bytearray(content_md5)),
+            max_concurrency=self.max_concurrency,
+        )
+
+    async def remove_blob(self, path: Optional[str] = None):
+        if not await self.check_container():
+            return
+        container_client = self.get_container_client()
+        if path is None:
+            prefix = None
+            blobs = container_client.list_blob_names()
+        else:
+            prefix = os.path.splitext(os.path.basename(path))[0]
+            blobs = container_client.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0])
+        async for blob_path in blobs:
+            # This still supports PDFs split into individual pages, but we could remove in future to simplify code
+            if (prefix is not None and not re.match(rf"{prefix}-\d+\.pdf", blob_path)) or (
+                path is not None and blob_path == os.path.basename(path)
+            ):
+                continue
+            if self.verbose:
+                print(f"\tRemoving blob {blob_path}")
+            await container_client.delete_blob(blob_path)
+
+    async def remove_blobs(self, paths: List[str]):
+        # Removes the blobs of many files with a single listing of the container, rather than one listing per file,
+        # and the same blobs remove_blob removes for each of them
+        if not paths or not await self.check_container():
+            return
+        prefixes = {os.path.splitext(os.path.basename(path))[0] for path in paths}
+        names = {os.path.basename(path) for path in paths}
+        container_client = self.get_container_client()
+        blob_paths = [
+            blob_path
+            async for blob_path in container_client.list_blob_names()
+            if blob_path not in names
+            and any(blob_path[: suffix.start()] in prefixes for suffix in PAGE_BLOB_SUFFIX.finditer(blob_path))
+        ]
+        semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+        async def delete_blob(blob_path: str):
+            async with semaphore:
                 if self.verbose:
                     print(f"\tRemoving blob {blob_path}")
                 await container_client.delete_blob(blob_path)
 
+        await asyncio.gather(*(delete_blob(blob_path) for blob_path in blob_paths))
+
     @classmethod
     def sourcepage_from_file_page(cls, filename, page=0) -> str:
         if os.path.splitext(filename)[1].lower() == ".pdf":
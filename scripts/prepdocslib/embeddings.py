@@ -1,6 +1,7 @@
+import asyncio
 import time
 from abc import ABC
-from typing import List, Optional, Union
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
 
 import tiktoken
 from azure.core.credentials import AccessToken, AzureKeyCredential
@@ -13,44 +14,83 @@ from tenacity import (
     wait_random_exponential,
 )
 
+from .embeddingcache import EmbeddingCache
+from .embeddingscheduler import (
+    RETRYABLE_ERRORS,
+    EmbeddingBatch,
+    EmbeddingBatchScheduler,
+)
 
-class EmbeddingBatch:
-    """
-    Represents a batch of text that is going to be embedded
-    """
-
-    def __init__(self, texts: List[str], token_length: int):
-        self.texts = texts
-        self.token_length = token_length
+# Azure AD tokens are renewed this many seconds before they expire, so requests in flight never carry an expired token
+TOKEN_REFRESH_MARGIN = 5 * 60
+# First GA version of the Azure OpenAI API accepting the dimensions parameter of text-embedding-3 models
+AZURE_OPENAI_API_VERSION = "2024-02-01"
 
 
 class OpenAIEmbeddings(ABC):
     """
     Contains common logic across both OpenAI and Azure OpenAI embedding services
     Can split source text into batches for more efficient embedding calls
+    text-embedding-3 models can return shorter embeddings of the given number of dimensions
     """
 
     SUPPORTED_BATCH_AOAI_MODEL = {
         "text-embedding-3-large": {"token_limit": 8100, "max_batch_size": 16}}
 
-    def __init__(self, open_ai_model_name: str, disable_batch: bool = False, verbose: bool = False):
+    def __init__(
+        self,
+        open_ai_model_name: str,
+        disable_batch: bool = False,
+        verbose: bool = False,
+        cache: Optional[EmbeddingCache] = None,
+        max_concurrency: int = 4,
+        dimensions: Optional[int] = None,
+    ):
         self.open_ai_model_name = open_ai_model_name
+        self.dimensions = dimensions
         self.disable_batch = disable_batch
         self.verbose = verbose
+        self.cache = cache
+        self.scheduler = EmbeddingBatchScheduler(max_concurrency=max_concurrency, verbose=verbose)
+        self.client: Optional[AsyncOpenAI] = None
+        self.encoding: Optional[tiktoken.Encoding] = None
 
     async def create_client(self) -> AsyncOpenAI:
         raise NotImplementedError
 
+    async def get_client(self) -> AsyncOpenAI:
+        # A single client (and HTTP connection pool) is kept for the lifetime of the service, so batches reuse
+        # connections instead of paying for a new TLS handshake every time
+        if self.client is None:
+            self.client = await self.create_client()
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
     def before_retry_sleep(self, retry_state):
         if self.verbose:
-            print(
-                "Rate limited on the OpenAI embeddings API, sleeping before retrying...")
+            error = retry_state.outcome.exception() if retry_state.outcome else None
+            if error is None or isinstance(error, RateLimitError):
+                print(
+                    "Rate limited on the OpenAI embeddings API, sleeping before retrying...")
+            else:
+                print(f"Error from the OpenAI embeddings API ({error}), sleeping before retrying...")
+
+    def dimensions_options(self) -> Dict[str, Any]:
+        # The installed openai version doesn't know the dimensions parameter yet, it's sent as an extra body field
+        return {"extra_body": {"dimensions": self.dimensions}} if self.dimensions else {}
 
     def calculate_token_length(self, text: str):
-        encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
-        return len(encoding.encode(text))
+        if self.encoding is None:
+            self.encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
+        return len(self.encoding.encode(text))
 
-    def split_text_into_batches(self, texts: List[str]) -> List[EmbeddingBatch]:
+    def split_text_into_batches(
+        self, texts: List[str], token_counts: Optional[List[Optional[int]]] = None
+    ) -> List[EmbeddingBatch]:
         batch_info = OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL.get(
             self.open_ai_model_name)
         if not batch_info:
@@ -63,8 +103,10 @@ class OpenAIEmbeddings(ABC):
         batches: List[EmbeddingBatch] = []
         batch: List[str] = []
         batch_token_length = 0
-        for text in texts:
-            text_token_length = self.calculate_token_length(text)
+        for i, text in enumerate(texts):
+            # Sections split by tokens already know their length
+            token_count = token_counts[i] if token_counts else None
+            text_token_length = token_count if token_count is not None else self.calculate_token_length(text)
             if batch_token_length + text_token_length >= batch_token_limit and len(batch) > 0:
                 batches.append(EmbeddingBatch(batch, batch_token_length))
                 batch = []
@@ -82,46 +124,70 @@ class OpenAIEmbeddings(ABC):
 
         return batches
 
-    async def create_embedding_batch(self, texts: List[str]) -> List[List[float]]:
-        batches = self.split_text_into_batches(texts)
-        embeddings = []
-        client = await self.create_client()
-        for batch in batches:
-            async for attempt in AsyncRetrying(
-                retry=retry_if_exception_type(RateLimitError),
-                wait=wait_random_exponential(min=15, max=60),
-                stop=stop_after_attempt(15),
-                before_sleep=self.before_retry_sleep,
-            ):
-                with attempt:
-                    emb_response = await client.embeddings.create(model=self.open_ai_model_name, input=batch.texts)
-                    embeddings.extend(
-                        [data.embedding for data in emb_response.data])
-                    if self.verbose:
-                        print(
-                            f"Batch Completed. Batch size  {len(batch.texts)} Token count {batch.token_length}")
-
-        return embeddings
+    async def create_embedding_batch(
+        self, texts: List[str], token_counts: Optional[List[Optional[int]]] = None
+    ) -> List[List[float]]:
+        batches = self.split_text_into_batches(texts, token_counts)
+        client = await self.get_client()
+
+        async def embed_batch(batch: EmbeddingBatch) -> Tuple[List[List[float]], Mapping[str, str]]:
+            # The raw response gives access to the rate limit headers used to pace the next batches
+            raw_response = await client.embeddings.with_raw_response.create(
+                model=self.open_ai_model_name, input=batch.texts, **self.dimensions_options()
+            )
+            emb_response = raw_response.parse()
+            if self.verbose:
+                print(f"Batch Completed. Batch size  {len(batch.texts)} Token count {batch.token_length}")
+            return [data.embedding for data in emb_response.data], raw_response.headers
+
+        return await self.scheduler.run(batches, embed_batch, before_sleep=self.before_retry_sleep)
 
     async def create_embedding_single(self, text: str) -> List[float]:
-        client = await self.create_client()
+        client = await self.get_client()
         async for attempt in AsyncRetrying(
-            retry=retry_if_exception_type(RateLimitError),
+            retry=retry_if_exception_type(RETRYABLE_ERRORS),
             wait=wait_random_exponential(min=15, max=60),
             stop=stop_after_attempt(15),
             before_sleep=self.before_retry_sleep,
         ):
             with attempt:
-                emb_response = await client.embeddings.create(model=self.open_ai_model_name, input=text)
+                emb_response = await client.embeddings.create(
+                    model=self.open_ai_model_name, input=text, **self.dimensions_options()
+                )
 
         return emb_response.data[0].embedding
 
-    async def create_embeddings(self, texts: List[str]) -> List[List[float]]:
+    async def compute_embeddings(
+        self, texts: List[str], token_counts: Optional[List[Optional[int]]] = None
+    ) -> List[List[float]]:
         if not self.disable_batch and self.open_ai_model_name in OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL:
-            return await self.create_embedding_batch(texts)
+            return await self.create_embedding_batch(texts, token_counts)
 
         return [await self.create_embedding_single(text) for text in texts]
 
+    async def create_embeddings(
+        self, texts: List[str], token_counts: Optional[List[Optional[int]]] = None
+    ) -> List[List[float]]:
+        if self.cache is None:
+            return await self.compute_embeddings(texts, token_counts)
+
+        # Look up the cache before batching so that only misses are sent to the API.
+        # Dimensions 0 means the model's native number of dimensions.
+        dimensions = self.dimensions or 0
+        cached = self.cache.get_many(self.open_ai_model_name, dimensions, texts)
+        missing_texts = list(dict.fromkeys(text for text, embedding in zip(texts, cached) if embedding is None))
+        if self.verbose:
+            print(f"Embedding cache hits: {len(texts) - len(missing_texts)}, misses: {len(missing_texts)}")
+        computed: Dict[str, List[float]] = {}
+        if missing_texts:
+            known_counts = dict(zip(texts, token_counts)) if token_counts else {}
+            missing_embeddings = await self.compute_embeddings(
+                missing_texts, [known_counts.get(text) for text in missing_texts]
+            )
+            self.cache.put_many(self.open_ai_model_name, dimensions, missing_texts, missing_embeddings)
+            computed = dict(zip(missing_texts, missing_embeddings))
+        return [embedding if embedding is not None else computed[text] for text, embedding in zip(texts, cached)]
+
 
 class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
     """
@@ -137,33 +203,85 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
         credential: Union[AsyncTokenCredential, AzureKeyCredential],
         disable_batch: bool = False,
         verbose: bool = False,
+        cache: Optional[EmbeddingCache] = None,
+        max_concurrency: int = 4,
+        dimensions: Optional[int] = None,
     ):
-        super().__init__(open_ai_model_name, disable_batch, verbose)
+        super().__init__(open_ai_model_name, disable_batch, verbose, cache, max_concurrency, dimensions)
         self.open_ai_service = open_ai_service
         self.open_ai_deployment = open_ai_deployment
         self.credential = credential
         self.cached_token: Optional[AccessToken] = None
+        self.token_lock: Optional[asyncio.Lock] = None
+        self.refresh_task: Optional[asyncio.Task] = None
 
     async def create_client(self) -> AsyncOpenAI:
-        return AsyncAzureOpenAI(
-            azure_endpoint=f"https://{self.open_ai_service}.openai.azure.com",
-            azure_deployment=self.open_ai_deployment,
-            api_key=await self.wrap_credential(),
-            api_version="2023-05-15",
-        )
+        if isinstance(self.credential, AzureKeyCredential):
+            return AsyncAzureOpenAI(
+                azure_endpoint=f"https://{self.open_ai_service}.openai.azure.com",
+                azure_deployment=self.open_ai_deployment,
+                api_key=self.credential.key,
+                api_version=AZURE_OPENAI_API_VERSION,
+                # Throttling and transient errors are retried by the batch scheduler and tenacity
+                max_retries=0,
+            )
+        if isinstance(self.credential, AsyncTokenCredential):
+            # The client asks for a token before every request, so a long-lived client always sends a valid one
+            return AsyncAzureOpenAI(
+                azure_endpoint=f"https://{self.open_ai_service}.openai.azure.com",
+                azure_deployment=self.open_ai_deployment,
+                azure_ad_token_provider=self.get_token,
+                api_version=AZURE_OPENAI_API_VERSION,
+                max_retries=0,
+            )
+        raise TypeError("Invalid credential type")
 
     async def wrap_credential(self) -> str:
         if isinstance(self.credential, AzureKeyCredential):
             return self.credential.key
 
         if isinstance(self.credential, AsyncTokenCredential):
-            if not self.cached_token or self.cached_token.expires_on <= time.time():
-                self.cached_token = await self.credential.get_token("https://cognitiveservices.azure.com/.default")
-
-            return self.cached_token.token
+            return await self.get_token()
 
         raise TypeError("Invalid credential type")
 
+    async def get_token(self) -> str:
+        now = time.time()
+        if not self.cached_token or self.cached_token.expires_on <= now:
+            await self.refresh_token()
+        elif self.cached_token.expires_on - now <= TOKEN_REFRESH_MARGIN and self.refresh_task is None:
+            # The token is still valid, keep using it while a new one is requested in the background
+            self.refresh_task = asyncio.create_task(self.refresh_token_in_background())
+        assert self.cached_token is not None
+        return self.cached_token.token
+
+    async def refresh_token(self):
+        if not isinstance(self.credential, AsyncTokenCredential):
+            raise TypeError("Invalid credential type")
+        if self.token_lock is None:
+            self.token_lock = asyncio.Lock()
+        async with self.token_lock:
+            # Another request may have renewed the token while this one was waiting for the lock
+            if self.cached_token and self.cached_token.expires_on - time.time() > TOKEN_REFRESH_MARGIN:
+                return
+            self.cached_token = await self.credential.get_token("https://cognitiveservices.azure.com/.default")
+
+    async def refresh_token_in_background(self):
+        try:
+            await self.refresh_token()
+        except Exception as error:
+            # The cached token is still valid for a few minutes, the next request will try again
+            if self.verbose:
+                print(f"Unable to refresh the Azure OpenAI token ahead of its expiry: {error}")
+        finally:
+            self.refresh_task = None
+
+    async def close(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+            self.refresh_task = None
+        await super().close()
+
 
 class OpenAIEmbeddingService(OpenAIEmbeddings):
     """
@@ -178,10 +296,13 @@ class OpenAIEmbeddingService(OpenAIEmbeddings):
         organization: Optional[str] = None,
         disable_batch: bool = False,
         verbose: bool = False,
+        cache: Optional[EmbeddingCache] = None,
+        max_concurrency: int = 4,
+        dimensions: Optional[int] = None,
     ):
-        super().__init__(open_ai_model_name, disable_batch, verbose)
+        super().__init__(open_ai_model_name, disable_batch, verbose, cache, max_concurrency, dimensions)
         self.credential = credential
         self.organization = organization
 
     async def create_client(self) -> AsyncOpenAI:
-        return AsyncOpenAI(api_key=self.credential, organization=self.organization)
+        return AsyncOpenAI(api_key=self.credential, organization=self.organization, max_retries=0)
@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Dict, Optional, Tuple
+
+# Size of the chunks read from a file while hashing it
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class FileState:
+    """
+    Size, modification time and content hash of a local file when it was listed
+    """
+
+    def __init__(self, path: str, size: int, mtime_ns: int, sha256: str):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.sha256 = sha256
+
+
+class FileManifest:
+    """
+    Record of the local files that were fully ingested, stored in a single local SQLite file, so that re-running
+    prepdocs skips files that haven't changed.
+    A file whose size and modification time match its entry is unchanged without being read. Otherwise its sha256 is
+    computed by streaming the file, and only a different hash counts as a change.
+    Files are only recorded by commit, once they're indexed, so a file that failed is ingested again on the next run.
+    """
+
+    def __init__(self, path: str, verbose: bool = False):
+        self.path = path
+        self.verbose = verbose
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                indexed_at REAL NOT NULL
+            )
+            """)
+        self.connection.commit()
+        # States of the changed files that were listed but aren't indexed yet, by path
+        self.pending: Dict[str, FileState] = {}
+
+    @classmethod
+    def file_sha256(cls, path: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def get(self, path: str) -> Optional[Tuple[int, int, str]]:
+        return self.connection.execute(
+            "SELECT size, mtime_ns, sha256 FROM files WHERE path = ?", (os.path.abspath(path),)
+        ).fetchone()
+
+    async def has_changed(self, path: str) -> bool:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.get(path)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return False
+
+        # Hashing reads the whole file, keep it off the event loop
+        sha256 = await asyncio.to_thread(self.file_sha256, path)
+        state = FileState(path, stat.st_size, stat.st_mtime_ns, sha256)
+        if entry is not None and entry[2] == sha256:
+            # Touched but not modified, refresh the entry so the next run takes the fast path
+            self.save(state)
+            return False
+        self.pending[path] = state
+        return True
+
+    def commit(self, path: str):
+        state = self.pending.pop(os.path.abspath(path), None)
+        if state is not None:
+            self.save(state)
+
+    def save(self, state: FileState):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256, indexed_at) VALUES (?, ?, ?, ?, ?)",
+            (state.path, state.size, state.mtime_ns, state.sha256, time.time()),
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -1,14 +1,22 @@
+import asyncio
 from enum import Enum
-from typing import Optional
+from typing import Dict, List, Optional
+
+from azure.search.documents.aio import SearchClient
 
 from .blobmanager import BlobManager
 from .embeddings import OpenAIEmbeddings
-from .listfilestrategy import ListFileStrategy
-from .pdfparser import PdfParser
-from .searchmanager import SearchManager, Section
+from .listfilestrategy import File, ListFileStrategy
+from .pdfparser import Page, PdfParser
+from .pipeline import Pipeline, PipelineStage
+from .searchmanager import ContentUpdate, SearchManager, Section
+from .searchuploader import SearchDocumentUploader
 from .strategy import SearchInfo, Strategy
 from .textsplitter import TextSplitter
 
+# Number of workers of each stage of the ingestion pipeline, unless overridden with stage_workers
+DEFAULT_STAGE_WORKERS = {"parse": 2, "split": 1, "embed": 2, "index": 2, "blob": 2}
+
 
 class DocumentAction(Enum):
     Add = 0
@@ -16,6 +24,18 @@ class DocumentAction(Enum):
     RemoveAll = 2
 
 
+class FileIngestion:
+    """
+    State of a single file as it moves through the stages of the ingestion pipeline
+    """
+
+    def __init__(self, file: File):
+        self.file = file
+        self.pages: List[Page] = []
+        self.sections: List[Section] = []
+        self.update: Optional[ContentUpdate] = None
+
+
 class FileStrategy(Strategy):
     """
     Strategy for ingesting documents into a search service from files stored either locally or in a data lake storage account
@@ -32,6 +52,8 @@ class FileStrategy(Strategy):
         search_analyzer_name: Optional[str] = None,
         use_acls: bool = False,
         category: Optional[str] = None,
+        stage_workers: Optional[Dict[str, int]] = None,
+        search_uploader: Optional[SearchDocumentUploader] = None,
     ):
         self.list_file_strategy = list_file_strategy
         self.blob_manager = blob_manager
@@ -42,34 +64,105 @@ class FileStrategy(Strategy):
         self.search_analyzer_name = search_analyzer_name
         self.use_acls = use_acls
         self.category = category
+        self.stage_workers = {**DEFAULT_STAGE_WORKERS, **(stage_workers or {})}
+        self.search_uploader = search_uploader
+        # Time spent in each stage of the ingestion pipeline during the last run
+        self.stage_seconds: Dict[str, float] = {}
 
     async def setup(self, search_info: SearchInfo):
-        search_manager = SearchManager(search_info, self.search_analyzer_name, self.use_acls, self.embeddings)
+        search_manager = SearchManager(
+            search_info, self.search_analyzer_name, self.use_acls, self.embeddings, self.search_uploader
+        )
         await search_manager.create_index()
 
     async def run(self, search_info: SearchInfo):
-        search_manager = SearchManager(search_info, self.search_analyzer_name, self.use_acls, self.embeddings)
-        if self.document_action == DocumentAction.Add:
-            files = self.list_file_strategy.list()
-            async for file in files:
-                try:
-                    pages = [page async for page in self.pdf_parser.parse(content=file.content)]
-                    if search_info.verbose:
-                        print(f"Splitting '{file.filename()}' into sections")
-                    sections = [
-                        Section(split_page, content=file, category=self.category)
-                        for split_page in self.text_splitter.split_pages(pages)
-                    ]
-                    await search_manager.update_content(sections)
-                    await self.blob_manager.upload_blob(file)
-                finally:
-                    if file:
-                        file.close()
-        elif self.document_action == DocumentAction.Remove:
-            paths = self.list_file_strategy.list_paths()
-            async for path in paths:
-                await self.blob_manager.remove_blob(path)
-                await search_manager.remove_content(path)
-        elif self.document_action == DocumentAction.RemoveAll:
-            await self.blob_manager.remove_blob()
-            await search_manager.remove_content()
+        search_manager = SearchManager(
+            search_info, self.search_analyzer_name, self.use_acls, self.embeddings, self.search_uploader
+        )
+        try:
+            if self.document_action == DocumentAction.Add:
+                async with search_info.create_search_client() as search_client:
+                    await self.ingest_files(search_info, search_manager, search_client)
+            elif self.document_action == DocumentAction.Remove:
+                paths = [path async for path in self.list_file_strategy.list_paths()]
+                # The blobs and the sections of all the files are looked up and deleted together
+                await self.blob_manager.remove_blobs(paths)
+                await search_manager.remove_contents(paths)
+            elif self.document_action == DocumentAction.RemoveAll:
+                await self.blob_manager.remove_blob()
+                await search_manager.remove_content()
+        finally:
+            self.pdf_parser.close()
+            await self.blob_manager.close()
+            if self.embeddings:
+                await self.embeddings.close()
+                if self.embeddings.cache:
+                    self.embeddings.cache.close()
+
+    async def ingest_files(self, search_info: SearchInfo, search_manager: SearchManager, search_client: SearchClient):
+        # Files go through parse -> split -> embed -> index -> blob, with every stage working on a different file
+        async def parse(item: FileIngestion) -> FileIngestion:
+            item.pages = [
+                page async for page in self.pdf_parser.parse(content=item.file.content, filename=item.file.filename())
+            ]
+            return item
+
+        async def split(item: FileIngestion) -> FileIngestion:
+            if search_info.verbose:
+                print(f"Splitting '{item.file.filename()}' into sections")
+
+            def split_sections() -> List[Section]:
+                return [
+                    Section(split_page, content=item.file, category=self.category)
+                    for split_page in self.text_splitter.split_pages(item.pages)
+                ]
+
+            # Splitting is CPU bound, run it in a thread so the other stages keep making network calls
+            item.sections = await asyncio.to_thread(split_sections)
+            item.pages = []
+            return item
+
+        async def embed(item: FileIngestion) -> FileIngestion:
+            item.update = await search_manager.prepare_update(search_client, item.sections)
+            await search_manager.embed_update(item.update)
+            item.sections = []
+            return item
+
+        async def index(item: FileIngestion) -> FileIngestion:
+            if item.update:
+                await search_manager.apply_update(search_client, item.update)
+            item.update = None
+            return item
+
+        async def upload_blob(item: FileIngestion) -> FileIngestion:
+            await self.blob_manager.upload_blob(item.file)
+            return item
+
+        async def on_done(item: FileIngestion, stage: Optional[str], error: Optional[Exception]):
+            item.file.close()
+            if error is not None:
+                print(f"Error ingesting '{item.file.filename()}' in the {stage} stage, skipping it: {error!r}")
+            else:
+                # Only now is the file recorded as ingested, a file that failed is picked up again on the next run
+                self.list_file_strategy.commit(item.file)
+
+        async def files():
+            async for file in self.list_file_strategy.list():
+                yield FileIngestion(file)
+
+        pipeline = Pipeline(
+            [
+                PipelineStage("parse", parse, self.stage_workers["parse"]),
+                PipelineStage("split", split, self.stage_workers["split"]),
+                PipelineStage("embed", embed, self.stage_workers["embed"]),
+                PipelineStage("index", index, self.stage_workers["index"]),
+                PipelineStage("blob", upload_blob, self.stage_workers["blob"]),
+            ]
+        )
+        failures = await pipeline.run(files(), on_done)
+        self.stage_seconds = pipeline.stage_seconds
+        report = search_manager.uploader.report()
+        if search_info.verbose and report:
+            print(report)
+        if failures:
+            raise RuntimeError(f"{failures} file(s) couldn't be ingested, see the errors above")
@@ -1,17 +1,23 @@
+import asyncio
 import base64
-import hashlib
 import os
 import re
 import tempfile
 from abc import ABC
+from collections import deque
 from glob import glob
-from typing import IO, AsyncGenerator, Dict, List, Optional, Union
+from typing import IO, AsyncGenerator, Deque, Dict, List, Optional, Union
 
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.storage.filedatalake.aio import (
     DataLakeServiceClient,
 )
 
+from .filemanifest import FileManifest
+
+# Downloaded files are kept in memory up to this size, larger ones roll over to an anonymous temporary file
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
 
 class File:
     """
@@ -19,12 +25,14 @@ class File:
     This file might contain access control information about which users or groups can access it
     """
 
-    def __init__(self, content: IO, acls: Optional[dict[str, list]] = None):
+    def __init__(self, content: IO, acls: Optional[dict[str, list]] = None, name: Optional[str] = None):
         self.content = content
         self.acls = acls or {}
+        # Path of the file, for content that isn't opened from that path (e.g. a download spooled in memory)
+        self.name = name
 
     def filename(self):
-        return os.path.basename(self.content.name)
+        return os.path.basename(self.name or self.content.name)
 
     def filename_to_id(self):
         filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", self.filename())
@@ -49,15 +57,21 @@ class ListFileStrategy(ABC):
         if False:  # pragma: no cover - this is necessary for mypy to type check
             yield
 
+    def commit(self, file: File):
+        # Called once a listed file has been fully ingested
+        pass
+
 
 class LocalListFileStrategy(ListFileStrategy):
     """
     Concrete strategy for listing files that are located in a local filesystem
     """
 
-    def __init__(self, path_pattern: str, verbose: bool = False):
+    def __init__(self, path_pattern: str, verbose: bool = False, manifest: Optional[FileManifest] = None):
         self.path_pattern = path_pattern
         self.verbose = verbose
+        # Without a manifest every file is listed, with one only the files that changed since they were ingested
+        self.manifest = manifest
 
     async def list_paths(self) -> AsyncGenerator[str, None]:
         async for p in self._list_paths(self.path_pattern):
@@ -74,33 +88,18 @@ class LocalListFileStrategy(ListFileStrategy):
 
     async def list(self) -> AsyncGenerator[File, None]:
         async for path in self.list_paths():
-            if not self.check_md5(path):
-                yield File(content=open(path, mode="rb"))
-
-    def check_md5(self, path: str) -> bool:
-        # if filename ends in .md5 skip
-        if path.endswith(".md5"):
-            return True
+            # Skip the .md5 files that older versions of this script wrote next to each source file
+            if path.endswith(".md5"):
+                continue
+            if self.manifest and not await self.manifest.has_changed(path):
+                if self.verbose:
+                    print(f"Skipping {path}, no changes detected.")
+                continue
+            yield File(content=open(path, mode="rb"))
 
-        # if there is a file called .md5 in this directory, see if its updated
-        stored_hash = None
-        with open(path, "rb") as file:
-            existing_hash = hashlib.md5(file.read()).hexdigest()
-        hash_path = f"{path}.md5"
-        if os.path.exists(hash_path):
-            with open(hash_path, encoding="utf-8") as md5_f:
-                stored_hash = md5_f.read()
-
-        if stored_hash and stored_hash.strip() == existing_hash.strip():
-            if self.verbose:
-                print(f"Skipping {path}, no changes detected.")
-            return True
-
-        # Write the hash
-        with open(hash_path, "w", encoding="utf-8") as md5_f:
-            md5_f.write(existing_hash)
-
-        return False
+    def commit(self, file: File):
+        if self.manifest:
+            self.manifest.commit(file.content.name)
 
 
 class ADLSGen2ListFileStrategy(ListFileStrategy):
@@ -115,12 +114,15 @@ class ADLSGen2ListFileStrategy(ListFileStrategy):
         data_lake_path: str,
         credential: Union[AsyncTokenCredential, str],
         verbose: bool = False,
+        max_concurrency: int = 4,
     ):
         self.data_lake_storage_account = data_lake_storage_account
         self.data_lake_filesystem = data_lake_filesystem
         self.data_lake_path = data_lake_path
         self.credential = credential
         self.verbose = verbose
+        # Number of files downloaded ahead of the consumer at once
+        self.max_concurrency = max(1, max_concurrency)
 
     async def list_paths(self) -> AsyncGenerator[str, None]:
         async with DataLakeServiceClient(
@@ -132,40 +134,71 @@ class ADLSGen2ListFileStrategy(ListFileStrategy):
 
                 yield path.name
 
+    @classmethod
+    def parse_acls(cls, acl_list: str) -> Dict[str, List[str]]:
+        # Parse out user ids and group ids
+        acls: Dict[str, List[str]] = {"oids": [], "groups": []}
+        # https://learn.microsoft.com/azure/storage/blobs/data-lake-storage-access-control
+        # ACL Format: user::rwx,group::r-x,other::r--,user:xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx:r--
+        for acl in acl_list.split(","):
+            acl_parts: list = acl.split(":")
+            if len(acl_parts) != 3:
+                continue
+            if len(acl_parts[1]) == 0:
+                continue
+            if acl_parts[0] == "user" and "r" in acl_parts[2]:
+                acls["oids"].append(acl_parts[1])
+            if acl_parts[0] == "group" and "r" in acl_parts[2]:
+                acls["groups"].append(acl_parts[1])
+        return acls
+
+    async def download(self, file_client, path: str) -> Optional[File]:
+        # The content never gets a name in the temporary directory, so files with the same basename can't clobber
+        # each other, and it's deleted as soon as the File is closed
+        content = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        try:
+            async with file_client:
+
+                async def download_content():
+                    downloader = await file_client.download_file()
+                    await downloader.readinto(content)
+
+                # The ACLs are fetched while the content downloads
+                # https://learn.microsoft.com/python/api/azure-storage-file-datalake/azure.storage.filedatalake.datalakefileclient?view=azure-python#azure-storage-filedatalake-datalakefileclient-get-access-control
+                # Request ACLs as GUIDs
+                _, access_control = await asyncio.gather(download_content(), file_client.get_access_control(upn=False))
+            content.seek(0)
+            return File(content=content, acls=self.parse_acls(access_control["acl"]), name=path)
+        except Exception as data_lake_exception:
+            content.close()
+            print(f"\tGot an error while reading {path} -> {data_lake_exception} --> skipping file")
+            return None
+        except asyncio.CancelledError:
+            content.close()
+            raise
+
     async def list(self) -> AsyncGenerator[File, None]:
         async with DataLakeServiceClient(
             account_url=f"https://{self.data_lake_storage_account}.dfs.core.windows.net", credential=self.credential
         ) as service_client, service_client.get_file_system_client(self.data_lake_filesystem) as filesystem_client:
-            async for path in self.list_paths():
-                temp_file_path = os.path.join(tempfile.gettempdir(), os.path.basename(path))
-                try:
-                    async with filesystem_client.get_file_client(path) as file_client:
-                        with open(temp_file_path, "wb") as temp_file:
-                            downloader = await file_client.download_file()
-                            await downloader.readinto(temp_file)
-                    # Parse out user ids and group ids
-                    acls: Dict[str, List[str]] = {"oids": [], "groups": []}
-                    # https://learn.microsoft.com/python/api/azure-storage-file-datalake/azure.storage.filedatalake.datalakefileclient?view=azure-python#azure-storage-filedatalake-datalakefileclient-get-access-control
-                    # Request ACLs as GUIDs
-                    access_control = await file_client.get_access_control(upn=False)
-                    acl_list = access_control["acl"]
-                    # https://learn.microsoft.com/azure/storage/blobs/data-lake-storage-access-control
-                    # ACL Format: user::rwx,group::r-x,other::r--,user:xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx:r--
-                    acl_list = acl_list.split(",")
-                    for acl in acl_list:
-                        acl_parts: list = acl.split(":")
-                        if len(acl_parts) != 3:
-                            continue
-                        if len(acl_parts[1]) == 0:
-                            continue
-                        if acl_parts[0] == "user" and "r" in acl_parts[2]:
-                            acls["oids"].append(acl_parts[1])
-                        if acl_parts[0] == "group" and "r" in acl_parts[2]:
-                            acls["groups"].append(acl_parts[1])
-                    yield File(content=open(temp_file_path, "rb"), acls=acls)
-                except Exception as data_lake_exception:
-                    print(f"\tGot an error while reading {path} -> {data_lake_exception} --> skipping file")
-                    try:
-                        os.remove(temp_file_path)
-                    except Exception as file_delete_exception:
-                        print(f"\tGot an error while deleting {temp_file_path} -> {file_delete_exception}")
+            # Files are downloaded ahead of the consumer, at most max_concurrency at a time, and yielded in the
+            # order they're listed
+            downloads: Deque[asyncio.Task] = deque()
+            try:
+                async for path in self.list_paths():
+                    downloads.append(asyncio.create_task(self.download(filesystem_client.get_file_client(path), path)))
+                    if len(downloads) >= self.max_concurrency:
+                        file = await downloads.popleft()
+                        if file:
+                            yield file
+                while downloads:
+                    file = await downloads.popleft()
+                    if file:
+                        yield file
+            finally:
+                # The consumer stopped early, don't leave downloads or their content behind
+                for task in downloads:
+                    task.cancel()
+                for result in await asyncio.gather(*downloads, return_exceptions=True):
+                    if isinstance(result, File):
+                        result.close()
@@ -0,0 +1,810 @@
+import asyncio
+import itertools
+import json
+import math
+import os
+import re
+import threading
+import uuid
+from collections import Counter
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.models import VectorQuery
+
+from .strategy import SearchInfo
+
+# File of a local index listing its documents and the file holding their embeddings
+DOCUMENTS_FILE = "documents.json"
+# Defaults of the BM25 similarity of Azure AI Search
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Constant of reciprocal rank fusion, the same as Azure AI Search uses for hybrid queries
+RRF_K = 60
+# Number of results of each query that take part in the fusion of a hybrid query
+HYBRID_CANDIDATES = 50
+# Number of results when a query doesn't set top, as for Azure AI Search
+DEFAULT_TOP = 50
+# Indexes with at least this many vectors are searched through an inverted file of clusters instead of exhaustively
+IVF_MIN_VECTORS = 20000
+# Number of clusters an IVF search looks into
+IVF_PROBES = 8
+# Compressions of the embeddings of a local index: int8 scalar quantization or one bit per dimension
+VECTOR_COMPRESSIONS = ("scalar", "binary")
+# Compressed indexes rescore this many times the number of requested results with the full precision vectors
+RESCORE_OVERSAMPLING = 4
+# Updated documents leave their previous row behind, the derived structures are built again once this share of the rows
+# is stale
+STALE_ROWS_REBUILD = 0.5
+# Number of bits set in each byte, to count the differing bits of binary quantized vectors
+POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+TOKEN_PATTERN = re.compile(r"\w+")
+SENTENCE_PATTERN = re.compile(r"[^.!?\n]+[.!?]?")
+FILTER_TOKEN_PATTERN = re.compile(
+    r"""\s*(?:
+    (?P<any>(?P<collection>\w+)/any\(\s*(?P<variable>\w+)\s*:\s*search\.in\(\s*(?P=variable)\s*,\s*
+        '(?P<values>(?:[^']|'')*)'(?:\s*,\s*'(?P<delimiters>(?:[^']|'')*)')?\s*\)\s*\))
+    |(?P<comparison>(?P<field>\w+)\s+(?P<operator>eq|ne)\s+(?:'(?P<value>(?:[^']|'')*)'|(?P<null>null)))
+    |(?P<keyword>and|or|not)\b
+    |(?P<paren>[()])
+    )""",
+    re.VERBOSE,
+)
+
+Document = Dict[str, Any]
+Predicate = Callable[[Document], bool]
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class LocalSearchFilter:
+    """
+    Parser of the subset of OData filter expressions the app and prepdocs send: eq and ne comparisons of a field with
+    a string or null, search.in over a collection field with any(), combined with and, or, not and parentheses
+    """
+
+    def __init__(self, filter: str):
+        self.filter = filter
+        self.tokens = self.tokenize(filter)
+        self.position = 0
+        self.predicate = self.parse_or()
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unsupported filter: {filter}")
+
+    @classmethod
+    def tokenize(cls, filter: str) -> List[Tuple[str, Any]]:
+        tokens: List[Tuple[str, Any]] = []
+        position = 0
+        filter = filter.rstrip()
+        while position < len(filter):
+            match = FILTER_TOKEN_PATTERN.match(filter, position)
+            if not match:
+                raise ValueError(f"Unsupported filter: {filter}")
+            position = match.end()
+            if match.group("any"):
+                delimiters = (match.group("delimiters") or " ,").replace("''", "'")
+                values = re.split("[" + re.escape(delimiters) + "]", match.group("values").replace("''", "'"))
+                tokens.append(("any", (match.group("collection"), {value for value in values if value})))
+            elif match.group("comparison"):
+                value = None if match.group("null") else match.group("value").replace("''", "'")
+                tokens.append(("comparison", (match.group("field"), match.group("operator"), value)))
+            else:
+                tokens.append((match.group("keyword") or match.group("paren"), None))
+        return tokens
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def parse_or(self) -> Predicate:
+        predicates = [self.parse_and()]
+        while self.peek() == "or":
+            self.position += 1
+            predicates.append(self.parse_and())
+        return predicates[0] if len(predicates) == 1 else lambda document: any(p(document) for p in predicates)
+
+    def parse_and(self) -> Predicate:
+        predicates = [self.parse_not()]
+        while self.peek() == "and":
+            self.position += 1
+            predicates.append(self.parse_not())
+        return predicates[0] if len(predicates) == 1 else lambda document: all(p(document) for p in predicates)
+
+    def parse_not(self) -> Predicate:
+        kind = self.peek()
+        if kind is None:
+            raise ValueError(f"Unsupported filter: {self.filter}")
+        token = self.tokens[self.position]
+        self.position += 1
+        if kind == "not":
+            predicate = self.parse_not()
+            return lambda document: not predicate(document)
+        if kind == "(":
+            predicate = self.parse_or()
+            if self.peek() != ")":
+                raise ValueError(f"Unsupported filter: {self.filter}")
+            self.position += 1
+            return predicate
+        if kind == "any":
+            collection, values = token[1]
+            return lambda document: any(item in values for item in document.get(collection) or [])
+        if kind == "comparison":
+            field, operator, value = token[1]
+            if operator == "eq":
+                return lambda document: document.get(field) == value
+            return lambda document: document.get(field) != value
+        raise ValueError(f"Unsupported filter: {self.filter}")
+
+    def __call__(self, document: Document) -> bool:
+        return self.predicate(document)
+
+
+class LocalIndexingResult:
+    """
+    Outcome of a document change, with the attributes of the SDK's IndexingResult
+    """
+
+    def __init__(self, key: str, status_code: int = 200, error_message: Optional[str] = None):
+        self.key = key
+        self.status_code = status_code
+        self.succeeded = status_code in (200, 201)
+        self.error_message = error_message
+
+
+class LocalCaption:
+    """
+    Extractive caption of a result, with the attributes of the SDK's CaptionResult
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.highlights: Optional[str] = None
+
+
+class GrowingArray:
+    """
+    Array that rows are appended to in amortized constant time, by doubling the capacity of its buffer
+    """
+
+    def __init__(self, initial: np.ndarray):
+        self.buffer = np.array(initial)
+        self.size = len(initial)
+
+    def append(self, rows: np.ndarray) -> np.ndarray:
+        size = self.size + len(rows)
+        if size > len(self.buffer):
+            buffer = np.empty((max(size, 2 * len(self.buffer)),) + self.buffer.shape[1:], dtype=self.buffer.dtype)
+            buffer[: self.size] = self.buffer[: self.size]
+            self.buffer = buffer
+        self.buffer[self.size : size] = rows
+        self.size = size
+        return self.buffer[:size]
+
+
+class LocalSearchIndex:
+    """
+    Search index stored in a local directory, for small indexes that can be searched in process instead of on an
+    Azure AI Search service. The fields of the documents are stored in a JSON file and their embeddings in a float32
+    matrix that is memory-mapped for searching. Text queries are ranked with BM25 over an inverted index, vector
+    queries by cosine similarity, exhaustively or through an inverted file (IVF) of k-means clusters for larger
+    indexes, and hybrid queries are merged with reciprocal rank fusion.
+    With a compression, the embeddings are also stored scalar (int8) or binary quantized. Vector queries scan the
+    compressed matrix and only read the full precision embeddings of the best matches, to rescore them.
+    Embeddings are never returned in results, as the embedding field of the Azure AI Search index isn't retrievable.
+    Changes are kept in memory until save, which writes new files and swaps them in atomically, so other processes
+    can keep searching the index while it's updated. There should only be one writer at a time.
+    The inverted index and the matrix searched are updated in place by changes: a changed document gets a new row and
+    its previous row is left out of searches, until stale rows are a large share of the index and it's built again.
+    Searches of vectors changed in memory are exact, only the stored matrix is searched through its compressed vectors.
+    """
+
+    def __init__(self, directory: str, ivf_min_vectors: int = IVF_MIN_VECTORS, ivf_probes: int = IVF_PROBES):
+        self.directory = directory
+        self.ivf_min_vectors = ivf_min_vectors
+        self.ivf_probes = ivf_probes
+        self.documents: Dict[str, Document] = {}
+        self.vectors: Dict[str, np.ndarray] = {}
+        self.loaded_version: Optional[Tuple[int, int]] = None
+        self.compression: Optional[str] = None
+        self.vectors_file: Optional[str] = None
+        self.quantized_file: Optional[str] = None
+        self.mapped_matrix: Optional[np.ndarray] = None
+        self.mapped_codes: Optional[np.ndarray] = None
+        self.dirty = False
+        # Searches may run in worker threads while the event loop changes the index
+        self.lock = threading.RLock()
+        self.invalidate()
+
+    def invalidate(self):
+        # Structures derived from the documents, built again on the next search
+        self.rows: Optional[List[Document]] = None
+        self.row_ids: Dict[str, int] = {}
+        self.alive: Optional[np.ndarray] = None
+        self.stale_rows = 0
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.lengths: Optional[np.ndarray] = None
+        self.growing: Dict[str, GrowingArray] = {}
+        self.matrix: Optional[np.ndarray] = None
+        self.vector_rows: Optional[np.ndarray] = None
+        self.norms: Optional[np.ndarray] = None
+        self.codes: Optional[np.ndarray] = None
+        self.centroids: Optional[np.ndarray] = None
+        self.clusters: List[np.ndarray] = []
+
+    @property
+    def documents_path(self) -> str:
+        return os.path.join(self.directory, DOCUMENTS_FILE)
+
+    def version(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.documents_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load(self):
+        with self.lock:
+            self.load_version()
+
+    def load_version(self):
+        # Reads the index again if another process saved it since it was last read, unless there are unsaved changes
+        version = self.version()
+        if self.dirty or version == self.loaded_version:
+            return
+        self.documents = {}
+        self.vectors = {}
+        self.vectors_file = None
+        self.quantized_file = None
+        self.mapped_matrix = None
+        self.mapped_codes = None
+        if version is not None:
+            with open(self.documents_path, encoding="utf-8") as documents_file:
+                stored = json.load(documents_file)
+            self.compression = stored.get("compression")
+            self.vectors_file = stored.get("vectors")
+            if self.vectors_file:
+                self.mapped_matrix = np.load(os.path.join(self.directory, self.vectors_file), mmap_mode="r")
+            self.quantized_file = stored.get("quantized")
+            if self.quantized_file:
+                self.mapped_codes = np.load(os.path.join(self.directory, self.quantized_file), mmap_mode="r")
+            for document in stored["documents"]:
+                row = document.pop("@row", None)
+                self.documents[document["id"]] = document
+                if row is not None and self.mapped_matrix is not None:
+                    self.vectors[document["id"]] = self.mapped_matrix[row]
+        self.loaded_version = version
+        self.invalidate()
+
+    def save(self):
+        with self.lock:
+            self.save_changes()
+
+    def save_changes(self):
+        if not self.dirty:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        stored_documents = []
+        vectors: List[np.ndarray] = []
+        for id, document in self.documents.items():
+            if id in self.vectors:
+                document = {**document, "@row": len(vectors)}
+                vectors.append(self.vectors[id])
+            stored_documents.append(document)
+        vectors_file = None
+        quantized_file = None
+        if vectors:
+            version = uuid.uuid4().hex
+            matrix = np.stack(vectors).astype(np.float32)
+            vectors_file = f"vectors-{version}.npy"
+            np.save(os.path.join(self.directory, vectors_file), matrix)
+            if self.compression:
+                quantized_file = f"vectors-{version}.{self.compression}.npy"
+                np.save(os.path.join(self.directory, quantized_file), self.quantize(matrix))
+        temporary_path = f"{self.documents_path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as documents_file:
+            json.dump(
+                {
+                    "compression": self.compression,
+                    "vectors": vectors_file,
+                    "quantized": quantized_file,
+                    "documents": stored_documents,
+                },
+                documents_file,
+            )
+        os.replace(temporary_path, self.documents_path)
+        # Searches in progress in other processes keep their mapping of the previous matrix
+        for previous_file in (self.vectors_file, self.quantized_file):
+            if previous_file and previous_file not in (vectors_file, quantized_file):
+                try:
+                    os.remove(os.path.join(self.directory, previous_file))
+                except OSError:
+                    pass
+        self.vectors_file = vectors_file
+        self.quantized_file = quantized_file
+        # Read back on the next search, to search the memory-mapped matrix that was just written
+        self.loaded_version = None
+        self.dirty = False
+
+    def set_vector(self, id: str, embedding: Any):
+        vector = np.asarray(embedding, dtype=np.float32)
+        dimensions = next((len(other) for other in self.vectors.values()), len(vector))
+        if vector.ndim != 1 or len(vector) != dimensions:
+            raise ValueError(f"Document {id} has an embedding of {len(vector)} dimensions instead of {dimensions}")
+        self.vectors[id] = vector
+
+    def index(self, action: str, documents: List[Document]) -> List[LocalIndexingResult]:
+        with self.lock:
+            self.load()
+            self.dirty = True
+            try:
+                results = self.apply(action, documents)
+            except Exception:
+                # Partly applied, the derived structures are built again from the documents
+                self.invalidate()
+                raise
+            self.update_rows([result.key for result in results if result.succeeded])
+            return results
+
+    def merge_or_upload(self, documents: List[Document]) -> List[LocalIndexingResult]:
+        with self.lock:
+            self.load()
+            new = [document for document in documents if document["id"] not in self.documents]
+            existing = [document for document in documents if document["id"] in self.documents]
+            return self.index("upload", new) + self.index("merge", existing)
+
+    def count(self) -> int:
+        with self.lock:
+            self.load()
+            return len(self.documents)
+
+    def create(self, compression: Optional[str]):
+        with self.lock:
+            self.load()
+            self.compression = compression
+            self.dirty = True
+            self.save()
+
+    def apply(self, action: str, documents: List[Document]) -> List[LocalIndexingResult]:
+        results = []
+        for document in documents:
+            id = document["id"]
+            status_code = 200
+            if action == "delete":
+                self.documents.pop(id, None)
+                self.vectors.pop(id, None)
+            elif action == "merge" and id not in self.documents:
+                status_code = 404
+            else:
+                fields = {key: value for key, value in document.items() if key != "embedding"}
+                if action == "upload":
+                    self.documents[id] = fields
+                    self.vectors.pop(id, None)
+                else:
+                    self.documents[id].update(fields)
+                if document.get("embedding") is not None:
+                    self.set_vector(id, document["embedding"])
+            results.append(LocalIndexingResult(id, status_code, "Document not found." if status_code == 404 else None))
+        return results
+
+    def extend(self, name: str, rows: np.ndarray):
+        # Appends to a derived array, copied once to a growing buffer if it was built or memory-mapped as a whole
+        if name not in self.growing:
+            current = getattr(self, name)
+            self.growing[name] = GrowingArray(rows[:0] if current is None else current)
+        setattr(self, name, self.growing[name].append(rows))
+
+    def update_rows(self, ids: List[str]):
+        # Updates the derived structures in place for the changed documents, instead of building them again
+        if self.rows is None:
+            return
+        assert self.alive is not None
+        ids = list(dict.fromkeys(ids))
+        for id in ids:
+            row = self.row_ids.pop(id, None)
+            if row is not None:
+                self.alive[row] = False
+                self.stale_rows += 1
+        if self.stale_rows > STALE_ROWS_REBUILD * len(self.rows):
+            self.invalidate()
+            return
+        documents = [self.documents[id] for id in ids if id in self.documents]
+        first_row = len(self.rows)
+        lengths = self.add_rows(documents)
+        self.extend("lengths", np.asarray(lengths, dtype=np.float32))
+        self.extend("alive", np.ones(len(documents), dtype=bool))
+
+        vector_rows = [
+            first_row + offset for offset, document in enumerate(documents) if document["id"] in self.vectors
+        ]
+        if not vector_rows:
+            return
+        vectors = np.stack([self.vectors[self.rows[row]["id"]] for row in vector_rows]).astype(np.float32)
+        if self.matrix is not None and self.norms is None:
+            # Compressed vectors were scored before, the changed vectors are searched exactly
+            self.norms = np.linalg.norm(self.matrix, axis=1)
+            self.norms[self.norms == 0] = 1
+        self.codes = None
+        first_position = 0 if self.matrix is None else len(self.matrix)
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0] = 1
+        self.extend("matrix", vectors)
+        self.extend("norms", norms)
+        self.extend("vector_rows", np.asarray(vector_rows, dtype=np.int64))
+        assert self.matrix is not None
+        if self.centroids is not None:
+            # New vectors join their nearest cluster, the clusters themselves are only computed again on a rebuild
+            positions = np.arange(first_position, len(self.matrix))
+            assignments = np.argmax((vectors / norms[:, None]) @ self.centroids.T, axis=1)
+            for cluster in np.unique(assignments):
+                self.clusters[cluster] = np.concatenate([self.clusters[cluster], positions[assignments == cluster]])
+        elif len(self.matrix) >= self.ivf_min_vectors:
+            self.build_clusters()
+
+    def add_rows(self, documents: List[Document]) -> List[int]:
+        # Appends the documents to the rows and the inverted index, returns their number of terms
+        assert self.rows is not None
+        lengths = []
+        for document in documents:
+            row = len(self.rows)
+            self.rows.append(document)
+            self.row_ids[document["id"]] = row
+            terms = Counter(tokenize(document.get("content") or ""))
+            lengths.append(sum(terms.values()))
+            for term, count in terms.items():
+                self.postings.setdefault(term, []).append((row, count))
+        return lengths
+
+    def prepare(self):
+        if self.rows is not None:
+            return
+        self.rows = []
+        self.postings = {}
+        self.lengths = np.asarray(self.add_rows(list(self.documents.values())), dtype=np.float32)
+        self.alive = np.ones(len(self.rows), dtype=bool)
+
+        vector_rows = [row for row, document in enumerate(self.rows) if document["id"] in self.vectors]
+        self.vector_rows = np.asarray(vector_rows, dtype=np.int64)
+        if vector_rows:
+            if self.mapped_matrix is not None and not self.dirty:
+                # Rows of the stored matrices are in the order of the documents
+                self.matrix = self.mapped_matrix
+                self.codes = self.mapped_codes
+            else:
+                self.matrix = np.stack([self.vectors[self.rows[row]["id"]] for row in vector_rows])
+            if self.compression and self.codes is None:
+                self.codes = self.quantize(self.matrix)
+            # Compressed indexes compute the norms of the few vectors they rescore, instead of reading all of them
+            if self.codes is None or len(vector_rows) >= self.ivf_min_vectors:
+                self.norms = np.linalg.norm(self.matrix, axis=1)
+                self.norms[self.norms == 0] = 1
+            if len(vector_rows) >= self.ivf_min_vectors:
+                self.build_clusters()
+
+    def quantize(self, matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        normalized = matrix / norms
+        if self.compression == "binary":
+            return np.packbits(normalized > 0, axis=1)
+        # A single scale for the whole matrix keeps the scores of different vectors comparable
+        scale = 127 / (float(np.abs(normalized).max()) or 1)
+        return np.round(normalized * scale).astype(np.int8)
+
+    def compressed_scores(self, candidates: np.ndarray, query: np.ndarray) -> np.ndarray:
+        assert self.codes is not None
+        codes = self.codes[candidates]
+        if self.compression == "binary":
+            # Fewer differing bits is closer
+            return -POPCOUNT[codes ^ np.packbits(query > 0)].sum(axis=1, dtype=np.int32)
+        return codes.astype(np.float32) @ query
+
+    def build_clusters(self, iterations: int = 10):
+        # k-means over the normalized vectors, with about sqrt(n) clusters
+        assert self.matrix is not None and self.norms is not None
+        normalized = self.matrix / self.norms[:, None]
+        count = max(1, int(math.sqrt(len(normalized))))
+        generator = np.random.default_rng(0)
+        centroids = normalized[generator.choice(len(normalized), count, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(normalized @ centroids.T, axis=1)
+            for cluster in range(count):
+                members = normalized[assignments == cluster]
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    centroids[cluster] = centroid / (np.linalg.norm(centroid) or 1)
+        assignments = np.argmax(normalized @ centroids.T, axis=1)
+        self.centroids = centroids
+        self.clusters = [np.flatnonzero(assignments == cluster) for cluster in range(count)]
+
+    def text_ranking(self, search_text: str, allowed: np.ndarray, count: int) -> List[Tuple[int, float]]:
+        assert self.rows is not None and self.lengths is not None and self.alive is not None
+        scores = np.zeros(len(self.rows), dtype=np.float32)
+        document_count = len(self.rows) - self.stale_rows
+        average_length = float(self.lengths[self.alive].mean()) if document_count else 0.0
+        for term in set(tokenize(search_text)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            rows = np.fromiter((row for row, _ in postings), dtype=np.int64, count=len(postings))
+            frequencies = np.fromiter((tf for _, tf in postings), dtype=np.float32, count=len(postings))
+            current = self.alive[rows]
+            rows, frequencies = rows[current], frequencies[current]
+            if not len(rows):
+                continue
+            idf = math.log(1 + (document_count - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[rows] / (average_length or 1))
+            scores[rows] += idf * frequencies * (BM25_K1 + 1) / (frequencies + norm)
+        matches = np.flatnonzero((scores > 0) & allowed)
+        return self.top_rows(matches, scores[matches], count)
+
+    def vector_ranking(self, vector: Any, allowed: np.ndarray, count: int) -> List[Tuple[int, float]]:
+        if self.matrix is None or self.vector_rows is None:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        if len(query) != self.matrix.shape[1]:
+            raise ValueError(f"The query vector has {len(query)} dimensions instead of {self.matrix.shape[1]}")
+        query = query / (np.linalg.norm(query) or 1)
+        candidates: Optional[np.ndarray] = None
+        if self.centroids is not None:
+            probes = np.argsort(-(self.centroids @ query))[: self.ivf_probes]
+            candidates = np.concatenate([self.clusters[probe] for probe in probes])
+            candidates = candidates[allowed[self.vector_rows[candidates]]]
+            if len(candidates) < count:
+                # Too few allowed vectors in the nearest clusters, e.g. with a selective filter
+                candidates = None
+        if candidates is None:
+            candidates = np.flatnonzero(allowed[self.vector_rows])
+        rescored = count * RESCORE_OVERSAMPLING
+        if self.codes is not None and 0 < rescored < len(candidates):
+            # Rank on the compressed vectors, then rescore the best ones with their full precision vectors
+            best = np.argpartition(-self.compressed_scores(candidates, query), rescored - 1)[:rescored]
+            candidates = np.sort(candidates[best])
+        vectors = self.matrix[candidates]
+        if self.norms is not None:
+            norms = self.norms[candidates]
+        else:
+            norms = np.linalg.norm(vectors, axis=1)
+            norms[norms == 0] = 1
+        similarities = (vectors @ query) / norms
+        # Same scale as the scores of Azure AI Search for the cosine metric
+        scores = 1 / (2 - similarities)
+        return self.top_rows(self.vector_rows[candidates], scores, count)
+
+    @classmethod
+    def top_rows(cls, rows: np.ndarray, scores: np.ndarray, count: int) -> List[Tuple[int, float]]:
+        if count <= 0:
+            return []
+        if len(rows) > count:
+            best = np.argpartition(-scores, count - 1)[:count]
+            rows, scores = rows[best], scores[best]
+        order = np.lexsort((rows, -scores))
+        return [(int(rows[index]), float(scores[index])) for index in order]
+
+    def search(
+        self,
+        search_text: Optional[str] = None,
+        filter: Optional[str] = None,
+        top: Optional[int] = None,
+        skip: Optional[int] = None,
+        vector_queries: Optional[List[VectorQuery]] = None,
+        select: Optional[List[str]] = None,
+        query_caption: Optional[str] = None,
+    ) -> List[Document]:
+        with self.lock:
+            return self.search_documents(search_text, filter, top, skip, vector_queries, select, query_caption)
+
+    def search_documents(
+        self,
+        search_text: Optional[str],
+        filter: Optional[str],
+        top: Optional[int],
+        skip: Optional[int],
+        vector_queries: Optional[List[VectorQuery]],
+        select: Optional[List[str]],
+        query_caption: Optional[str],
+    ) -> List[Document]:
+        self.load()
+        top = DEFAULT_TOP if top is None else top
+        skip = skip or 0
+        predicate = LocalSearchFilter(filter) if filter else None
+        text = (search_text or "").strip()
+        has_text = bool(text) and text != "*"
+        caption_text = text if query_caption else None
+        if not has_text and not vector_queries:
+            # Filter only, e.g. prepdocs looking up the ids of a file between uploads: the documents are scanned as
+            # they are, without building the inverted index and the matrix
+            matches = (document for document in self.documents.values() if predicate is None or predicate(document))
+            return [
+                self.result(document, 1.0, select, caption_text)
+                for document in itertools.islice(matches, skip, skip + top)
+            ]
+
+        self.prepare()
+        assert self.rows is not None and self.alive is not None
+        allowed = self.alive & np.fromiter(
+            (predicate is None or predicate(document) for document in self.rows), dtype=bool, count=len(self.rows)
+        )
+        candidates = max(top + skip, HYBRID_CANDIDATES)
+
+        rankings = []
+        if has_text:
+            rankings.append(self.text_ranking(text, allowed, candidates if vector_queries else top + skip))
+        for vector_query in vector_queries or []:
+            rankings.append(self.vector_ranking(vector_query.vector, allowed, vector_query.k or top + skip))  # type: ignore[attr-defined]
+
+        if len(rankings) == 1:
+            ranking = rankings[0]
+        else:
+            fused: Dict[int, float] = {}
+            for query_ranking in rankings:
+                for rank, (row, _) in enumerate(query_ranking, 1):
+                    fused[row] = fused.get(row, 0.0) + 1 / (RRF_K + rank)
+            ranking = sorted(fused.items(), key=lambda item: (-item[1], item[0]))
+
+        return [self.result(self.rows[row], score, select, caption_text) for row, score in ranking[skip : skip + top]]
+
+    def result(self, document: Document, score: float, select: Optional[List[str]], caption_text: Optional[str]):
+        fields = {**document}
+        if select:
+            fields = {field: fields.get(field) for field in select}
+        result = {"@search.score": score, "@search.reranker_score": None, "@search.highlights": None, **fields}
+        if caption_text is not None:
+            result["@search.captions"] = [LocalCaption(self.caption(document.get("content") or "", caption_text))]
+        return result
+
+    @classmethod
+    def caption(cls, content: str, search_text: str) -> str:
+        # Extractive caption: the sentence sharing the most terms with the query
+        terms = set(tokenize(search_text))
+        sentences = [sentence.strip() for sentence in SENTENCE_PATTERN.findall(content) if sentence.strip()]
+        if not sentences:
+            return content
+        return max(sentences, key=lambda sentence: len(terms.intersection(tokenize(sentence))))
+
+    @classmethod
+    def open(cls, directory: str) -> "LocalSearchIndex":
+        # The same index object for every client of a directory in this process
+        directory = os.path.abspath(directory)
+        if directory not in OPEN_INDEXES:
+            OPEN_INDEXES[directory] = cls(directory)
+        return OPEN_INDEXES[directory]
+
+
+OPEN_INDEXES: Dict[str, LocalSearchIndex] = {}
+
+
+class LocalSearchResults:
+    """
+    Results of a search on a local index, iterated like the results of the SDK's SearchClient
+    """
+
+    def __init__(self, documents: List[Document]):
+        self.documents = documents
+
+    def __aiter__(self) -> AsyncIterator[Document]:
+        return self.iterate()
+
+    async def iterate(self) -> AsyncIterator[Document]:
+        for document in self.documents:
+            yield document
+
+    async def get_count(self) -> int:
+        return len(self.documents)
+
+
+class LocalSearchClient:
+    """
+    Drop-in replacement for the async SearchClient of the Azure AI Search SDK, for the searches and document changes
+    the app and prepdocs make, backed by a LocalSearchIndex in a directory
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.search_index = LocalSearchIndex.open(directory)
+
+    async def __aenter__(self) -> "LocalSearchClient":
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        await asyncio.to_thread(self.search_index.save)
+
+    async def search(
+        self,
+        search_text: Optional[str] = None,
+        *,
+        filter: Optional[str] = None,
+        top: Optional[int] = None,
+        skip: Optional[int] = None,
+        select: Optional[List[str]] = None,
+        vector_queries: Optional[List[VectorQuery]] = None,
+        query_caption: Optional[str] = None,
+        **kwargs: Any,
+    ) -> LocalSearchResults:
+        # Semantic ranking options are accepted and ignored, results keep their BM25, vector or fused order.
+        # Scoring runs in a worker thread, so a large query doesn't hold up the other requests of the event loop
+        return LocalSearchResults(
+            await asyncio.to_thread(
+                self.search_index.search,
+                search_text,
+                filter=filter,
+                top=top,
+                skip=skip,
+                vector_queries=vector_queries,
+                select=select,
+                query_caption=query_caption,
+            )
+        )
+
+    # Changes and counts take the index lock, which searches hold while scoring, so they wait in a worker thread too
+
+    async def get_document_count(self) -> int:
+        return await asyncio.to_thread(self.search_index.count)
+
+    async def upload_documents(self, documents: List[Document]) -> List[LocalIndexingResult]:
+        return await asyncio.to_thread(self.search_index.index, "upload", documents)
+
+    async def merge_documents(self, documents: List[Document]) -> List[LocalIndexingResult]:
+        return await asyncio.to_thread(self.search_index.index, "merge", documents)
+
+    async def merge_or_upload_documents(self, documents: List[Document]) -> List[LocalIndexingResult]:
+        return await asyncio.to_thread(self.search_index.merge_or_upload, documents)
+
+    async def delete_documents(self, documents: List[Document]) -> List[LocalIndexingResult]:
+        return await asyncio.to_thread(self.search_index.index, "delete", documents)
+
+
+class LocalSearchIndexClient:
+    """
+    Stand-in for the SDK's SearchIndexClient listing and creating the indexes stored in a local directory
+    """
+
+    def __init__(self, directory: str, vector_compression: Optional[str] = None):
+        if vector_compression is not None and vector_compression not in VECTOR_COMPRESSIONS:
+            raise ValueError(f"Unsupported vector compression {vector_compression}")
+        self.directory = directory
+        self.vector_compression = vector_compression
+
+    async def __aenter__(self) -> "LocalSearchIndexClient":
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def list_index_names(self) -> AsyncIterator[str]:
+        if not os.path.isdir(self.directory):
+            return
+        for name in sorted(os.listdir(self.directory)):
+            if os.path.isfile(os.path.join(self.directory, name, DOCUMENTS_FILE)):
+                yield name
+
+    async def create_index(self, index: Any):
+        # The fields are implied by the documents, only the directory and the compression of the embeddings are set
+        search_index = LocalSearchIndex.open(os.path.join(self.directory, index.name))
+        await asyncio.to_thread(search_index.create, self.vector_compression)
+
+
+class LocalSearchInfo(SearchInfo):
+    """
+    Connection to local search indexes, each stored in a subdirectory of directory named after the index.
+    Indexes it creates store their embeddings with vector_compression, when set
+    """
+
+    def __init__(
+        self, directory: str, index_name: str, verbose: bool = False, vector_compression: Optional[str] = None
+    ):
+        super().__init__(
+            endpoint=directory, credential=AzureKeyCredential("local"), index_name=index_name, verbose=verbose
+        )
+        self.directory = directory
+        self.vector_compression = vector_compression
+
+    def create_search_client(self) -> Any:
+        return LocalSearchClient(os.path.join(self.directory, self.index_name))
+
+    def create_search_index_client(self) -> Any:
+        return LocalSearchIndexClient(self.directory, self.vector_compression)
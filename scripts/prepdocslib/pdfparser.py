@@ -1,8 +1,14 @@
+import asyncio
+import heapq
 import html
+import math
+import os
 from abc import ABC
-from typing import IO, AsyncGenerator, Union
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO, AsyncGenerator, Dict, List, Optional, Tuple, Union
 
-from azure.ai.formrecognizer import DocumentTable
+from azure.ai.formrecognizer import DocumentTable, DocumentTableCell
 from azure.ai.formrecognizer.aio import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
@@ -32,18 +38,50 @@ class PdfParser(ABC):
     Abstract parser that parses PDFs into pages
     """
 
-    async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
+    async def parse(self, content: IO, filename: Optional[str] = None) -> AsyncGenerator[Page, None]:
         if False:
             yield
 
+    def close(self):
+        pass
+
+
+def count_pdf_pages(path: str) -> int:
+    return len(PdfReader(path).pages)
+
+
+def extract_pdf_pages(path: str, start: int, end: int) -> List[str]:
+    # Runs in a worker process, which opens the file itself so its bytes never have to be pickled
+    pages = PdfReader(path).pages
+    return [pages[page_num].extract_text() for page_num in range(start, end)]
+
 
 class LocalPdfParser(PdfParser):
     """
     Concrete parser backed by PyPDF that can parse PDFs into pages
     To learn more, please visit https://pypi.org/project/pypdf/
+    With more than one worker, text extraction is CPU bound work spread over a pool of processes, each extracting a
+    range of pages of files that exist on disk
     """
 
-    async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
+    def __init__(self, workers: int = 1, pages_per_shard: Optional[int] = None, verbose: bool = False):
+        self.workers = workers
+        self.pages_per_shard = pages_per_shard
+        self.verbose = verbose
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    async def parse(self, content: IO, filename: Optional[str] = None) -> AsyncGenerator[Page, None]:
+        path = getattr(content, "name", None)
+        if self.workers > 1 and isinstance(path, str) and os.path.isfile(path):
+            async for page in self.parse_in_processes(path):
+                yield page
+            return
+
         reader = PdfReader(content)
         pages = reader.pages
         offset = 0
@@ -52,6 +90,34 @@ class LocalPdfParser(PdfParser):
             yield Page(page_num=page_num, offset=offset, text=page_text)
             offset += len(page_text)
 
+    async def parse_in_processes(self, path: str) -> AsyncGenerator[Page, None]:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        loop = asyncio.get_running_loop()
+        page_count = await loop.run_in_executor(self.executor, count_pdf_pages, path)
+        # Several shards per worker so that a few slow pages don't leave the other workers idle
+        pages_per_shard = self.pages_per_shard or max(1, math.ceil(page_count / (self.workers * 4)))
+        if self.verbose:
+            print(f"Extracting text from '{path}' in {self.workers} processes, {pages_per_shard} pages at a time")
+        shards = [
+            (
+                start,
+                loop.run_in_executor(
+                    self.executor, extract_pdf_pages, path, start, min(start + pages_per_shard, page_count)
+                ),
+            )
+            for start in range(0, page_count, pages_per_shard)
+        ]
+        offset = 0
+        try:
+            for start, shard in shards:
+                for page_num, page_text in enumerate(await shard, start):
+                    yield Page(page_num=page_num, offset=offset, text=page_text)
+                    offset += len(page_text)
+        finally:
+            for _, shard in shards:
+                shard.cancel()
+
 
 class DocumentAnalysisPdfParser(PdfParser):
     """
@@ -71,9 +137,10 @@ class DocumentAnalysisPdfParser(PdfParser):
         self.credential = credential
         self.verbose = verbose
 
-    async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
+    async def parse(self, content: IO, filename: Optional[str] = None) -> AsyncGenerator[Page, None]:
         if self.verbose:
-            print(f"Extracting text from '{content.name}' using Azure Document Intelligence")
+            # Downloaded files are spooled to anonymous temporary files, the caller knows their name
+            print(f"Extracting text from '{filename}' using Azure Document Intelligence")
 
         async with DocumentAnalysisClient(
             endpoint=self.endpoint, credential=self.credential, headers={"x-ms-useragent": USER_AGENT}
@@ -81,56 +148,80 @@ class DocumentAnalysisPdfParser(PdfParser):
             poller = await form_recognizer_client.begin_analyze_document(model_id=self.model_id, document=content)
             form_recognizer_results = await poller.result()
 
+            tables_by_page: Dict[int, List[DocumentTable]] = defaultdict(list)
+            for table in form_recognizer_results.tables or []:
+                if table.bounding_regions:
+                    tables_by_page[table.bounding_regions[0].page_number].append(table)
+
             offset = 0
             for page_num, page in enumerate(form_recognizer_results.pages):
-                tables_on_page = [
-                    table
-                    for table in (form_recognizer_results.tables or [])
-                    if table.bounding_regions and table.bounding_regions[0].page_number == page_num + 1
-                ]
-
-                # mark all positions of the table spans in the page
-                page_offset = page.spans[0].offset
-                page_length = page.spans[0].length
-                table_chars = [-1] * page_length
-                for table_id, table in enumerate(tables_on_page):
-                    for span in table.spans:
-                        # replace all table spans with "table_id" in table_chars array
-                        for i in range(span.length):
-                            idx = span.offset - page_offset + i
-                            if idx >= 0 and idx < page_length:
-                                table_chars[idx] = table_id
-
-                # build page text by replacing characters in table spans with table html
-                page_text = ""
-                added_tables = set()
-                for idx, table_id in enumerate(table_chars):
-                    if table_id == -1:
-                        page_text += form_recognizer_results.content[page_offset + idx]
-                    elif table_id not in added_tables:
-                        page_text += DocumentAnalysisPdfParser.table_to_html(tables_on_page[table_id])
-                        added_tables.add(table_id)
-
+                page_text = DocumentAnalysisPdfParser.page_text(
+                    form_recognizer_results.content,
+                    page.spans[0].offset,
+                    page.spans[0].length,
+                    tables_by_page[page_num + 1],
+                )
                 yield Page(page_num=page_num, offset=offset, text=page_text)
                 offset += len(page_text)
 
+    @classmethod
+    def page_text(cls, content: str, page_offset: int, page_length: int, tables: List[DocumentTable]) -> str:
+        # Builds the text of a page, replacing the text of each table with its html where the table first appears
+        page_end = page_offset + page_length
+        intervals = []
+        for table_id, table in enumerate(tables):
+            for span in table.spans:
+                start = max(span.offset, page_offset)
+                end = min(span.offset + span.length, page_end)
+                if start < end:
+                    intervals.append((start, end, table_id))
+        if not intervals:
+            return content[page_offset:page_end]
+
+        intervals.sort()
+        boundaries = sorted(
+            {page_offset, page_end, *(start for start, _, _ in intervals), *(end for _, end, _ in intervals)}
+        )
+        parts = []
+        added_tables = set()
+        # Tables covering the current position, the one listed last wins where spans of several tables overlap
+        active: List[Tuple[int, int]] = []
+        next_interval = 0
+        for start, end in zip(boundaries, boundaries[1:]):
+            while next_interval < len(intervals) and intervals[next_interval][0] <= start:
+                _, interval_end, table_id = intervals[next_interval]
+                heapq.heappush(active, (-table_id, interval_end))
+                next_interval += 1
+            # Intervals that already ended are only dropped once they reach the top of the heap
+            while active and active[0][1] <= start:
+                heapq.heappop(active)
+            table_id = -active[0][0] if active else -1
+            if table_id == -1:
+                parts.append(content[start:end])
+            elif table_id not in added_tables:
+                parts.append(DocumentAnalysisPdfParser.table_to_html(tables[table_id]))
+                added_tables.add(table_id)
+        return "".join(parts)
+
     @classmethod
     def table_to_html(cls, table: DocumentTable):
-        table_html = "<table>"
-        rows = [
-            sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index)
-            for i in range(table.row_count)
-        ]
+        # Cells grouped by row in a single pass, instead of scanning every cell for each row
+        rows: List[List[DocumentTableCell]] = [[] for _ in range(table.row_count)]
+        for cell in table.cells:
+            if 0 <= cell.row_index < table.row_count:
+                rows[cell.row_index].append(cell)
+
+        parts = ["<table>"]
         for row_cells in rows:
-            table_html += "<tr>"
-            for cell in row_cells:
+            parts.append("<tr>")
+            for cell in sorted(row_cells, key=lambda cell: cell.column_index):
                 tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
                 cell_spans = ""
                 if cell.column_span is not None and cell.column_span > 1:
                     cell_spans += f" colSpan={cell.column_span}"
                 if cell.row_span is not None and cell.row_span > 1:
                     cell_spans += f" rowSpan={cell.row_span}"
-                table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-            table_html += "</tr>"
-        table_html += "</table>"
-        return table_html
+                parts.append(f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>")
+            parts.append("</tr>")
+        parts.append("</table>")
+        return "".join(parts)
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+
+class PipelineStage:
+    """
+    A step of a pipeline, run by a number of workers that each process one item at a time
+    """
+
+    def __init__(self, name: str, process: Callable[[Any], Awaitable[Any]], workers: int = 1):
+        self.name = name
+        self.process = process
+        self.workers = max(1, workers)
+
+
+class Pipeline:
+    """
+    Runs items through a sequence of asynchronous stages connected by bounded queues, so that different items can be
+    in different stages at the same time (e.g. parsing the next file while the current one is being embedded).
+    A full queue blocks the stage before it, which bounds how many items are in memory at once.
+    An item that fails in any stage is dropped from the pipeline without stopping the other items.
+    """
+
+    # Sentinel telling a worker that no more items will arrive
+    DONE = object()
+
+    def __init__(self, stages: List[PipelineStage], queue_size: int = 1):
+        self.stages = stages
+        self.queue_size = queue_size
+        # Time spent processing items in each stage during the last run, summed over its workers
+        self.stage_seconds: Dict[str, float] = {}
+
+    async def run(
+        self,
+        items: AsyncIterator[Any],
+        on_done: Optional[Callable[[Any, Optional[str], Optional[Exception]], Awaitable[None]]] = None,
+    ) -> int:
+        # on_done is called exactly once per item, with the name of the stage that failed and the error if any.
+        # Returns the number of items that failed.
+        queues: List[asyncio.Queue] = [
+            asyncio.Queue(maxsize=max(self.queue_size, stage.workers)) for stage in self.stages
+        ]
+        failures = 0
+        self.stage_seconds = {stage.name: 0.0 for stage in self.stages}
+
+        async def finish(item: Any, stage_name: Optional[str] = None, error: Optional[Exception] = None):
+            nonlocal failures
+            if error is not None:
+                failures += 1
+            if on_done:
+                await on_done(item, stage_name, error)
+
+        async def worker(index: int):
+            stage = self.stages[index]
+            while True:
+                item = await queues[index].get()
+                if item is Pipeline.DONE:
+                    return
+                start = time.monotonic()
+                try:
+                    result = await stage.process(item)
+                except Exception as error:
+                    await finish(item, stage.name, error)
+                    continue
+                finally:
+                    self.stage_seconds[stage.name] += time.monotonic() - start
+                if index + 1 < len(self.stages):
+                    await queues[index + 1].put(result)
+                else:
+                    await finish(result)
+
+        async def run_stage(index: int):
+            await asyncio.gather(*(worker(index) for _ in range(self.stages[index].workers)))
+            # Every worker of this stage is done, so nothing else will reach the next stage
+            if index + 1 < len(self.stages):
+                for _ in range(self.stages[index + 1].workers):
+                    await queues[index + 1].put(Pipeline.DONE)
+
+        async def feed():
+            async for item in items:
+                await queues[0].put(item)
+            for _ in range(self.stages[0].workers):
+                await queues[0].put(Pipeline.DONE)
+
+        tasks = [asyncio.create_task(feed())] + [asyncio.create_task(run_stage(i)) for i in range(len(self.stages))]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return failures
@@ -1,16 +1,29 @@
-from typing import Generator, List
+import bisect
+import re
+from typing import Callable, Generator, List, Optional, Tuple
+
+import tiktoken
 
 from .pdfparser import Page
 
+TABLE_PATTERN = re.compile(r"<table.*?</table>", re.DOTALL)
+# A sentence ends at a sentence ending followed by whitespace, the whitespace stays with the sentence
+SENTENCE_PATTERN = re.compile(r".+?(?:[.!?]+(?:\s+|$)|$)", re.DOTALL)
+# Fallbacks for sentences or tables that don't fit in a section on their own
+ROW_PATTERN = re.compile(r".+?(?:</tr>|$)", re.DOTALL)
+WORD_PATTERN = re.compile(r"\S*\s*")
+
 
 class SplitPage:
     """
     A section of a page that has been split into a smaller chunk.
     """
 
-    def __init__(self, page_num: int, text: str):
+    def __init__(self, page_num: int, text: str, token_count: Optional[int] = None):
         self.page_num = page_num
         self.text = text
+        # Number of tokens of the text for the embedding model, when the splitter already counted them
+        self.token_count = token_count
 
 
 class TextSplitter:
@@ -18,59 +31,86 @@ class TextSplitter:
     Class that splits pages into smaller chunks. This is required because embedding models may not be able to analyze an entire page at once
     """
 
-    def __init__(self, verbose: bool = False):
+    def __init__(
+        self,
+        verbose: bool = False,
+        max_tokens_per_section: Optional[int] = None,
+        model_name: str = "text-embedding-ada-002",
+    ):
         self.sentence_endings = [".", "!", "?"]
         self.word_breaks = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
         self.max_section_length = 1000
         self.sentence_search_limit = 100
         self.section_overlap = 100
         self.verbose = verbose
+        # When set, sections are sized by tokens of the embedding model instead of characters
+        self.max_tokens_per_section = max_tokens_per_section
+        self.token_overlap = (max_tokens_per_section or 0) // 10
+        self.model_name = model_name
+        self._encoding: Optional[tiktoken.Encoding] = None
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        if self._encoding is None:
+            self._encoding = tiktoken.encoding_for_model(self.model_name)
+        return self._encoding
+
+    def count_tokens(self, texts: List[str]) -> List[int]:
+        return [len(tokens) for tokens in self.encoding.encode_ordinary_batch(texts)]
 
     def split_pages(self, pages: List[Page]) -> Generator[SplitPage, None, None]:
-        def find_page(offset):
-            num_pages = len(pages)
-            for i in range(num_pages - 1):
-                if offset >= pages[i].offset and offset < pages[i + 1].offset:
-                    return pages[i].page_num
-            return pages[num_pages - 1].page_num
+        if self.max_tokens_per_section:
+            yield from self.split_pages_by_tokens(pages, self.max_tokens_per_section)
+            return
 
         all_text = "".join(page.text for page in pages)
+        find_page = self.page_finder(pages)
         length = len(all_text)
+
+        # Sentence endings are found with a binary search over their positions. Word breaks are only needed when
+        # there is no sentence ending nearby and are so frequent that they're searched within that window instead.
+        sentence_endings = [
+            match.start() for match in re.finditer(self.character_class(self.sentence_endings), all_text)
+        ]
+        word_break = re.compile(self.character_class(self.word_breaks))
+
         start = 0
         end = length
         while start + self.section_overlap < length:
-            last_word = -1
             end = start + self.max_section_length
 
             if end > length:
                 end = length
             else:
                 # Try to find the end of the sentence
-                while (
-                    end < length
-                    and (end - start - self.max_section_length) < self.sentence_search_limit
-                    and all_text[end] not in self.sentence_endings
-                ):
-                    if all_text[end] in self.word_breaks:
-                        last_word = end
-                    end += 1
-                if end < length and all_text[end] not in self.sentence_endings and last_word > 0:
-                    end = last_word  # Fall back to at least keeping a whole word
+                search_end = min(end + self.sentence_search_limit, length - 1)
+                i = bisect.bisect_left(sentence_endings, end)
+                if i < len(sentence_endings) and sentence_endings[i] <= search_end:
+                    end = sentence_endings[i]
+                else:
+                    search_start = end
+                    end = min(end + self.sentence_search_limit, length)
+                    if end < length:
+                        # Fall back to at least keeping a whole word
+                        last_word = -1
+                        for match in word_break.finditer(all_text, search_start, end):
+                            last_word = match.start()
+                        if last_word > 0:
+                            end = last_word
             if end < length:
                 end += 1
 
             # Try to find the start of the sentence or at least a whole word boundary
-            last_word = -1
-            while (
-                start > 0
-                and start > end - self.max_section_length - 2 * self.sentence_search_limit
-                and all_text[start] not in self.sentence_endings
-            ):
-                if all_text[start] in self.word_breaks:
-                    last_word = start
-                start -= 1
-            if all_text[start] not in self.sentence_endings and last_word > 0:
-                start = last_word
+            search_start = max(0, end - self.max_section_length - 2 * self.sentence_search_limit)
+            if start > search_start:
+                i = bisect.bisect_right(sentence_endings, start) - 1
+                if i >= 0 and sentence_endings[i] > search_start:
+                    start = sentence_endings[i]
+                else:
+                    first_word = word_break.search(all_text, search_start + 1, start + 1)
+                    start = search_start
+                    if all_text[start] not in self.sentence_endings and first_word:
+                        start = first_word.start()
             if start > 0:
                 start += 1
 
@@ -92,3 +132,101 @@ class TextSplitter:
 
         if start + self.section_overlap < end:
             yield SplitPage(page_num=find_page(start), text=all_text[start:end])
+
+    @classmethod
+    def character_class(cls, characters: List[str]) -> str:
+        return "[" + "".join(re.escape(character) for character in characters) + "]"
+
+    @classmethod
+    def page_finder(cls, pages: List[Page]) -> Callable[[int], int]:
+        # Returns the number of the page an offset of the joined text belongs to. Offsets past the last page (or
+        # before the first one) belong to the last page.
+        offsets = [page.offset for page in pages]
+        if any(offsets[i] > offsets[i + 1] for i in range(len(offsets) - 1)):
+
+            def find_page_linear(offset: int) -> int:
+                for i in range(len(pages) - 1):
+                    if offset >= pages[i].offset and offset < pages[i + 1].offset:
+                        return pages[i].page_num
+                return pages[-1].page_num
+
+            return find_page_linear
+
+        def find_page(offset: int) -> int:
+            i = bisect.bisect_right(offsets, offset) - 1
+            return pages[i].page_num if i >= 0 else pages[-1].page_num
+
+        return find_page
+
+    def split_span(
+        self, text: str, start: int, end: int, token_count: int, max_tokens: int, patterns: List[re.Pattern]
+    ) -> List[Tuple[int, int, int]]:
+        # Breaks a span that doesn't fit in a section into smaller pieces, using the coarsest pattern that works
+        if token_count <= max_tokens or end - start <= 1:
+            return [(start, end, token_count)]
+        if not patterns:
+            # A single word longer than a whole section, cut it in proportion to its tokens
+            step = max(1, (end - start) * max_tokens // token_count)
+            pieces = [(i, min(i + step, end)) for i in range(start, end, step)]
+        else:
+            pieces = [(start + match.start(), start + match.end()) for match in patterns[0].finditer(text[start:end])]
+            pieces = [(piece_start, piece_end) for piece_start, piece_end in pieces if piece_end > piece_start]
+            if len(pieces) <= 1:
+                return self.split_span(text, start, end, token_count, max_tokens, patterns[1:])
+        counts = self.count_tokens([text[piece_start:piece_end] for piece_start, piece_end in pieces])
+        spans: List[Tuple[int, int, int]] = []
+        for (piece_start, piece_end), count in zip(pieces, counts):
+            spans.extend(self.split_span(text, piece_start, piece_end, count, max_tokens, patterns[1:]))
+        return spans
+
+    def split_pages_by_tokens(self, pages: List[Page], max_tokens: int) -> Generator[SplitPage, None, None]:
+        all_text = "".join(page.text for page in pages)
+        if not all_text:
+            return
+        find_page = self.page_finder(pages)
+
+        # Sentences and whole tables are the units sections are built from, so neither is cut unless it's too
+        # large to fit in a section by itself
+        units: List[Tuple[int, int, List[re.Pattern]]] = []
+        position = 0
+        for table in TABLE_PATTERN.finditer(all_text):
+            units.extend(
+                (position + match.start(), position + match.end(), [WORD_PATTERN])
+                for match in SENTENCE_PATTERN.finditer(all_text[position : table.start()])
+            )
+            units.append((table.start(), table.end(), [ROW_PATTERN, WORD_PATTERN]))
+            position = table.end()
+        units.extend(
+            (position + match.start(), position + match.end(), [WORD_PATTERN])
+            for match in SENTENCE_PATTERN.finditer(all_text[position:])
+        )
+
+        spans: List[Tuple[int, int, int]] = []
+        unit_counts = self.count_tokens([all_text[start:end] for start, end, _ in units])
+        for (start, end, patterns), count in zip(units, unit_counts):
+            spans.extend(self.split_span(all_text, start, end, count, max_tokens, patterns))
+
+        # Pack consecutive spans up to the token budget, starting each section with the last spans of the previous
+        # one that fit in the overlap budget
+        sections: List[Tuple[int, int]] = []
+        first = 0
+        while first < len(spans):
+            last = first
+            total = spans[first][2]
+            while last + 1 < len(spans) and total + spans[last + 1][2] <= max_tokens:
+                last += 1
+                total += spans[last][2]
+            sections.append((spans[first][0], spans[last][1]))
+            if last + 1 >= len(spans):
+                break
+            next_first = last + 1
+            overlap = 0
+            while next_first - 1 > first and overlap + spans[next_first - 1][2] <= self.token_overlap:
+                next_first -= 1
+                overlap += spans[next_first][2]
+            first = next_first
+
+        # Counted once here so that embedding batching doesn't need to tokenize the sections again
+        section_counts = self.count_tokens([all_text[start:end] for start, end in sections])
+        for (start, end), token_count in zip(sections, section_counts):
+            yield SplitPage(page_num=find_page(start), text=all_text[start:end], token_count=token_count)
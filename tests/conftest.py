@@ -214,6 +214,7 @@ def mock_acs_search_filter(monkeypatch):
 
     async def mock_search(self, *args, **kwargs):
         self.filter = kwargs.get("filter")
+        self.select = kwargs.get("select")
         return AsyncSearchResultsIterator()
 
     monkeypatch.setattr(SearchClient, "search", mock_search)
@@ -575,7 +576,7 @@ def mock_data_lake_service_client(monkeypatch):
     def mock_download_file(self, *args, **kwargs):
         return azure.storage.filedatalake.StorageStreamDownloader(None)
 
-    def mock_download_file_aio(self, *args, **kwargs):
+    async def mock_download_file_aio(self, *args, **kwargs):
         return azure.storage.filedatalake.aio.StorageStreamDownloader(None)
 
     async def mock_get_access_control(self, *args, **kwargs):
@@ -658,6 +659,9 @@ def mock_data_lake_service_client(monkeypatch):
     def mock_readinto(self, *args, **kwargs):
         pass
 
+    async def mock_readinto_aio(self, stream, *args, **kwargs):
+        stream.write(b"content")
+
     monkeypatch.setattr(
         azure.storage.filedatalake.StorageStreamDownloader, "__init__", mock_init)
     monkeypatch.setattr(
@@ -666,4 +670,4 @@ def mock_data_lake_service_client(monkeypatch):
     monkeypatch.setattr(
         azure.storage.filedatalake.aio.StorageStreamDownloader, "__init__", mock_init)
     monkeypatch.setattr(
-        azure.storage.filedatalake.aio.StorageStreamDownloader, "readinto", mock_readinto)
+        azure.storage.filedatalake.aio.StorageStreamDownloader, "readinto", mock_readinto_aio)
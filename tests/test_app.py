@@ -1,3 +1,8 @@
+import asyncio
+import base64
+import glob
+import hashlib
+import io
 import json
 import logging
 import os
@@ -7,8 +12,10 @@ import pytest
 import quart.testing.app
 from httpx import Request, Response
 from openai import BadRequestError
+from quart.datastructures import FileStorage
 
 import app
+from core.deadline import DeadlineSettings
 
 
 def fake_response(http_code):
@@ -140,6 +147,7 @@ async def test_ask_rtr_text_filter(auth_client, snapshot):
         auth_client.config[app.CONFIG_SEARCH_CLIENT].filter
         == "category ne 'excluded' and (oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z')))"
     )
+    assert auth_client.config[app.CONFIG_SEARCH_CLIENT].select == ["sourcepage", "content"]
     result = await response.get_json()
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
@@ -192,6 +200,146 @@ async def test_ask_rtr_hybrid(client, snapshot):
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+async def test_ask_deadline_exceeded(client, monkeypatch, caplog):
+    openai_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    create = openai_client.chat.completions.create
+    cancelled = []
+
+    async def slow_create(*args, **kwargs):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return await create(*args, **kwargs)
+
+    monkeypatch.setattr(openai_client.chat.completions, "create", slow_create)
+    response = await client.post(
+        "/ask",
+        headers={"X-Request-Deadline-Ms": "100"},
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 504
+    result = await response.get_json()
+    assert result["error"] == app.ERROR_MESSAGE_DEADLINE.format(stage="generation")
+    assert cancelled == [True]
+
+    response = await client.post(
+        "/ask",
+        headers={"X-Request-Deadline-Ms": "later"},
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_ask_deadline_skips_semantic_ranker(client):
+    client.app.config[app.CONFIG_DEADLINE_SETTINGS] = DeadlineSettings(10, {"semantic_ranker": 60})
+    response = await client.post(
+        "/ask",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text", "semantic_ranker": True, "semantic_captions": True},
+            },
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    context = result["choices"][0]["context"]
+    assert context["skipped_stages"] == ["semantic_ranker"]
+    # Without the semantic ranker, the sources are the content of the documents instead of captions
+    assert context["data_points"][0].startswith("Benefit_Options-2.pdf: There is a whistleblower policy.")
+
+
+@pytest.mark.asyncio
+async def test_ask_include_context(client):
+    contexts = {}
+    for include_context in ["none", "citations", "full"]:
+        response = await client.post(
+            "/ask",
+            json={
+                "messages": [{"content": "What is the capital of France?", "role": "user"}],
+                "context": {"overrides": {"retrieval_mode": "text", "include_context": include_context}},
+            },
+        )
+        assert response.status_code == 200
+        contexts[include_context] = (await response.get_json())["choices"][0]["context"]
+    assert contexts["none"] == {}
+    assert contexts["citations"] == {"data_points": ["Benefit_Options-2.pdf"]}
+    assert contexts["full"]["data_points"][0].startswith("Benefit_Options-2.pdf: ")
+    assert contexts["full"]["thoughts"].startswith("Question:<br>What is the capital of France?")
+
+    response = await client.post(
+        "/ask",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"include_context": "thoughts"}},
+        },
+    )
+    assert response.status_code == 400
+    assert (await response.get_json())["error"] == "include_context must be one of none, citations, full"
+
+
+@pytest.mark.asyncio
+async def test_ask_batch(client, monkeypatch, caplog):
+    openai_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    embeddings_calls = []
+    embeddings_create = openai_client.embeddings.create
+
+    async def batch_embeddings_create(*args, **kwargs):
+        embeddings_calls.append(kwargs["input"])
+        response = await embeddings_create(*args, **kwargs)
+        response.data = [response.data[0].model_copy(update={"index": index}) for index in range(len(kwargs["input"]))]
+        return response
+
+    chat_create = openai_client.chat.completions.create
+    running = []
+    max_running = []
+
+    async def slow_chat_create(*args, **kwargs):
+        running.append(True)
+        max_running.append(len(running))
+        try:
+            await asyncio.sleep(0.01)
+            if kwargs["messages"][-1]["content"].startswith("Why?"):
+                raise ZeroDivisionError("something bad happened")
+            return await chat_create(*args, **kwargs)
+        finally:
+            running.pop()
+
+    monkeypatch.setattr(openai_client.embeddings, "create", batch_embeddings_create)
+    monkeypatch.setattr(openai_client.chat.completions, "create", slow_chat_create)
+    monkeypatch.setattr(client.app.config[app.CONFIG_ASK_APPROACH], "batch_completion_concurrency", 2)
+
+    questions = ["What is the capital of France?"] * 4 + ["Why?"]
+    response = await client.post(
+        "/ask/batch",
+        json={"questions": questions, "context": {"overrides": {"include_context": "citations"}}},
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/json-lines"
+    results = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert sorted(result["index"] for result in results) == [0, 1, 2, 3, 4]
+    for result in results:
+        if result["index"] == 4:
+            assert result["error"] == app.ERROR_MESSAGE.format(error_type=ZeroDivisionError)
+        else:
+            assert (
+                result["choices"][0]["message"]["content"] == "The capital of France is Paris. [Benefit_Options-2.pdf]."
+            )
+            assert result["choices"][0]["context"] == {"data_points": ["Benefit_Options-2.pdf"]}
+    assert "Exception in /ask/batch: something bad happened" in caplog.text
+    # The questions were embedded together, and no more than two completions ran at once
+    assert embeddings_calls == [questions]
+    assert max(max_running) == 2
+
+    for invalid in [{}, {"questions": []}, {"questions": ["", "Why?"]}, {"questions": ["Why?"] * 101}]:
+        response = await client.post("/ask/batch", json=invalid)
+        assert response.status_code == 400
+
+
 @pytest.mark.asyncio
 async def test_chat_request_must_be_json(client):
     response = await client.post("/chat")
@@ -304,6 +452,7 @@ async def test_chat_text_filter(auth_client, snapshot):
         auth_client.config[app.CONFIG_SEARCH_CLIENT].filter
         == "category ne 'excluded' and (oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z')))"
     )
+    assert auth_client.config[app.CONFIG_SEARCH_CLIENT].select == ["sourcepage", "content"]
     result = await response.get_json()
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
@@ -444,6 +593,7 @@ async def test_chat_stream_text_filter(auth_client, snapshot):
         auth_client.config[app.CONFIG_SEARCH_CLIENT].filter
         == "category ne 'excluded' and (oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z')))"
     )
+    assert auth_client.config[app.CONFIG_SEARCH_CLIENT].select == ["sourcepage", "content"]
     result = await response.get_data()
     snapshot.assert_match(result, "result.jsonlines")
 
@@ -571,6 +721,121 @@ async def test_chat_stream_followup(client, snapshot):
     snapshot.assert_match(result, "result.jsonlines")
 
 
+@pytest.fixture
+def mock_prepdocs_script(monkeypatch):
+    runs = []
+
+    async def mock_run_prepdocs_script(index, container, files, use_file_manifest=True):
+        staged = {}
+        for path in sorted(glob.glob(files)):
+            with open(path, "rb") as f:
+                staged[os.path.basename(path)] = f.read()
+        runs.append(
+            {
+                "index": index,
+                "container": container,
+                "files": files,
+                "staged": staged,
+                "use_file_manifest": use_file_manifest,
+            }
+        )
+
+    monkeypatch.setattr(app, "run_prepdocs_script", mock_run_prepdocs_script)
+    return runs
+
+
+@pytest.mark.asyncio
+async def test_upload_files_multipart(client, mock_prepdocs_script):
+    response = await client.post(
+        "/uploadFiles",
+        form={"azureIndex": "team-index", "azureContainer": "team-container"},
+        files={
+            "files": FileStorage(io.BytesIO(b"%PDF-1.4 first"), filename="a.pdf", content_type="application/pdf"),
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["azureIndex"] == "team-index"
+    assert result["files"] == [{"name": "a.pdf", "size": 14, "sha256": hashlib.sha256(b"%PDF-1.4 first").hexdigest()}]
+
+    assert len(mock_prepdocs_script) == 1
+    run = mock_prepdocs_script[0]
+    assert run["index"] == "team-index"
+    assert run["container"] == "team-container"
+    assert run["staged"] == {"a.pdf": b"%PDF-1.4 first"}
+    # Staged files are never ingested from the same path again, the manifest would only grow
+    assert run["use_file_manifest"] is False
+    # The per-request staging directory is removed once ingestion has finished
+    assert not os.path.exists(os.path.dirname(run["files"]))
+
+
+@pytest.mark.asyncio
+async def test_upload_files_multipart_missing_index(client, mock_prepdocs_script):
+    response = await client.post(
+        "/uploadFiles",
+        form={"azureContainer": "team-container"},
+        files={"files": FileStorage(io.BytesIO(b"data"), filename="a.pdf")},
+    )
+    assert response.status_code == 400
+    assert mock_prepdocs_script == []
+
+
+@pytest.mark.asyncio
+async def test_upload_files_multipart_duplicate_names(client, mock_prepdocs_script):
+    response = await client.post(
+        "/uploadFiles",
+        form={"azureIndex": "team-index", "azureContainer": "team-container"},
+        # Quart's test client sends one file per field, the route stages the files of every field
+        files={
+            "files": FileStorage(io.BytesIO(b"first"), filename="docs/a.pdf"),
+            "more": FileStorage(io.BytesIO(b"second"), filename="other/a.pdf"),
+        },
+    )
+    assert response.status_code == 400
+    assert "Duplicate file name 'a.pdf'" in (await response.get_json())["error"]
+    assert mock_prepdocs_script == []
+
+
+@pytest.mark.asyncio
+async def test_upload_files_json(client, mock_prepdocs_script):
+    response = await client.post(
+        "/uploadFiles",
+        json={
+            "azureIndex": "team-index",
+            "azureContainer": "team-container",
+            "files": [{"name": "../b.txt", "content": "data:text/plain;base64," + base64.b64encode(b"hello").decode()}],
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["files"] == [{"name": "b.txt", "size": 5, "sha256": hashlib.sha256(b"hello").hexdigest()}]
+    assert mock_prepdocs_script[0]["staged"] == {"b.txt": b"hello"}
+
+
+@pytest.mark.asyncio
+async def test_upload_files_json_duplicate_names(client, mock_prepdocs_script):
+    content = "data:text/plain;base64," + base64.b64encode(b"hello").decode()
+    response = await client.post(
+        "/uploadFiles",
+        json={
+            "azureIndex": "team-index",
+            "azureContainer": "team-container",
+            "files": [{"name": "b.txt", "content": content}, {"name": "dir/b.txt", "content": content}],
+        },
+    )
+    assert response.status_code == 400
+    assert mock_prepdocs_script == []
+
+
+@pytest.mark.asyncio
+async def test_upload_files_json_no_files(client, mock_prepdocs_script):
+    response = await client.post(
+        "/uploadFiles", json={"azureIndex": "team-index", "azureContainer": "team-container", "files": []}
+    )
+    assert response.status_code == 400
+    assert mock_prepdocs_script == []
+
+
 @pytest.mark.asyncio
 async def test_format_as_ndjson():
     async def gen():
@@ -1,8 +1,12 @@
+import asyncio
+import hashlib
 import os
 import sys
 from tempfile import NamedTemporaryFile
 
 import pytest
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobProperties, ContentSettings
 from conftest import MockAzureCredential
 
 from scripts.prepdocslib.blobmanager import BlobManager
@@ -32,6 +36,11 @@ async def test_upload_and_remove(monkeypatch, mock_env, blob_manager):
 
         monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
 
+        async def mock_get_blob_properties(*args, **kwargs):
+            raise ResourceNotFoundError()
+
+        monkeypatch.setattr("azure.storage.blob.aio.BlobClient.get_blob_properties", mock_get_blob_properties)
+
         async def mock_upload_blob(self, name, *args, **kwargs):
             assert name == filename
             return True
@@ -83,6 +92,11 @@ async def test_upload_and_remove_all(monkeypatch, mock_env, blob_manager):
 
         monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
 
+        async def mock_get_blob_properties(*args, **kwargs):
+            raise ResourceNotFoundError()
+
+        monkeypatch.setattr("azure.storage.blob.aio.BlobClient.get_blob_properties", mock_get_blob_properties)
+
         async def mock_upload_blob(self, name, *args, **kwargs):
             assert name == filename
             return True
@@ -138,6 +152,11 @@ async def test_create_container_upon_upload(monkeypatch, mock_env, blob_manager)
 
         monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.create_container", mock_create_container)
 
+        async def mock_get_blob_properties(*args, **kwargs):
+            raise ResourceNotFoundError()
+
+        monkeypatch.setattr("azure.storage.blob.aio.BlobClient.get_blob_properties", mock_get_blob_properties)
+
         async def mock_upload_blob(self, name, *args, **kwargs):
             assert name == filename
             return True
@@ -147,6 +166,35 @@ async def test_create_container_upon_upload(monkeypatch, mock_env, blob_manager)
         await blob_manager.upload_blob(f)
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_remove_blobs(monkeypatch, mock_env, blob_manager):
+    async def mock_exists(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+    listings = []
+
+    async def mock_list_blob_names(self, *args, **kwargs):
+        listings.append(kwargs.get("name_starts_with"))
+        for blob_path in ["a.pdf", "a-1.pdf", "a-2.pdf", "b-1.pdf", "b-x.pdf", "c-1.pdf", "notes-a-1.pdf"]:
+            yield blob_path
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.list_blob_names", mock_list_blob_names)
+    deleted = []
+
+    async def mock_delete_blob(self, name, *args, **kwargs):
+        await asyncio.sleep(0)
+        deleted.append(name)
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blob", mock_delete_blob)
+
+    await blob_manager.remove_blobs(["data/a.pdf", "data/b.pdf", "data/d.pdf"])
+    # The container is listed once for all the files
+    assert listings == [None]
+    assert sorted(deleted) == ["a-1.pdf", "a-2.pdf", "b-1.pdf"]
+
+
 @pytest.mark.asyncio
 @pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
 async def test_dont_remove_if_no_container(monkeypatch, mock_env, blob_manager):
@@ -163,6 +211,55 @@ async def test_dont_remove_if_no_container(monkeypatch, mock_env, blob_manager):
     await blob_manager.remove_blob()
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_upload_skips_unchanged_blobs(monkeypatch, mock_env, blob_manager, tmp_path):
+    exists_calls = 0
+
+    async def mock_exists(*args, **kwargs):
+        nonlocal exists_calls
+        exists_calls += 1
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    stored_md5 = {"unchanged.pdf": hashlib.md5(b"same").digest(), "changed.pdf": hashlib.md5(b"old").digest()}
+
+    async def mock_get_blob_properties(self, *args, **kwargs):
+        if self.blob_name not in stored_md5:
+            raise ResourceNotFoundError()
+        properties = BlobProperties()
+        properties.content_settings = ContentSettings(content_md5=bytearray(stored_md5[self.blob_name]))
+        return properties
+
+    monkeypatch.setattr("azure.storage.blob.aio.BlobClient.get_blob_properties", mock_get_blob_properties)
+
+    uploads = {}
+
+    async def mock_upload_blob(self, name, data, *args, **kwargs):
+        uploads[name] = kwargs
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    contents = {"unchanged.pdf": b"same", "changed.pdf": b"new", "new.pdf": b"new"}
+    files = []
+    for name, content in contents.items():
+        (tmp_path / name).write_bytes(content)
+        files.append(File(open(tmp_path / name, "rb")))
+    try:
+        await asyncio.gather(*(blob_manager.upload_blob(file) for file in files))
+    finally:
+        for file in files:
+            file.close()
+        await blob_manager.close()
+
+    assert exists_calls == 1, "The container should only be looked up once"
+    assert sorted(uploads) == ["changed.pdf", "new.pdf"]
+    assert uploads["new.pdf"]["content_settings"].content_md5 == bytearray(hashlib.md5(b"new").digest())
+    assert uploads["new.pdf"]["max_concurrency"] == 4
+
+
 def test_sourcepage_from_file_page():
     assert BlobManager.sourcepage_from_file_page("test.pdf", 0) == "test.pdf#page=1"
     assert BlobManager.sourcepage_from_file_page("test.html", 0) == "test.html"
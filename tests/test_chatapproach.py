@@ -1,9 +1,13 @@
+import asyncio
 import json
+from types import SimpleNamespace
 
 import pytest
-from openai.types.chat import ChatCompletion
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
 
+from app import format_as_ndjson
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.deadline import Deadline
 
 
 @pytest.fixture
@@ -208,3 +212,167 @@ def test_get_messages_from_history_few_shots(chat_approach):
     assert messages[4]["role"] == "assistant"
     assert messages[5]["role"] == "user"
     assert messages[5]["content"] == user_query_request
+
+
+def test_search_select(chat_approach):
+    assert chat_approach.search_select("sourcepage", "content", use_semantic_captions=False) == [
+        "sourcepage",
+        "content",
+    ]
+    # Captions are returned without selecting the content
+    assert chat_approach.search_select("sourcepage", "content", use_semantic_captions=True) == ["sourcepage"]
+
+
+class FakeSearchClient:
+    async def search(self, *args, **kwargs):
+        async def results():
+            yield {"sourcepage": "plan.pdf", "content": "Eye exams are covered."}
+
+        return results()
+
+
+class FakeStreamResponse:
+    def __init__(self):
+        self.closed = False
+
+    async def aclose(self):
+        self.closed = True
+
+
+class FakeChatStream:
+    def __init__(self):
+        self.response = FakeStreamResponse()
+
+    async def __aiter__(self):
+        yield ChatCompletionChunk.model_validate(
+            {
+                "id": "chunk",
+                "object": "chat.completion.chunk",
+                "created": 1,
+                "model": "gpt-35-turbo",
+                "choices": [{"delta": {"content": "Eye exams"}, "index": 0, "finish_reason": None}],
+            }
+        )
+        # The rest of the answer is late
+        await asyncio.sleep(10)
+
+
+class FakeCompletions:
+    def __init__(self):
+        self.calls = []
+        self.stream = FakeChatStream()
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if kwargs.get("stream"):
+            return self.stream
+        return ChatCompletion.model_validate(
+            {
+                "id": "completion",
+                "object": "chat.completion",
+                "created": 1,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {"message": {"role": "assistant", "content": "Covered."}, "index": 0, "finish_reason": "stop"}
+                ],
+            }
+        )
+
+
+@pytest.fixture
+def fake_chat_approach(monkeypatch):
+    # Counting tokens isn't what these tests are about
+    monkeypatch.setattr(
+        ChatReadRetrieveReadApproach,
+        "get_messages_from_history",
+        lambda self, system_prompt, model_id, history, user_content, max_tokens, few_shots=[]: [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content},
+        ],
+    )
+    completions = FakeCompletions()
+    return ChatReadRetrieveReadApproach(
+        search_client=FakeSearchClient(),  # type: ignore[arg-type]
+        openai_client=SimpleNamespace(chat=SimpleNamespace(completions=completions)),  # type: ignore[arg-type]
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model="text-",
+        sourcepage_field="sourcepage",
+        content_field="content",
+        query_language="en-us",
+        query_speller="lexicon",
+    )
+
+
+@pytest.mark.asyncio
+async def test_run_skips_rewrite_when_short_on_time(fake_chat_approach):
+    messages = [{"role": "user", "content": "are eye exams covered?"}]
+    context = {"overrides": {"retrieval_mode": "text"}, "deadline": Deadline(10, {"rewrite": 60})}
+    result = await fake_chat_approach.run(messages, context=context)
+    # Only the answer was generated, the search used the question as asked
+    completions = fake_chat_approach.openai_client.chat.completions
+    assert len(completions.calls) == 1
+    assert result["choices"][0]["context"]["skipped_stages"] == ["rewrite"]
+    assert "Searched for:<br>are eye exams covered?" in result["choices"][0]["context"]["thoughts"]
+    assert result["choices"][0]["message"]["content"] == "Covered."
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_stops_at_deadline(fake_chat_approach):
+    messages = [{"role": "user", "content": "are eye exams covered?"}]
+    context = {"overrides": {"retrieval_mode": "text"}, "deadline": Deadline(0.2, {"rewrite": 60})}
+    events = [event async for event in await fake_chat_approach.run(messages, stream=True, context=context)]
+    assert events[1]["choices"][0]["delta"]["content"] == "Eye exams"
+    assert events[-1]["choices"][0]["finish_reason"] == "deadline_exceeded"
+    assert fake_chat_approach.openai_client.chat.completions.stream.response.closed
+    assert fake_chat_approach.stream_cancellations.cancelled == 1
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_closes_stream_when_response_closed(fake_chat_approach):
+    messages = [{"role": "user", "content": "are eye exams covered?"}]
+    result = await fake_chat_approach.run(messages, stream=True, context={"overrides": {"retrieval_mode": "text"}})
+    response_body = format_as_ndjson(result)
+    await response_body.__anext__()
+    assert json.loads(await response_body.__anext__())["choices"][0]["delta"]["content"] == "Eye exams"
+    # Quart closes the response body at its yield when the client disconnects between two chunks
+    await response_body.aclose()
+    assert fake_chat_approach.openai_client.chat.completions.stream.response.closed
+    assert fake_chat_approach.stream_cancellations.cancelled == 1
+    assert fake_chat_approach.stream_cancellations.tokens_saved == 1023
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_closes_stream_when_cancelled(fake_chat_approach):
+    messages = [{"role": "user", "content": "are eye exams covered?"}]
+    result = await fake_chat_approach.run(messages, stream=True, context={"overrides": {"retrieval_mode": "text"}})
+    events = []
+
+    async def send_response():
+        async for event in format_as_ndjson(result):
+            events.append(event)
+
+    # Quart cancels the request's task when the client disconnects while the answer is being generated
+    task = asyncio.create_task(send_response())
+    await asyncio.sleep(0.1)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert len(events) == 2
+    assert fake_chat_approach.openai_client.chat.completions.stream.response.closed
+    assert fake_chat_approach.stream_cancellations.cancelled == 1
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_include_citations(fake_chat_approach):
+    messages = [{"role": "user", "content": "are eye exams covered?"}]
+    context = {
+        "overrides": {"retrieval_mode": "text", "include_context": "citations"},
+        "deadline": Deadline(0.2, {"rewrite": 60}),
+    }
+    events = [event async for event in await fake_chat_approach.run(messages, stream=True, context=context)]
+    assert events[0]["choices"][0]["context"] == {
+        "data_points": ["plan.pdf"],
+        "skipped_stages": ["rewrite"],
+    }
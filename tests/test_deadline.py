@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from core.deadline import Deadline, DeadlineExceeded, DeadlineSettings
+
+
+@pytest.mark.asyncio
+async def test_deadline_cancels_late_stage():
+    cancelled = asyncio.Event()
+
+    async def slow_stage():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    deadline = Deadline(0.05)
+    assert await deadline.run("embedding", asyncio.sleep(0, result="fast")) == "fast"
+    with pytest.raises(DeadlineExceeded) as error:
+        await deadline.run("search", slow_stage())
+    assert error.value.stage == "search"
+    assert cancelled.is_set()
+    assert deadline.remaining() == 0
+
+    # Later stages fail right away once the budget is spent
+    with pytest.raises(DeadlineExceeded):
+        await deadline.run("generation", asyncio.sleep(0))
+
+
+@pytest.mark.asyncio
+async def test_deadline_iterate():
+    async def stream():
+        yield 1
+        yield 2
+        await asyncio.sleep(10)
+        yield 3
+
+    items = []
+    with pytest.raises(DeadlineExceeded):
+        async for item in Deadline(0.05).iterate("generation", stream()):
+            items.append(item)
+    assert items == [1, 2]
+
+    async def fast_stream():
+        for item in range(3):
+            yield item
+
+    assert [item async for item in Deadline().iterate("generation", fast_stream())] == [0, 1, 2]
+
+
+@pytest.mark.asyncio
+async def test_deadline_skips_optional_stages():
+    deadline = Deadline(1, min_remaining={"rewrite": 5, "semantic_ranker": 0.5})
+    assert not deadline.allows("rewrite")
+    assert deadline.allows("semantic_ranker")
+    assert deadline.allows("search")
+    assert deadline.skipped == ["rewrite"]
+
+    unlimited = Deadline(min_remaining={"rewrite": 5})
+    assert unlimited.remaining() is None
+    assert unlimited.allows("rewrite")
+    assert await unlimited.run("search", asyncio.sleep(0.01, result="done")) == "done"
+
+
+def test_deadline_settings(monkeypatch):
+    monkeypatch.setenv("APP_REQUEST_DEADLINE_SECONDS", "20")
+    monkeypatch.setenv("APP_DEADLINE_MIN_REMAINING_REWRITE_SECONDS", "8")
+    settings = DeadlineSettings.from_env()
+    assert settings.budget == 20
+    assert settings.min_remaining == {"rewrite": 8}
+
+    assert settings.start({}).budget == 20
+    # Clients can shorten the budget, not extend it
+    assert settings.start({"X-Request-Deadline-Ms": "5000"}).budget == 5
+    assert settings.start({"X-Request-Deadline-Ms": "60000"}).budget == 20
+    assert DeadlineSettings().start({}).remaining() is None
+    assert DeadlineSettings().start({"X-Request-Deadline-Ms": "1500"}).budget == 1.5
+    for invalid in ["soon", "0", "-5"]:
+        with pytest.raises(ValueError, match="X-Request-Deadline-Ms"):
+            settings.start({"X-Request-Deadline-Ms": invalid})
@@ -0,0 +1,202 @@
+import asyncio
+import io
+import sqlite3
+
+import pytest
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+
+from scripts.prepdocslib.blobmanager import BlobManager
+from scripts.prepdocslib.embeddingcache import EmbeddingCache
+from scripts.prepdocslib.embeddings import OpenAIEmbeddingService
+from scripts.prepdocslib.filestrategy import FileStrategy
+from scripts.prepdocslib.listfilestrategy import File, ListFileStrategy
+from scripts.prepdocslib.pdfparser import Page, PdfParser
+from scripts.prepdocslib.pipeline import Pipeline, PipelineStage
+from scripts.prepdocslib.strategy import SearchInfo
+from scripts.prepdocslib.textsplitter import TextSplitter
+
+
+class AsyncSearchResultsIterator:
+    def __init__(self, results):
+        self.results = list(results)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if len(self.results) == 0:
+            raise StopAsyncIteration
+        return self.results.pop(0)
+
+
+async def async_items(items):
+    for item in items:
+        yield item
+
+
+@pytest.mark.asyncio
+async def test_pipeline_overlaps_stages():
+    events = []
+
+    async def first(item):
+        events.append(("first", item))
+        await asyncio.sleep(0.01)
+        return item
+
+    async def second(item):
+        events.append(("second", item))
+        await asyncio.sleep(0.01)
+        return item
+
+    done = []
+
+    async def on_done(item, stage, error):
+        done.append(item)
+
+    pipeline = Pipeline([PipelineStage("first", first), PipelineStage("second", second)])
+    assert await pipeline.run(async_items([1, 2, 3]), on_done) == 0
+
+    assert sorted(done) == [1, 2, 3]
+    assert set(pipeline.stage_seconds) == {"first", "second"}
+    assert pipeline.stage_seconds["first"] >= 0.03
+    # The second item is in the first stage while the first item is in the second stage
+    assert events.index(("first", 2)) < events.index(("second", 2))
+    assert events.index(("second", 1)) < events.index(("second", 2))
+
+
+@pytest.mark.asyncio
+async def test_pipeline_bounded_queue():
+    in_flight = 0
+    max_in_flight = 0
+    produced = 0
+
+    async def items():
+        nonlocal produced, in_flight, max_in_flight
+        for i in range(20):
+            produced += 1
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            yield i
+
+    async def slow(item):
+        await asyncio.sleep(0.001)
+        return item
+
+    async def on_done(item, stage, error):
+        nonlocal in_flight
+        in_flight -= 1
+
+    pipeline = Pipeline([PipelineStage("slow", slow, workers=2)], queue_size=2)
+    assert await pipeline.run(items(), on_done) == 0
+    assert produced == 20
+    # Backpressure from the full queue keeps the source from running ahead
+    assert max_in_flight <= 5
+
+
+@pytest.mark.asyncio
+async def test_pipeline_errors():
+    async def fail_on_two(item):
+        if item == 2:
+            raise ValueError("bad item")
+        return item
+
+    results = []
+
+    async def on_done(item, stage, error):
+        results.append((item, stage, str(error) if error else None))
+
+    pipeline = Pipeline([PipelineStage("check", fail_on_two, workers=3), PipelineStage("pass", fail_on_two)])
+    assert await pipeline.run(async_items([1, 2, 3]), on_done) == 1
+    assert sorted(results) == [(1, None, None), (2, "check", "bad item"), (3, None, None)]
+
+
+class MemoryListFileStrategy(ListFileStrategy):
+    def __init__(self, names):
+        self.names = names
+        self.committed = []
+
+    async def list(self):
+        for name in self.names:
+            content = io.BytesIO(name.encode())
+            content.name = name
+            yield File(content)
+
+    def commit(self, file):
+        self.committed.append(file.filename())
+
+
+class NamePdfParser(PdfParser):
+    async def parse(self, content, filename=None):
+        text = content.read().decode()
+        if text == "broken.pdf":
+            raise ValueError("Unable to parse")
+        yield Page(page_num=0, offset=0, text=f"The text of {text}. " * 20)
+
+
+@pytest.mark.asyncio
+async def test_file_strategy_ingest(monkeypatch, capsys):
+    async def mock_search(self, *args, **kwargs):
+        return AsyncSearchResultsIterator([])
+
+    uploaded_documents = []
+
+    async def mock_upload_documents(self, documents):
+        uploaded_documents.extend(documents)
+
+    uploaded_blobs = []
+
+    async def mock_upload_blob(self, file):
+        uploaded_blobs.append(file.filename())
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(BlobManager, "upload_blob", mock_upload_blob)
+
+    names = [f"doc{i}.pdf" for i in range(5)] + ["broken.pdf"]
+    list_file_strategy = MemoryListFileStrategy(names)
+    file_strategy = FileStrategy(
+        list_file_strategy=list_file_strategy,
+        blob_manager=BlobManager(endpoint="https://test.blob.core.windows.net", container="test", credential="test"),
+        pdf_parser=NamePdfParser(),
+        text_splitter=TextSplitter(),
+        stage_workers={"parse": 3, "index": 1},
+    )
+    assert file_strategy.stage_workers["parse"] == 3
+    assert file_strategy.stage_workers["embed"] == 2
+    search_info = SearchInfo(
+        endpoint="https://testsearchclient.blob.core.windows.net",
+        credential=AzureKeyCredential("test"),
+        index_name="test",
+    )
+
+    # A file that fails doesn't stop the others, but the run still reports it
+    with pytest.raises(RuntimeError):
+        await file_strategy.run(search_info)
+
+    assert sorted(uploaded_blobs) == names[:5]
+    assert sorted({document["sourcefile"] for document in uploaded_documents}) == names[:5]
+    assert "Error ingesting 'broken.pdf' in the parse stage" in capsys.readouterr().out
+    # Only the files that were fully ingested are recorded
+    assert sorted(list_file_strategy.committed) == names[:5]
+
+
+@pytest.mark.asyncio
+async def test_file_strategy_closes_embedding_cache(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+    file_strategy = FileStrategy(
+        list_file_strategy=MemoryListFileStrategy([]),
+        blob_manager=BlobManager(endpoint="https://test.blob.core.windows.net", container="test", credential="test"),
+        pdf_parser=NamePdfParser(),
+        text_splitter=TextSplitter(),
+        embeddings=OpenAIEmbeddingService(open_ai_model_name="text-embedding-ada-002", credential="key", cache=cache),
+    )
+    search_info = SearchInfo(
+        endpoint="https://testsearchclient.blob.core.windows.net",
+        credential=AzureKeyCredential("test"),
+        index_name="test",
+    )
+    await file_strategy.run(search_info)
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        cache.stats()
@@ -1,11 +1,15 @@
+import argparse
+import asyncio
 import hashlib
 import io
 import os
 import tempfile
 
+import azure.storage.filedatalake.aio
 import pytest
 from conftest import MockAzureCredential
 
+from scripts.prepdocslib.filemanifest import FileManifest
 from scripts.prepdocslib.listfilestrategy import (
     ADLSGen2ListFileStrategy,
     File,
@@ -96,21 +100,54 @@ async def test_locallistfilestrategy_nesteddir():
         assert files[2].filename() == "c.pdf"
 
 
-def test_locallistfilestrategy_checkmd5():
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        with open(os.path.join(tmpdirname, "test.pdf"), "w") as pdf_file:
-            pdf_file.write("test")
-            f1_hash = hashlib.md5(b"test").hexdigest()
-        with open(os.path.join(tmpdirname, "test.pdf.md5"), "w", encoding="utf-8") as md5_file:
-            md5_file.write(f1_hash)
+@pytest.mark.asyncio
+async def test_locallistfilestrategy_manifest(tmp_path):
+    for filename in ["a.pdf", "b.pdf", "c.pdf"]:
+        (tmp_path / filename).write_text("test")
+    # Left behind by older versions
+    (tmp_path / "a.pdf.md5").write_text(hashlib.md5(b"test").hexdigest())
+    manifest = FileManifest(str(tmp_path / "manifest" / "files.sqlite"))
+    local_list_strategy = LocalListFileStrategy(path_pattern=f"{tmp_path}/*.pdf*", manifest=manifest)
+
+    async def list_and_commit(failed=()):
+        names = []
+        async for file in local_list_strategy.list():
+            names.append(file.filename())
+            if file.filename() not in failed:
+                local_list_strategy.commit(file)
+            file.close()
+        return sorted(names)
+
+    assert await list_and_commit(failed=["b.pdf"]) == ["a.pdf", "b.pdf", "c.pdf"]
+    # The file that failed isn't skipped on the next run
+    assert await list_and_commit() == ["b.pdf"]
+    assert await list_and_commit() == []
+
+    # Only touching a file doesn't make it change
+    os.utime(tmp_path / "a.pdf", ns=(0, 0))
+    assert await list_and_commit() == []
+    assert manifest.get(str(tmp_path / "a.pdf"))[1] == 0
+
+    (tmp_path / "c.pdf").write_text("changed")
+    assert await list_and_commit() == ["c.pdf"]
+    assert manifest.get(str(tmp_path / "c.pdf"))[2] == hashlib.sha256(b"changed").hexdigest()
+    manifest.close()
 
-        local_list_strategy = LocalListFileStrategy(path_pattern=f"{tmpdirname}/*")
-        assert local_list_strategy.check_md5(md5_file.name) is True
-        assert local_list_strategy.check_md5(pdf_file.name) is True
-        # now change the file, hash should no longer match
-        with open(os.path.join(tmpdirname, "test.pdf"), "w") as pdf_file:
-            pdf_file.write("test2")
-        assert local_list_strategy.check_md5(pdf_file.name) is False
+
+@pytest.mark.asyncio
+async def test_manifest_fast_path(tmp_path, monkeypatch):
+    path = tmp_path / "a.pdf"
+    path.write_text("test")
+    manifest = FileManifest(str(tmp_path / "files.sqlite"))
+    assert await manifest.has_changed(str(path)) is True
+    manifest.commit(str(path))
+
+    def fail_hash(cls, path):
+        raise AssertionError("Unchanged files shouldn't be read")
+
+    monkeypatch.setattr(FileManifest, "file_sha256", classmethod(fail_hash))
+    assert await manifest.has_changed(str(path)) is False
+    manifest.close()
 
 
 @pytest.mark.asyncio
@@ -127,3 +164,57 @@ async def test_read_adls_gen2_files(monkeypatch, mock_data_lake_service_client):
     assert files[1].acls == {"oids": ["B-USER-ID"], "groups": ["B-GROUP-ID"]}
     assert files[2].filename() == "c.txt"
     assert files[2].acls == {"oids": ["C-USER-ID"], "groups": ["C-GROUP-ID"]}
+    assert files[0].content.read() == b"content"
+
+
+@pytest.mark.asyncio
+async def test_read_adls_gen2_files_concurrently(monkeypatch, mock_data_lake_service_client):
+    paths = [f"folder{i}/same.txt" for i in range(6)]
+
+    async def mock_get_paths(self, *args, **kwargs):
+        for path in paths:
+            yield argparse.Namespace(is_directory=False, name=path)
+
+    in_flight = 0
+    max_in_flight = 0
+
+    async def mock_download_file(self, *args, **kwargs):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        downloader = azure.storage.filedatalake.aio.StorageStreamDownloader(None)
+        downloader.path = self.path
+        return downloader
+
+    async def mock_readinto(self, stream, *args, **kwargs):
+        stream.write(self.path.encode())
+
+    async def mock_get_access_control(self, *args, **kwargs):
+        return {"acl": f"user:{self.path}:r--"}
+
+    monkeypatch.setattr(azure.storage.filedatalake.aio.FileSystemClient, "get_paths", mock_get_paths)
+    monkeypatch.setattr(azure.storage.filedatalake.aio.DataLakeFileClient, "download_file", mock_download_file)
+    monkeypatch.setattr(azure.storage.filedatalake.aio.StorageStreamDownloader, "readinto", mock_readinto)
+    monkeypatch.setattr(
+        azure.storage.filedatalake.aio.DataLakeFileClient, "get_access_control", mock_get_access_control
+    )
+
+    adlsgen2_list_strategy = ADLSGen2ListFileStrategy(
+        data_lake_storage_account="a",
+        data_lake_filesystem="a",
+        data_lake_path="a",
+        credential=MockAzureCredential(),
+        max_concurrency=3,
+    )
+    files = [file async for file in adlsgen2_list_strategy.list()]
+
+    # Files with the same name in different folders keep their own content, in the order they were listed
+    assert [file.content.read() for file in files] == [path.encode() for path in paths]
+    assert [file.acls["oids"] for file in files] == [[path] for path in paths]
+    assert all(file.filename() == "same.txt" for file in files)
+    assert max_in_flight == 3
+    for file in files:
+        file.close()
+        assert file.content.closed
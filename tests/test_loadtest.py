@@ -0,0 +1,125 @@
+import json
+
+import aiohttp
+import openai
+import pytest
+from aiohttp import web
+from loadtest.harness import LoadGenerator, RequestResult, percentile, report
+from loadtest.mockservers import MockOpenAIServer, MockSearchServer
+
+
+def test_percentile():
+    values = [float(value) for value in range(1, 101)]
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.95) == 95
+    assert percentile(values, 0.99) == 99
+    assert percentile([3.0], 0.99) == 3
+    assert percentile([], 0.5) is None
+
+
+def test_report():
+    results = []
+    for number in range(4):
+        result = RequestResult("chat-stream")
+        result.seconds = number + 1
+        result.first_token_seconds = 0.5
+        results.append(result)
+    failed = RequestResult("ask")
+    failed.error = "HTTP 500"
+    results.append(failed)
+
+    summary = report(results, seconds=2)
+    assert summary["requests"] == 5
+    assert summary["errors"] == 1
+    assert summary["scenarios"]["ask"]["errors"] == {"HTTP 500": 1}
+    assert summary["scenarios"]["ask"]["latency"]["p50_ms"] is None
+    assert summary["scenarios"]["chat-stream"]["latency"]["p50_ms"] == 2000
+    assert summary["scenarios"]["chat-stream"]["first_token"]["p99_ms"] == 500
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "events, error, has_first_token",
+    [
+        ([{"choices": [{"delta": {"role": "assistant"}}]}, {"choices": [{"delta": {"content": "Hi"}}]}], None, True),
+        # The app sends errors as the last line of a stream that already answered with a 200
+        (
+            [{"choices": [{"delta": {"role": "assistant"}}]}, {"error": "The app encountered an error"}],
+            "Stream error: The app encountered an error",
+            False,
+        ),
+        ([{"choices": [{"delta": {"role": "assistant"}}]}], "Stream without content", False),
+    ],
+)
+async def test_load_generator_chat_stream(events, error, has_first_token):
+    async def chat(request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        await response.write("\n".join(json.dumps(event) for event in events).encode())
+        return response
+
+    app = web.Application()
+    app.router.add_post("/chat", chat)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        generator = LoadGenerator(f"http://127.0.0.1:{port}", ["chat-stream"], rps=1)
+        async with aiohttp.ClientSession() as session:
+            result = await generator.send(session, "chat-stream")
+    finally:
+        await runner.cleanup()
+
+    assert result.status == 200
+    assert result.error == error
+    assert (result.first_token_seconds is not None) == has_first_token
+
+
+@pytest.mark.asyncio
+async def test_mock_openai_server():
+    server = MockOpenAIServer(latency=0, token_delay=0, tokens=5, throttle_rate=0.3, retry_after_ms=1, seed=1)
+    url = await server.start()
+    try:
+        client = openai.AsyncOpenAI(base_url=f"{url}/v1", api_key="loadtest", max_retries=10)
+        messages = [{"role": "user", "content": "hi"}]
+        completion = await client.chat.completions.create(model="gpt-35-turbo", messages=messages)
+        assert completion.choices[0].message.content.endswith("[info1.txt].")
+
+        chunks = [
+            chunk
+            async for chunk in await client.chat.completions.create(
+                model="gpt-35-turbo", messages=messages, stream=True
+            )
+        ]
+        assert "".join(chunk.choices[0].delta.content or "" for chunk in chunks).endswith("[info1.txt].")
+        assert chunks[-1].choices[0].finish_reason == "stop"
+
+        embeddings = await client.embeddings.create(model="text-embedding-ada-002", input=["a", "b"])
+        assert [len(item.embedding) for item in embeddings.data] == [1536, 1536]
+    finally:
+        await server.close()
+    # The client retried the throttled requests
+    assert server.throttled > 0
+    assert server.requests == server.throttled + 3
+    assert server.streams_completed == 1
+
+
+@pytest.mark.asyncio
+async def test_mock_search_server():
+    server = MockSearchServer(latency=0, blob_size=1000)
+    url = await server.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(
+                f"{url}/indexes('loadtest')/docs/search.post.search", json={"search": "hi", "top": 2}
+            ) as response:
+                documents = (await response.json())["value"]
+            async with session.get(f"{url}/content/doc0.pdf", headers={"x-ms-range": "bytes=0-99"}) as response:
+                assert response.status == 206
+                assert response.headers["Content-Range"] == "bytes 0-99/1000"
+                assert len(await response.read()) == 100
+    finally:
+        await server.close()
+    assert [document["sourcepage"] for document in documents] == ["doc0-0.pdf", "doc1-1.pdf"]
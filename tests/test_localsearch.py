@@ -0,0 +1,319 @@
+import asyncio
+import io
+import threading
+
+import numpy as np
+import pytest
+from azure.search.documents.indexes.models import SearchIndex
+from azure.search.documents.models import RawVectorQuery
+
+from scripts.prepdocslib.listfilestrategy import File
+from scripts.prepdocslib.localsearch import (
+    LocalSearchClient,
+    LocalSearchFilter,
+    LocalSearchIndex,
+    LocalSearchInfo,
+)
+from scripts.prepdocslib.searchmanager import SearchManager, Section
+from scripts.prepdocslib.textsplitter import SplitPage
+
+DOCUMENTS = [
+    {"id": "1", "content": "Deductibles are $500 for employees.", "category": "benefits", "oids": ["a"], "groups": []},
+    {"id": "2", "content": "Overlake is in-network. Overlake is near Bellevue.", "category": None, "oids": ["b"]},
+    {"id": "3", "content": "The employee handbook covers reviews.", "category": "handbook", "groups": ["g1", "g2"]},
+]
+
+
+def test_local_search_filter():
+    assert LocalSearchFilter("category ne 'benefits'")(DOCUMENTS[1])
+    assert not LocalSearchFilter("category ne 'benefits'")(DOCUMENTS[0])
+    assert LocalSearchFilter("category eq null")(DOCUMENTS[1])
+    assert LocalSearchFilter("sourcefile eq 'it''s.pdf'")({"sourcefile": "it's.pdf"})
+
+    security = LocalSearchFilter("(oids/any(g:search.in(g, 'b')) or groups/any(g:search.in(g, 'g0, g2')))")
+    assert [security(document) for document in DOCUMENTS] == [False, True, True]
+    combined = LocalSearchFilter(
+        "category ne 'handbook' and (oids/any(g:search.in(g, 'a')) or groups/any(g:search.in(g, 'g2')))"
+    )
+    assert [combined(document) for document in DOCUMENTS] == [True, False, False]
+    assert LocalSearchFilter("not (category eq 'handbook')")(DOCUMENTS[0])
+
+    for unsupported in ["category gt 'a'", "category eq 'a' and", "(category eq 'a'", "search.ismatch('a')"]:
+        with pytest.raises(ValueError, match="Unsupported filter"):
+            LocalSearchFilter(unsupported)
+
+
+def make_vectors(count, dimensions=8, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, dimensions)).astype(np.float32)
+
+
+@pytest.mark.asyncio
+async def test_local_search_client(tmp_path):
+    vectors = make_vectors(3)
+    async with LocalSearchClient(str(tmp_path / "index")) as search_client:
+        results = await search_client.upload_documents(
+            [{**document, "embedding": vector.tolist()} for document, vector in zip(DOCUMENTS, vectors)]
+        )
+        assert all(result.succeeded for result in results)
+
+    # A new index object reads what the client saved, with the embeddings memory-mapped
+    search_index = LocalSearchIndex(str(tmp_path / "index"))
+    search_index.load()
+    search_index.prepare()
+    assert isinstance(search_index.matrix, np.memmap)
+    assert [document["id"] for document in search_index.search("Overlake")] == ["2"]
+    assert search_index.search("employee handbook", top=1)[0]["id"] == "3"
+    assert search_index.search("employee", filter="category ne 'handbook'") == []
+
+    vector_query = RawVectorQuery(vector=vectors[1].tolist(), k=3, fields="embedding")
+    results = search_index.search("", vector_queries=[vector_query], select=["id", "content"])
+    assert results[0]["id"] == "2"
+    assert results[0]["@search.score"] == pytest.approx(1.0)
+    assert set(results[0]) == {"@search.score", "@search.reranker_score", "@search.highlights", "id", "content"}
+
+    # Hybrid: documents found by both queries come first
+    results = search_index.search("employees handbook", vector_queries=[vector_query], top=3)
+    assert len(results) == 3
+    assert results[0]["@search.score"] == pytest.approx(1 / 61 + 1 / 63)
+
+    results = search_index.search("Bellevue", query_caption="extractive|highlight-false")
+    assert results[0]["@search.captions"][0].text == "Overlake is near Bellevue."
+
+    # All the documents matching a filter, as prepdocs looks up the ids of a file
+    results = search_index.search("", filter="oids/any(g:search.in(g, 'a, b'))", select=["id"])
+    assert [result["id"] for result in results] == ["1", "2"]
+
+
+@pytest.mark.asyncio
+async def test_local_search_client_changes(tmp_path):
+    search_client = LocalSearchClient(str(tmp_path / "changes"))
+    await search_client.upload_documents(DOCUMENTS)
+    results = await search_client.merge_documents([{"id": "1", "category": "moved"}, {"id": "9", "category": "x"}])
+    assert [(result.key, result.succeeded, result.status_code) for result in results] == [
+        ("1", True, 200),
+        ("9", False, 404),
+    ]
+    await search_client.delete_documents([{"id": "2"}])
+    results = await search_client.search("", select=["id", "category"])
+    assert [document async for document in results] == [
+        {
+            "@search.score": 1.0,
+            "@search.reranker_score": None,
+            "@search.highlights": None,
+            "id": "1",
+            "category": "moved",
+        },
+        {
+            "@search.score": 1.0,
+            "@search.reranker_score": None,
+            "@search.highlights": None,
+            "id": "3",
+            "category": "handbook",
+        },
+    ]
+    assert await search_client.get_document_count() == 2
+
+    with pytest.raises(ValueError, match="dimensions"):
+        await search_client.upload_documents(
+            [{"id": "4", "content": "", "embedding": [1.0, 0.0]}, {"id": "5", "content": "", "embedding": [1.0]}]
+        )
+
+
+def test_local_search_ivf(tmp_path):
+    vectors = make_vectors(400, dimensions=16)
+    search_index = LocalSearchIndex(str(tmp_path / "ivf"), ivf_min_vectors=100, ivf_probes=4)
+    search_index.index(
+        "upload",
+        [
+            {"id": str(number), "content": "", "category": "even" if number % 2 == 0 else "odd", "embedding": vector}
+            for number, vector in enumerate(vectors)
+        ],
+    )
+    search_index.prepare()
+    assert search_index.centroids is not None and len(search_index.clusters) == 20
+
+    # The nearest clusters hold the exact match of a stored vector
+    query = RawVectorQuery(vector=vectors[7].tolist(), k=5, fields="embedding")
+    assert search_index.search(None, vector_queries=[query], top=5)[0]["id"] == "7"
+    results = search_index.search(None, vector_queries=[query], filter="category eq 'even'", top=5)
+    assert len(results) == 5
+    assert all(int(result["id"]) % 2 == 0 for result in results)
+
+
+def test_local_search_updates_in_place(tmp_path):
+    vectors = make_vectors(6)
+    search_index = LocalSearchIndex(str(tmp_path / "updates"))
+    search_index.index("upload", [{**document, "embedding": vector} for document, vector in zip(DOCUMENTS, vectors)])
+    # Looking up ids with a filter doesn't build the inverted index and the matrix
+    results = search_index.search("", filter="category eq 'benefits'", select=["id"])
+    assert [result["id"] for result in results] == ["1"]
+    assert search_index.rows is None
+
+    search_index.search("Overlake")
+    rows = search_index.rows
+    search_index.index(
+        "upload", [{"id": "4", "content": "Overlake clinics are open on weekends.", "embedding": vectors[3]}]
+    )
+    search_index.index("merge", [{"id": "2", "content": "Overlake moved to Redmond."}])
+    search_index.index("delete", [{"id": "1"}])
+    search_index.index("upload", [{"id": "5", "content": "Reviews are yearly.", "embedding": vectors[4]}])
+    assert search_index.rows is rows
+    assert search_index.stale_rows == 2
+    assert set(search_index.row_ids) == {"2", "3", "4", "5"}
+
+    # Same results as the index built from scratch
+    rebuilt = LocalSearchIndex(str(tmp_path / "rebuilt"))
+    rebuilt.index(
+        "upload",
+        [{**document, "embedding": search_index.vectors[id]} for id, document in search_index.documents.items()],
+    )
+    queries = [{"search_text": text} for text in ["Overlake", "Redmond", "employee handbook", "deductibles"]]
+    queries += [
+        {"vector_queries": [RawVectorQuery(vector=vector.tolist(), k=3, fields="embedding")]} for vector in vectors
+    ]
+    queries.append({"filter": "category ne 'handbook'"})
+    for query in queries:
+        results = search_index.search(**query)
+        expected = rebuilt.search(**query)
+        assert [result["id"] for result in results] == [result["id"] for result in expected]
+        assert [result["@search.score"] for result in results] == pytest.approx(
+            [result["@search.score"] for result in expected]
+        )
+
+    # Once most rows are stale, the structures are built again
+    search_index.index("delete", [{"id": "2"}, {"id": "3"}, {"id": "4"}])
+    assert search_index.rows is None
+    assert [result["id"] for result in search_index.search("yearly reviews")] == ["5"]
+
+
+def test_local_search_ivf_updates(tmp_path):
+    vectors = make_vectors(120, dimensions=16)
+    search_index = LocalSearchIndex(str(tmp_path / "ivf"), ivf_min_vectors=100, ivf_probes=10)
+    search_index.index(
+        "upload",
+        [{"id": str(number), "content": "", "embedding": vector} for number, vector in enumerate(vectors[:90])],
+    )
+    search_index.search(None, vector_queries=[RawVectorQuery(vector=vectors[0].tolist(), k=1, fields="embedding")])
+    assert search_index.centroids is None
+
+    # Clusters are computed once the index is large enough, then new vectors join their nearest cluster
+    for number in range(90, 120):
+        search_index.index("upload", [{"id": str(number), "content": "", "embedding": vectors[number]}])
+    assert search_index.centroids is not None
+    assert sum(len(cluster) for cluster in search_index.clusters) == 120
+    query = RawVectorQuery(vector=vectors[115].tolist(), k=3, fields="embedding")
+    assert search_index.search(None, vector_queries=[query], top=3)[0]["id"] == "115"
+
+
+@pytest.mark.asyncio
+async def test_local_search_client_searches_in_thread(tmp_path, monkeypatch):
+    search_client = LocalSearchClient(str(tmp_path / "threads"))
+    await search_client.upload_documents(DOCUMENTS)
+    threads = []
+    search = search_client.search_index.search
+
+    def search_in_thread(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return search(*args, **kwargs)
+
+    monkeypatch.setattr(search_client.search_index, "search", search_in_thread)
+    results = [document async for document in await search_client.search("handbook")]
+    assert [document["id"] for document in results] == ["3"]
+    assert threads and threads[0] is not threading.main_thread()
+
+
+@pytest.mark.asyncio
+async def test_local_search_client_waits_for_lock_in_thread(tmp_path):
+    search_client = LocalSearchClient(str(tmp_path / "locked"))
+    await search_client.upload_documents(DOCUMENTS)
+    locked = threading.Event()
+    release = threading.Event()
+
+    def long_search():
+        # Stands for a search scoring a large index while holding the lock
+        with search_client.search_index.lock:
+            locked.set()
+            release.wait(5)
+
+    search_thread = threading.Thread(target=long_search)
+    search_thread.start()
+    locked.wait(5)
+    changes = asyncio.gather(
+        search_client.delete_documents([{"id": "1"}]), search_client.merge_documents([{"id": "2", "category": "b"}])
+    )
+    # The event loop keeps running while the changes wait for the lock
+    await asyncio.sleep(0.05)
+    assert not changes.done()
+    release.set()
+    deleted, merged = await changes
+    search_thread.join()
+    assert deleted[0].succeeded and merged[0].succeeded
+    assert await search_client.get_document_count() == len(DOCUMENTS) - 1
+
+
+@pytest.mark.parametrize("compression", ["scalar", "binary"])
+@pytest.mark.asyncio
+async def test_local_search_compression(tmp_path, compression):
+    vectors = make_vectors(300, dimensions=64)
+    search_info = LocalSearchInfo(str(tmp_path), index_name="compressed", vector_compression=compression)
+    async with search_info.create_search_index_client() as search_index_client:
+        await search_index_client.create_index(SearchIndex(name="compressed", fields=[]))
+    async with search_info.create_search_client() as search_client:
+        await search_client.upload_documents(
+            [{"id": str(number), "content": "", "embedding": vector} for number, vector in enumerate(vectors)]
+        )
+
+    search_index = LocalSearchIndex(str(tmp_path / "compressed"))
+    search_index.load()
+    search_index.prepare()
+    assert search_index.compression == compression
+    assert isinstance(search_index.codes, np.memmap)
+    assert search_index.codes.dtype == (np.int8 if compression == "scalar" else np.uint8)
+    assert search_index.codes.shape == (300, 64 if compression == "scalar" else 8)
+
+    # Scores are rescored with the full precision vectors
+    exact = LocalSearchIndex(str(tmp_path / "exact"))
+    exact.index(
+        "upload", [{"id": str(number), "content": "", "embedding": vector} for number, vector in enumerate(vectors)]
+    )
+    for number in [3, 150]:
+        query = RawVectorQuery(vector=vectors[number].tolist(), k=3, fields="embedding")
+        results = search_index.search(None, vector_queries=[query], top=3)
+        assert results[0]["id"] == str(number)
+        assert results[0]["@search.score"] == pytest.approx(1.0)
+        if compression == "scalar":
+            assert results == exact.search(None, vector_queries=[query], top=3)
+
+
+class MockEmbeddings:
+    open_ai_model_name = "text-embedding-ada-002"
+    dimensions = None
+
+    async def create_embeddings(self, texts, token_counts=None):
+        return [[float(len(text)), 1.0, 0.5] for text in texts]
+
+
+@pytest.mark.asyncio
+async def test_search_manager_local_index(tmp_path):
+    search_info = LocalSearchInfo(str(tmp_path), index_name="team")
+    manager = SearchManager(search_info, embeddings=MockEmbeddings())  # type: ignore[arg-type]
+    await manager.create_index()
+    async with search_info.create_search_index_client() as search_index_client:
+        assert [name async for name in search_index_client.list_index_names()] == ["team"]
+
+    file = File(content=io.BytesIO(b""), name="plan.pdf")
+    await manager.update_content(
+        [
+            Section(SplitPage(page_num=0, text="Eye exams are covered."), content=file, category="benefits"),
+            Section(SplitPage(page_num=1, text="Dental is not covered."), content=file, category="benefits"),
+        ]
+    )
+    search_client = LocalSearchClient(str(tmp_path / "team"))
+    results = [document async for document in await search_client.search("eye exams", top=3)]
+    assert [document["sourcepage"] for document in results] == ["plan.pdf#page=1"]
+    # The embeddings are stored but not retrievable
+    assert "embedding" not in results[0]
+    assert search_client.search_index.vectors[results[0]["id"]].tolist() == [22.0, 1.0, 0.5]
+
+    await manager.remove_content("plan.pdf")
+    assert await LocalSearchClient(str(tmp_path / "team")).get_document_count() == 0
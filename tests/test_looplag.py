@@ -0,0 +1,50 @@
+import asyncio
+import logging
+import time
+
+import pytest
+
+from core.looplag import LoopLagMonitor
+
+
+def blocking_callback(seconds):
+    time.sleep(seconds)
+
+
+@pytest.mark.asyncio
+async def test_loop_lag_monitor_captures_blocking_callback(caplog):
+    monitor = LoopLagMonitor(interval=0.01, threshold=0.05, log_interval=60)
+    await monitor.start()
+    try:
+        await asyncio.sleep(0.05)
+        with caplog.at_level(logging.WARNING, logger="core.looplag"):
+            blocking_callback(0.3)
+            await asyncio.sleep(0.05)
+            blocking_callback(0.3)
+            await asyncio.sleep(0.05)
+    finally:
+        await monitor.stop()
+
+    # One capture per stall, only the first one is logged within the log interval
+    assert monitor.blocked == 2
+    assert "blocking_callback" in monitor.last_stack
+    assert len(caplog.records) == 1
+    assert "blocking_callback" in caplog.records[0].getMessage()
+
+    stats = monitor.stats()
+    assert stats["max_ms"] >= 250
+    assert stats["histogram"]["<=500ms"] == 2
+    assert stats["p99_ms"] == 500
+    assert sum(stats["histogram"].values()) == stats["samples"]
+
+
+def test_loop_lag_percentiles():
+    monitor = LoopLagMonitor()
+    assert monitor.stats()["p99_ms"] is None
+    for lag_ms in [0.5] * 98 + [30, 7000]:
+        monitor.record(lag_ms)
+    assert monitor.percentile_ms(0.5) == 1
+    assert monitor.percentile_ms(0.99) == 50
+    assert monitor.percentile_ms(1) == 7000
+    monitor.reset()
+    assert monitor.stats()["samples"] == 0
@@ -0,0 +1,159 @@
+import io
+import random
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+from azure.ai.formrecognizer import DocumentSpan, DocumentTable, DocumentTableCell
+from azure.core.credentials import AzureKeyCredential
+
+from scripts.pdfparserbenchmark import legacy_page_text, legacy_table_to_html
+from scripts.prepdocslib import pdfparser
+from scripts.prepdocslib.pdfparser import DocumentAnalysisPdfParser, LocalPdfParser
+
+
+def make_pdf(page_texts):
+    # Smallest valid PDF with one line of Helvetica text per page
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for text in page_texts:
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % len(objects)
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode()
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return pdf
+
+
+@pytest.mark.asyncio
+async def test_local_pdf_parser(tmp_path):
+    page_texts = [f"Page number {i}" for i in range(7)]
+    path = tmp_path / "test.pdf"
+    path.write_bytes(make_pdf(page_texts))
+
+    with open(path, "rb") as content:
+        pages = [page async for page in LocalPdfParser().parse(content)]
+    assert [page.text for page in pages] == page_texts
+    assert [page.offset for page in pages] == [sum(len(text) for text in page_texts[:i]) for i in range(7)]
+
+    parser = LocalPdfParser(workers=2, pages_per_shard=2)
+    try:
+        with open(path, "rb") as content:
+            parallel_pages = [page async for page in parser.parse(content)]
+    finally:
+        parser.close()
+    assert [(page.page_num, page.offset, page.text) for page in parallel_pages] == [
+        (page.page_num, page.offset, page.text) for page in pages
+    ]
+
+
+@pytest.mark.asyncio
+async def test_local_pdf_parser_in_memory():
+    # Content that isn't a file on disk is parsed in process
+    content = io.BytesIO(make_pdf(["Hello"]))
+    parser = LocalPdfParser(workers=2)
+    assert [page.text async for page in parser.parse(content)] == ["Hello"]
+    assert parser.executor is None
+
+
+@pytest.mark.asyncio
+async def test_document_analysis_pdf_parser_logs_filename(monkeypatch, capsys):
+    class MockPoller:
+        async def result(self):
+            page = SimpleNamespace(spans=[DocumentSpan(offset=0, length=5)])
+            return SimpleNamespace(content="Hello", pages=[page], tables=[])
+
+    class MockDocumentAnalysisClient:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def begin_analyze_document(self, model_id, document):
+            return MockPoller()
+
+    monkeypatch.setattr(pdfparser, "DocumentAnalysisClient", MockDocumentAnalysisClient)
+    parser = DocumentAnalysisPdfParser(endpoint="https://test", credential=AzureKeyCredential("test"), verbose=True)
+    # Downloaded files are spooled to temporary files without a name
+    with tempfile.SpooledTemporaryFile() as content:
+        assert [page.text async for page in parser.parse(content, filename="plan.pdf")] == ["Hello"]
+    assert "Extracting text from 'plan.pdf' using Azure Document Intelligence" in capsys.readouterr().out
+
+
+def make_table(spans, rows=2, columns=2):
+    cells = [
+        DocumentTableCell(
+            kind="columnHeader" if row == 0 else "content",
+            row_index=row,
+            column_index=column,
+            row_span=2 if (row, column) == (1, 0) else 1,
+            column_span=1,
+            content=f"<{row},{column}>",
+            bounding_regions=[],
+            spans=[],
+        )
+        for row in range(rows)
+        for column in range(columns)
+    ]
+    random.shuffle(cells)
+    return DocumentTable(
+        row_count=rows,
+        column_count=columns,
+        cells=cells,
+        bounding_regions=[],
+        spans=[DocumentSpan(offset=offset, length=length) for offset, length in spans],
+    )
+
+
+def test_table_to_html():
+    random.seed(1)
+    table = make_table([(0, 10)], rows=3, columns=3)
+    assert DocumentAnalysisPdfParser.table_to_html(table) == legacy_table_to_html(table)
+    assert DocumentAnalysisPdfParser.table_to_html(table).startswith(
+        "<table><tr><th>&lt;0,0&gt;</th><th>&lt;0,1&gt;</th><th>&lt;0,2&gt;</th></tr><tr><td rowSpan=2>"
+    )
+
+
+def test_page_text():
+    content = "0123456789" * 10
+    assert DocumentAnalysisPdfParser.page_text(content, 20, 30, []) == content[20:50]
+
+    table = make_table([(25, 5), (35, 5)])
+    # The table replaces its first span, the text of its other spans is dropped
+    assert DocumentAnalysisPdfParser.page_text(content, 20, 30, [table]) == (
+        content[20:25] + DocumentAnalysisPdfParser.table_to_html(table) + content[30:35] + content[40:50]
+    )
+
+
+def test_page_text_matches_previous_implementation():
+    random.seed(0)
+    content = "".join(random.choice("abc .\n") for _ in range(2000))
+    for _ in range(200):
+        page_offset = random.randrange(0, 1000)
+        page_length = random.randrange(0, 500)
+        # Tables may overlap each other and the page boundaries
+        tables = [
+            make_table([(random.randrange(0, 1600), random.randrange(0, 100)) for _ in range(random.randrange(1, 4))])
+            for _ in range(random.randrange(0, 5))
+        ]
+        assert DocumentAnalysisPdfParser.page_text(content, page_offset, page_length, tables) == legacy_page_text(
+            content, page_offset, page_length, tables
+        )
@@ -1,15 +1,26 @@
+import asyncio
+import time
+
 import openai
 import openai.types
 import pytest
 import tenacity
-from conftest import MockAzureCredential
+from conftest import MockAzureCredential, MockToken
 from httpx import Request, Response
 from openai.types.create_embedding_response import Usage
 
+from scripts.prepdocslib.embeddingcache import EmbeddingCache
 from scripts.prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
+    OpenAIEmbeddings,
     OpenAIEmbeddingService,
 )
+from scripts.prepdocslib.embeddingscheduler import (
+    EmbeddingBatch,
+    EmbeddingBatchScheduler,
+    TokenBucket,
+    retry_after_seconds,
+)
 
 
 class MockEmbeddingsClient:
@@ -20,9 +31,27 @@ class MockEmbeddingsClient:
         return self.create_embedding_response
 
 
+class MockRawResponse:
+    def __init__(self, response, headers=None):
+        self.response = response
+        self.headers = headers or {}
+
+    def parse(self):
+        return self.response
+
+
+class MockRawResponseEmbeddingsClient:
+    def __init__(self, embeddings_client):
+        self.embeddings_client = embeddings_client
+
+    async def create(self, *args, **kwargs) -> MockRawResponse:
+        return MockRawResponse(await self.embeddings_client.create(*args, **kwargs))
+
+
 class MockClient:
     def __init__(self, embeddings_client):
         self.embeddings = embeddings_client
+        self.embeddings.with_raw_response = MockRawResponseEmbeddingsClient(embeddings_client)
 
 
 @pytest.mark.asyncio
@@ -158,6 +187,45 @@ async def test_compute_embedding_ratelimiterror_single(monkeypatch, capsys):
     assert captured.out.count("Rate limited on the OpenAI embeddings API") == 14
 
 
+class FlakyMockEmbeddingsClient:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        self.calls += 1
+        if self.calls == 1:
+            raise openai.InternalServerError(message="Service unavailable", response=fake_response(503), body=None)
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[openai.types.Embedding(embedding=[0.5], index=0, object="embedding")],
+            model="text-embedding-ada-002",
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("disable_batch", [False, True])
+async def test_compute_embedding_servererror_retried(monkeypatch, capsys, disable_batch):
+    monkeypatch.setattr(tenacity.wait_random_exponential, "__call__", lambda x, y: 0)
+    embeddings_client = FlakyMockEmbeddingsClient()
+
+    async def create_flaky_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name="text-embedding-ada-002",
+        credential=MockAzureCredential(),
+        disable_batch=disable_batch,
+        verbose=True,
+    )
+    monkeypatch.setattr(embeddings, "create_client", create_flaky_client)
+    assert await embeddings.create_embeddings(texts=["foo"]) == [[0.5]]
+    assert embeddings_client.calls == 2
+    assert "Error from the OpenAI embeddings API (Service unavailable)" in capsys.readouterr().out
+
+
 class AuthenticationErrorMockEmbeddingsClient:
     async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
         raise openai.AuthenticationError(message="Bad things happened.", response=fake_response(403), body=None)
@@ -193,3 +261,254 @@ async def test_compute_embedding_autherror(monkeypatch, capsys):
         )
         monkeypatch.setattr(embeddings, "create_client", create_auth_error_limit_client)
         await embeddings.create_embeddings(texts=["foo"])
+
+
+def test_embedding_cache_roundtrip(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    assert cache.get_many("text-embedding-3-large", 0, ["foo", "bar"]) == [None, None]
+
+    cache.put_many("text-embedding-3-large", 0, ["foo"], [[0.5, -0.25, 1.0]])
+    assert cache.get_many("text-embedding-3-large", 0, ["foo", "bar", "foo"]) == [
+        [0.5, -0.25, 1.0],
+        None,
+        [0.5, -0.25, 1.0],
+    ]
+    # Entries are keyed by model and dimensions too
+    assert cache.get_many("text-embedding-3-small", 0, ["foo"]) == [None]
+    assert cache.get_many("text-embedding-3-large", 256, ["foo"]) == [None]
+
+    stats = cache.stats()
+    assert stats["entries"] == 1
+    assert stats["models"] == [{"model": "text-embedding-3-large", "dimensions": 0, "entries": 1, "vector_bytes": 12}]
+
+    assert cache.prune(older_than_days=1) == 0
+    assert cache.prune(model="text-embedding-3-large") == 1
+    assert cache.stats()["entries"] == 0
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_cache(monkeypatch, tmp_path):
+    requested_inputs = []
+
+    class RecordingEmbeddingsClient:
+        async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+            requested_inputs.append(kwargs["input"])
+            return openai.types.CreateEmbeddingResponse(
+                object="list",
+                data=[
+                    openai.types.Embedding(embedding=[float(len(text)), 0.5], index=i, object="embedding")
+                    for i, text in enumerate(kwargs["input"])
+                ],
+                model="text-embedding-3-large",
+                usage=Usage(prompt_tokens=8, total_tokens=8),
+            )
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=RecordingEmbeddingsClient())
+
+    monkeypatch.setattr(OpenAIEmbeddings, "calculate_token_length", lambda self, text: len(text))
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name="text-embedding-3-large", credential=MockAzureCredential(), cache=cache
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+
+    assert await embeddings.create_embeddings(texts=["a", "bb"]) == [[1.0, 0.5], [2.0, 0.5]]
+    assert requested_inputs == [["a", "bb"]]
+
+    # Only the text that isn't cached yet is sent to the API, and only once
+    assert await embeddings.create_embeddings(texts=["bb", "ccc", "a", "ccc"]) == [
+        [2.0, 0.5],
+        [3.0, 0.5],
+        [1.0, 0.5],
+        [3.0, 0.5],
+    ]
+    assert requested_inputs == [["a", "bb"], ["ccc"]]
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_dimensions(monkeypatch, tmp_path):
+    requests = []
+
+    class RecordingEmbeddingsClient:
+        async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+            requests.append(kwargs)
+            dimensions = kwargs.get("extra_body", {}).get("dimensions", 3)
+            return openai.types.CreateEmbeddingResponse(
+                object="list",
+                data=[
+                    openai.types.Embedding(embedding=[0.5] * dimensions, index=i, object="embedding")
+                    for i, _ in enumerate(kwargs["input"])
+                ],
+                model="text-embedding-3-large",
+                usage=Usage(prompt_tokens=8, total_tokens=8),
+            )
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=RecordingEmbeddingsClient())
+
+    monkeypatch.setattr(OpenAIEmbeddings, "calculate_token_length", lambda self, text: len(text))
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    for disable_batch in [False, True]:
+        embeddings = OpenAIEmbeddingService(
+            open_ai_model_name="text-embedding-3-large",
+            credential=MockAzureCredential(),
+            disable_batch=disable_batch,
+            dimensions=2,
+        )
+        monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+        assert await embeddings.create_embeddings(texts=["a"]) == [[0.5, 0.5]]
+        assert requests[-1]["extra_body"] == {"dimensions": 2}
+
+    # Embeddings of different dimensions are cached separately
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name="text-embedding-3-large", credential=MockAzureCredential(), cache=cache, dimensions=2
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    assert await embeddings.create_embeddings(texts=["a"]) == [[0.5, 0.5]]
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name="text-embedding-3-large", credential=MockAzureCredential(), cache=cache
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    assert await embeddings.create_embeddings(texts=["a"]) == [[0.5, 0.5, 0.5]]
+    assert "extra_body" not in requests[-1]
+    assert len(requests) == 4
+    cache.close()
+
+
+def test_retry_after_seconds():
+    def rate_limit_error(headers):
+        response = Response(429, headers=headers, request=Request(method="post", url="https://foo.bar/"))
+        return openai.RateLimitError(message="Rate limited", response=response, body=None)
+
+    assert retry_after_seconds(rate_limit_error({"retry-after-ms": "1500"})) == 1.5
+    assert retry_after_seconds(rate_limit_error({"retry-after": "7"})) == 7
+    assert retry_after_seconds(rate_limit_error({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0
+    assert retry_after_seconds(rate_limit_error({})) is None
+    assert retry_after_seconds(ValueError()) is None
+
+
+def test_token_bucket_delay():
+    bucket = TokenBucket()
+    # Nothing is known about the quota before the first response
+    assert bucket.delay(1000) == 0
+
+    bucket.update({"x-ratelimit-remaining-tokens": "6000", "x-ratelimit-limit-tokens": "6000"})
+    assert bucket.delay(1000) == 0
+    bucket.consume(5500)
+    # 500 tokens left out of 6000 per minute, so 1000 tokens are available in about 5 seconds
+    assert bucket.delay(1000) == pytest.approx(5, abs=0.1)
+
+
+@pytest.mark.asyncio
+async def test_embedding_scheduler_concurrency():
+    in_flight = 0
+    max_in_flight = 0
+
+    async def embed(batch):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        # Later batches finish first
+        await asyncio.sleep(0.01 / batch.token_length)
+        in_flight -= 1
+        return [[float(len(text))] for text in batch.texts], {}
+
+    scheduler = EmbeddingBatchScheduler(max_concurrency=3)
+    batches = [EmbeddingBatch(["a" * i, "b" * i], i) for i in range(1, 9)]
+    embeddings = await scheduler.run(batches, embed)
+
+    assert embeddings == [[float(i)] for i in range(1, 9) for _ in range(2)]
+    assert max_in_flight == 3
+
+
+@pytest.mark.asyncio
+async def test_embedding_scheduler_throttling():
+    calls = 0
+
+    async def embed(batch):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            response = Response(
+                429, headers={"retry-after-ms": "10"}, request=Request(method="post", url="https://foo.bar/")
+            )
+            raise openai.RateLimitError(message="Rate limited", response=response, body=None)
+        return [[1.0]], {}
+
+    scheduler = EmbeddingBatchScheduler(max_concurrency=4)
+    assert await scheduler.run([EmbeddingBatch(["a"], 1)], embed) == [[1.0]]
+    assert calls == 2
+    # Halved on the 429, then grows back additively on success
+    assert scheduler.concurrency == pytest.approx(2.5)
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_reuses_client(monkeypatch):
+    created_clients = []
+
+    async def mock_create_client(*args, **kwargs):
+        client = MockClient(
+            embeddings_client=MockEmbeddingsClient(
+                create_embedding_response=openai.types.CreateEmbeddingResponse(
+                    object="list",
+                    data=[openai.types.Embedding(embedding=[0.5], index=0, object="embedding")],
+                    model="text-embedding-3-large",
+                    usage=Usage(prompt_tokens=8, total_tokens=8),
+                )
+            )
+        )
+        created_clients.append(client)
+        return client
+
+    monkeypatch.setattr(OpenAIEmbeddings, "calculate_token_length", lambda self, text: len(text))
+    embeddings = OpenAIEmbeddingService(open_ai_model_name="text-embedding-3-large", credential="key")
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    assert await embeddings.create_embeddings(texts=["foo"]) == [[0.5]]
+    assert await embeddings.create_embeddings(texts=["bar"]) == [[0.5]]
+    assert len(created_clients) == 1
+
+
+@pytest.mark.asyncio
+async def test_azure_openai_token_refresh(monkeypatch):
+    class ExpiringCredential(MockAzureCredential):
+        def __init__(self):
+            self.requested = 0
+
+        async def get_token(self, uri):
+            self.requested += 1
+            return MockToken(f"token{self.requested}", time.time() + 60)
+
+    credential = ExpiringCredential()
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name="text-embedding-3-large",
+        credential=credential,
+    )
+    assert await embeddings.get_token() == "token1"
+    # The token expires within the refresh margin, so it's renewed in the background while still being used
+    assert await embeddings.get_token() == "token1"
+    await embeddings.refresh_task
+    assert credential.requested == 2
+    assert await embeddings.get_token() == "token2"
+
+    client = await embeddings.get_client()
+    assert isinstance(client, openai.AsyncAzureOpenAI)
+    assert await embeddings.get_client() is client
+    await embeddings.close()
+    assert embeddings.client is None
+
+
+def test_split_text_into_batches_token_counts(monkeypatch):
+    def fail_calculate_token_length(self, text):
+        raise AssertionError("Texts with a known token count shouldn't be tokenized again")
+
+    monkeypatch.setattr(OpenAIEmbeddings, "calculate_token_length", fail_calculate_token_length)
+    embeddings = OpenAIEmbeddingService(open_ai_model_name="text-embedding-3-large", credential="key")
+    batches = embeddings.split_text_into_batches(["a", "b", "c"], token_counts=[5000, 3000, 4000])
+
+    assert [batch.texts for batch in batches] == [["a", "b"], ["c"]]
+    assert [batch.token_length for batch in batches] == [8000, 4000]
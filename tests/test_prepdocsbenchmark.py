@@ -0,0 +1,33 @@
+import argparse
+
+import pytest
+
+from scripts.prepdocsbenchmark import run_benchmark
+
+
+@pytest.mark.asyncio
+async def test_run_benchmark():
+    args = argparse.Namespace(
+        files=4,
+        pages=2,
+        pagelength=2000,
+        dimensions=8,
+        embeddinglatency=0,
+        embeddingthrottlerate=0,
+        embeddingconcurrency=2,
+        searchlatency=0,
+        searchthrottlerate=0.2,
+        searchretrydelay=0,
+        bloblatency=0,
+        parserworkers=1,
+        stageworkers=None,
+        output=None,
+    )
+    results = await run_benchmark(args)
+
+    assert results["error"] is None
+    assert results["files"] == 4
+    assert results["sections"] > 4
+    assert results["sections_per_second"] > 0
+    assert set(results["stage_seconds"]) == {"parse", "split", "embed", "index", "blob"}
+    assert results["config"]["files"] == 4
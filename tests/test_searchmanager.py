@@ -1,4 +1,6 @@
+import hashlib
 import io
+import re
 
 import openai
 import openai.types
@@ -28,6 +30,30 @@ class MockClient:
         self.embeddings = embeddings_client
 
 
+class AsyncSearchResultsIterator:
+    def __init__(self, results):
+        self.results = list(results)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if len(self.results) == 0:
+            raise StopAsyncIteration
+        return self.results.pop(0)
+
+    async def get_count(self):
+        return len(self.results)
+
+
+@pytest.fixture
+def mock_search_no_results(monkeypatch):
+    async def mock_search(self, *args, **kwargs):
+        return AsyncSearchResultsIterator([])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+
 @pytest.fixture
 def search_info():
     return SearchInfo(
@@ -59,6 +85,35 @@ async def test_create_index_doesnt_exist_yet(monkeypatch, search_info):
     assert len(indexes) == 1, "It should have created one index"
     assert indexes[0].name == "test"
     assert len(indexes[0].fields) == 6
+    embedding_field = next(field for field in indexes[0].fields if field.name == "embedding")
+    assert embedding_field.vector_search_dimensions == 3072
+    assert embedding_field.hidden
+
+
+@pytest.mark.asyncio
+async def test_create_index_embedding_dimensions(monkeypatch, search_info):
+    indexes = []
+
+    async def mock_create_index(self, index):
+        indexes.append(index)
+
+    async def mock_list_index_names(self):
+        for index in []:
+            yield index
+
+    monkeypatch.setattr(SearchIndexClient, "create_index", mock_create_index)
+    monkeypatch.setattr(SearchIndexClient, "list_index_names", mock_list_index_names)
+
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name="text-embedding-3-large",
+        credential=AzureKeyCredential("test"),
+        dimensions=256,
+    )
+    await SearchManager(search_info, embeddings=embeddings).create_index()
+    embedding_field = next(field for field in indexes[0].fields if field.name == "embedding")
+    assert embedding_field.vector_search_dimensions == 256
 
 
 @pytest.mark.asyncio
@@ -106,10 +161,10 @@ async def test_create_index_acls(monkeypatch, search_info):
 
 
 @pytest.mark.asyncio
-async def test_update_content(monkeypatch, search_info):
+async def test_update_content(monkeypatch, search_info, mock_search_no_results):
     async def mock_upload_documents(self, documents):
         assert len(documents) == 1
-        assert documents[0]["id"] == "file-foo_pdf-666F6F2E706466-page-0"
+        assert documents[0]["id"] == "file-foo_pdf-666F6F2E706466-" + hashlib.sha256(b"0:test content").hexdigest()
         assert documents[0]["content"] == "test content"
         assert documents[0]["category"] == "test"
         assert documents[0]["sourcepage"] == "foo.pdf#page=1"
@@ -140,7 +195,7 @@ async def test_update_content(monkeypatch, search_info):
 
 
 @pytest.mark.asyncio
-async def test_update_content_many(monkeypatch, search_info):
+async def test_update_content_many(monkeypatch, search_info, mock_search_no_results):
     ids = []
 
     async def mock_upload_documents(self, documents):
@@ -177,7 +232,7 @@ async def test_update_content_many(monkeypatch, search_info):
 
 
 @pytest.mark.asyncio
-async def test_update_content_with_embeddings(monkeypatch, search_info):
+async def test_update_content_with_embeddings(monkeypatch, search_info, mock_search_no_results):
     async def mock_create_client(*args, **kwargs):
         # From https://platform.openai.com/docs/api-reference/embeddings/create
         return MockClient(
@@ -245,6 +300,86 @@ async def test_update_content_with_embeddings(monkeypatch, search_info):
     ]
 
 
+def test_section_ids():
+    test_io = io.BytesIO(b"test")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io)
+    sections = [
+        Section(split_page=SplitPage(page_num=0, text="same text"), content=file),
+        Section(split_page=SplitPage(page_num=1, text="same text"), content=file),
+        Section(split_page=SplitPage(page_num=2, text="other text"), content=file),
+    ]
+    ids = SearchManager.section_ids(sections)
+    assert len(set(ids)) == 3, "Repeated text within a file should still get unique ids"
+    assert all(id.startswith("file-foo_pdf-666F6F2E706466-") for id in ids)
+    # ids only depend on the text, not on where the section is in the file
+    assert SearchManager.section_ids(sections[2:]) == ids[2:]
+    # Changing the embedding model or dimensions changes every id, so the sections are embedded again
+    large_ids = SearchManager.section_ids(sections, "text-embedding-3-large:0:")
+    shortened_ids = SearchManager.section_ids(sections, "text-embedding-3-large:256:")
+    assert len(set(ids) | set(large_ids) | set(shortened_ids)) == 9
+
+
+@pytest.mark.asyncio
+async def test_update_content_incremental(monkeypatch, search_info):
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io)
+    sections = [
+        Section(split_page=SplitPage(page_num=0, text="unchanged"), content=file),
+        Section(split_page=SplitPage(page_num=1, text="edited"), content=file),
+    ]
+    unchanged_id, edited_id = SearchManager.section_ids(sections, "text-ada-003:0:")
+
+    searches = []
+
+    async def mock_search(self, *args, **kwargs):
+        searches.append(kwargs)
+        return AsyncSearchResultsIterator([{"id": unchanged_id}, {"id": "file-foo_pdf-666F6F2E706466-vanished"}])
+
+    uploaded, merged, deleted = [], [], []
+
+    async def mock_upload_documents(self, documents):
+        uploaded.extend(documents)
+
+    async def mock_merge_documents(self, documents):
+        merged.extend(documents)
+
+    async def mock_delete_documents(self, documents):
+        deleted.extend(documents)
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "merge_documents", mock_merge_documents)
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    embedded_texts = []
+
+    async def mock_create_embeddings(texts, token_counts=None):
+        embedded_texts.extend(texts)
+        return [[0.1, 0.2] for _ in texts]
+
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name="text-ada-003",
+        credential=AzureKeyCredential("test"),
+    )
+    monkeypatch.setattr(embeddings, "create_embeddings", mock_create_embeddings)
+    manager = SearchManager(search_info, embeddings=embeddings)
+
+    await manager.update_content(sections)
+
+    assert searches[0]["filter"] == "sourcefile eq 'foo.pdf'"
+    assert searches[0]["select"] == ["id"]
+    assert embedded_texts == ["edited"], "Only new chunks should be embedded"
+    assert [document["id"] for document in uploaded] == [edited_id]
+    assert merged == [
+        {"id": unchanged_id, "category": None, "sourcepage": "foo.pdf#page=1", "sourcefile": "foo.pdf"}
+    ], "Unchanged chunks should only get their metadata refreshed"
+    assert deleted == [{"id": "file-foo_pdf-666F6F2E706466-vanished"}]
+
+
 @pytest.mark.asyncio
 async def test_remove_content(monkeypatch, search_info):
     class AsyncSearchResultsIterator:
@@ -278,6 +413,7 @@ async def test_remove_content(monkeypatch, search_info):
     async def mock_search(self, *args, **kwargs):
         self.filter = kwargs.get("filter")
         searched_filters.append(self.filter)
+        assert kwargs.get("select") == ["id"], "Only the ids of the sections should be retrieved"
         return search_results
 
     monkeypatch.setattr(SearchClient, "search", mock_search)
@@ -286,7 +422,6 @@ async def test_remove_content(monkeypatch, search_info):
 
     async def mock_delete_documents(self, documents):
         deleted_documents.extend(documents)
-        return documents
 
     monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
 
@@ -296,7 +431,36 @@ async def test_remove_content(monkeypatch, search_info):
 
     await manager.remove_content("foo.pdf")
 
-    assert len(searched_filters) == 2, "It should have searched twice (with no results on second try)"
+    assert len(searched_filters) == 1, "It should have searched once, as all the ids fit in a single search"
     assert searched_filters[0] == "sourcefile eq 'foo.pdf'"
     assert len(deleted_documents) == 1, "It should have deleted one document"
     assert deleted_documents[0]["id"] == "file-foo_pdf-666F6F2E706466-page-0"
+
+
+@pytest.mark.asyncio
+async def test_remove_contents_many_files(monkeypatch, search_info):
+    searched_filters = []
+
+    async def mock_search(self, *args, **kwargs):
+        filter = kwargs.get("filter")
+        searched_filters.append(filter)
+        return AsyncSearchResultsIterator(
+            [{"id": f"{name}-section"} for name in re.findall(r"sourcefile eq '((?:[^']|'')*)'", filter)]
+        )
+
+    deleted_ids = []
+
+    async def mock_delete_documents(self, documents):
+        deleted_ids.extend(document["id"] for document in documents)
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    paths = [f"data/doc{i}.pdf" for i in range(250)] + ["other/doc0.pdf", "data/it's.pdf"]
+    await SearchManager(search_info).remove_contents(paths)
+
+    # Files are looked up 100 at a time, and a file name listed twice is only removed once
+    assert len(searched_filters) == 3
+    assert searched_filters[0].startswith("sourcefile eq 'doc0.pdf' or sourcefile eq 'doc1.pdf' or ")
+    assert len(deleted_ids) == 251
+    assert "it''s.pdf-section" in deleted_ids
@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+from azure.core.exceptions import HttpResponseError
+
+from scripts.prepdocslib.searchuploader import SearchDocumentUploader
+
+
+class MockIndexingResult:
+    def __init__(self, key, status_code=200, error_message=None):
+        self.key = key
+        self.succeeded = status_code in (200, 201)
+        self.status_code = status_code
+        self.error_message = error_message
+
+
+class MockSearchClient:
+    def __init__(self, statuses=None, delay=0):
+        # statuses maps a key to the status codes returned for it on successive attempts
+        self.statuses = statuses or {}
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def upload_documents(self, documents):
+        self.requests.append([document["id"] for document in documents])
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.delay)
+        self.in_flight -= 1
+        results = []
+        for document in documents:
+            statuses = self.statuses.get(document["id"], [])
+            results.append(MockIndexingResult(document["id"], statuses.pop(0) if statuses else 200))
+        return results
+
+    merge_documents = upload_documents
+    delete_documents = upload_documents
+
+
+def test_split_batches():
+    documents = [{"id": str(i), "content": "x" * 100} for i in range(10)]
+    size = SearchDocumentUploader.document_size(documents[0])
+
+    uploader = SearchDocumentUploader(max_batch_bytes=size * 3)
+    assert [len(batch) for batch in uploader.split_batches(documents)] == [3, 3, 3, 1]
+
+    uploader = SearchDocumentUploader(max_batch_bytes=size * 100, max_batch_size=4)
+    assert [len(batch) for batch in uploader.split_batches(documents)] == [4, 4, 2]
+
+    # A document bigger than the limit is still sent, on its own
+    uploader = SearchDocumentUploader(max_batch_bytes=10)
+    assert [len(batch) for batch in uploader.split_batches(documents)] == [1] * 10
+
+
+@pytest.mark.asyncio
+async def test_send_concurrently():
+    client = MockSearchClient(delay=0.01)
+    uploader = SearchDocumentUploader(max_batch_size=2, max_concurrency=3)
+    await uploader.send(client, "upload", [{"id": str(i)} for i in range(10)])
+
+    assert sorted(id for request in client.requests for id in request) == [str(i) for i in range(10)]
+    assert client.max_in_flight == 3
+    assert uploader.documents_sent == 10
+    assert "10 documents" in uploader.report()
+
+
+@pytest.mark.asyncio
+async def test_send_reports_actions(capsys):
+    uploader = SearchDocumentUploader(verbose=True)
+    for action in ["upload", "merge", "delete"]:
+        await uploader.send(MockSearchClient(), action, [{"id": "1"}, {"id": "2"}])
+    output = capsys.readouterr().out
+    assert "Uploaded 2 documents" in output
+    assert "Merged 2 documents" in output
+    assert "Deleted 2 documents" in output
+
+
+@pytest.mark.asyncio
+async def test_send_retries_failed_keys():
+    client = MockSearchClient(statuses={"1": [503, 503], "3": [422]})
+    uploader = SearchDocumentUploader(retry_delay=0)
+    await uploader.send(client, "upload", [{"id": str(i)} for i in range(5)])
+
+    # Only the documents that failed are sent again
+    assert client.requests == [["0", "1", "2", "3", "4"], ["1", "3"], ["1"]]
+
+
+@pytest.mark.asyncio
+async def test_send_fails():
+    client = MockSearchClient(statuses={"1": [400], "2": [503] * 10})
+    uploader = SearchDocumentUploader(max_retries=2, retry_delay=0)
+    with pytest.raises(Exception, match="2 documents couldn't be indexed"):
+        await uploader.send(client, "upload", [{"id": str(i)} for i in range(3)])
+    # The document rejected as invalid isn't retried
+    assert client.requests == [["0", "1", "2"], ["2"], ["2"]]
+
+
+@pytest.mark.asyncio
+async def test_send_retries_throttled_requests():
+    client = MockSearchClient()
+    attempts = 0
+    upload_documents = client.upload_documents
+
+    async def throttled_upload_documents(documents):
+        nonlocal attempts
+        attempts += 1
+        if attempts == 1:
+            error = HttpResponseError("Service unavailable")
+            error.status_code = 503
+            raise error
+        return await upload_documents(documents)
+
+    client.upload_documents = throttled_upload_documents
+    uploader = SearchDocumentUploader(retry_delay=0)
+    await uploader.send(client, "upload", [{"id": "0"}])
+    assert attempts == 2
+    assert client.requests == [["0"]]
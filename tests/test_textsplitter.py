@@ -0,0 +1,166 @@
+import random
+import re
+
+import pytest
+import tiktoken
+
+from scripts.prepdocslib.pdfparser import Page
+from scripts.prepdocslib.textsplitter import SplitPage, TextSplitter
+
+
+class WordEncoding:
+    # Stand-in for a tiktoken encoding where every word is a token
+    def encode_ordinary_batch(self, texts):
+        return [re.findall(r"\S+\s*", text) for text in texts]
+
+
+@pytest.fixture
+def word_encoding(monkeypatch):
+    monkeypatch.setattr(tiktoken, "encoding_for_model", lambda model_name: WordEncoding())
+
+
+def test_split_pages_by_characters():
+    pages = [Page(page_num=0, offset=0, text="Hello world. " * 100), Page(page_num=1, offset=1300, text="Bye. " * 400)]
+    split_pages = list(TextSplitter().split_pages(pages))
+
+    assert len(split_pages) > 1
+    assert all(len(split_page.text) <= 1100 for split_page in split_pages)
+    assert all(split_page.token_count is None for split_page in split_pages)
+    assert split_pages[0].page_num == 0
+    assert split_pages[-1].page_num == 1
+
+
+def test_split_pages_by_tokens(word_encoding):
+    sentences = [f"Sentence number {i} has exactly seven words. " for i in range(20)]
+    pages = [
+        Page(page_num=0, offset=0, text="".join(sentences[:10])),
+        Page(page_num=1, offset=len("".join(sentences[:10])), text="".join(sentences[10:])),
+    ]
+    split_pages = list(TextSplitter(max_tokens_per_section=75).split_pages(pages))
+
+    # Ten whole sentences fit in 75 tokens, and the last sentence of a section fits in the overlap of the next one
+    assert [split_page.text for split_page in split_pages] == [
+        "".join(sentences[0:10]),
+        "".join(sentences[9:19]),
+        "".join(sentences[18:20]),
+    ]
+    assert [split_page.token_count for split_page in split_pages] == [70, 70, 14]
+    assert [split_page.page_num for split_page in split_pages] == [0, 0, 1]
+
+
+def test_split_pages_by_tokens_tables(word_encoding):
+    table = "<table><tr><td>a b c</td></tr><tr><td>d e f</td></tr></table>"
+    text = "Intro sentence here. " + table + " Outro sentence here."
+    split_pages = list(TextSplitter(max_tokens_per_section=10).split_pages([Page(page_num=0, offset=0, text=text)]))
+
+    # The table fits in a section, so it's never cut
+    assert any(table in split_page.text for split_page in split_pages)
+
+    split_pages = list(TextSplitter(max_tokens_per_section=3).split_pages([Page(page_num=0, offset=0, text=table)]))
+    # Tables that are too large are cut after a row first
+    assert split_pages[0].text == "<table><tr><td>a b c</td></tr>"
+
+
+def test_split_pages_by_tokens_long_sentence(word_encoding):
+    text = " ".join(f"word{i}" for i in range(25)) + "."
+    split_pages = list(TextSplitter(max_tokens_per_section=10).split_pages([Page(page_num=0, offset=0, text=text)]))
+
+    assert [split_page.token_count for split_page in split_pages] == [10, 10, 7]
+    assert split_pages[1].text.startswith("word9 ")
+    assert split_pages[-1].text.endswith("word24.")
+
+
+def test_split_pages_by_tokens_empty(word_encoding):
+    assert list(TextSplitter(max_tokens_per_section=10).split_pages([Page(page_num=0, offset=0, text="")])) == []
+
+
+def test_split_page_token_count():
+    assert SplitPage(page_num=0, text="foo").token_count is None
+    assert SplitPage(page_num=0, text="foo", token_count=1).token_count == 1
+
+
+def legacy_split_pages(splitter, pages):
+    # Character by character implementation that split_pages replaced, kept to check the output is unchanged
+    def find_page(offset):
+        num_pages = len(pages)
+        for i in range(num_pages - 1):
+            if offset >= pages[i].offset and offset < pages[i + 1].offset:
+                return pages[i].page_num
+        return pages[num_pages - 1].page_num
+
+    all_text = "".join(page.text for page in pages)
+    length = len(all_text)
+    start = 0
+    end = length
+    while start + splitter.section_overlap < length:
+        last_word = -1
+        end = start + splitter.max_section_length
+        if end > length:
+            end = length
+        else:
+            while (
+                end < length
+                and (end - start - splitter.max_section_length) < splitter.sentence_search_limit
+                and all_text[end] not in splitter.sentence_endings
+            ):
+                if all_text[end] in splitter.word_breaks:
+                    last_word = end
+                end += 1
+            if end < length and all_text[end] not in splitter.sentence_endings and last_word > 0:
+                end = last_word
+        if end < length:
+            end += 1
+        last_word = -1
+        while (
+            start > 0
+            and start > end - splitter.max_section_length - 2 * splitter.sentence_search_limit
+            and all_text[start] not in splitter.sentence_endings
+        ):
+            if all_text[start] in splitter.word_breaks:
+                last_word = start
+            start -= 1
+        if all_text[start] not in splitter.sentence_endings and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+        section_text = all_text[start:end]
+        yield SplitPage(page_num=find_page(start), text=section_text)
+        last_table_start = section_text.rfind("<table")
+        if last_table_start > 2 * splitter.sentence_search_limit and last_table_start > section_text.rfind("</table"):
+            start = min(end - splitter.section_overlap, start + last_table_start)
+        else:
+            start = end - splitter.section_overlap
+    if start + splitter.section_overlap < end:
+        yield SplitPage(page_num=find_page(start), text=all_text[start:end])
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_split_pages_matches_previous_implementation(seed):
+    random.seed(seed)
+    # Few sentence endings and word breaks on some pages, many on others, tables, empty pages and long words
+    alphabets = ["abcdefgh", "abc def, ghi; jk", "ab. cd! ef? gh ", "(a) [b] {c}:\td\n"]
+    pages = []
+    offset = 0
+    for page_num in range(random.randrange(1, 8)):
+        parts = []
+        for _ in range(random.randrange(0, 6)):
+            if random.random() < 0.2:
+                parts.append("<table><tr><td>" + "cell " * random.randrange(0, 150) + "</td></tr>")
+                if random.random() < 0.7:
+                    parts.append("</table>")
+            else:
+                alphabet = random.choice(alphabets)
+                parts.append("".join(random.choice(alphabet) for _ in range(random.randrange(0, 900))))
+        text = "".join(parts)
+        pages.append(Page(page_num=page_num, offset=offset, text=text))
+        offset += len(text)
+
+    splitter = TextSplitter()
+    expected = [(split_page.page_num, split_page.text) for split_page in legacy_split_pages(splitter, pages)]
+    assert [(split_page.page_num, split_page.text) for split_page in splitter.split_pages(pages)] == expected
+
+
+def test_page_finder():
+    pages = [Page(page_num=0, offset=0, text="ab"), Page(page_num=1, offset=2, text=""), Page(2, 2, "cd")]
+    find_page = TextSplitter.page_finder(pages)
+    assert [find_page(offset) for offset in range(5)] == [0, 0, 2, 2, 2]